@@ -308,6 +308,10 @@ class FileSR(SR.SR):
             index += 1
  
     def _kickGC(self):
+        # a running instance may be scanning incrementally: make sure it 
+        # picks up any changes we made
+        cleanup.requestFullScan(self.uuid)
+
         # don't bother if an instance already running (this is just an 
         # optimization to reduce the overhead of forking a new process if we 
         # don't have to, but the process will check the lock anyways)
@@ -20,6 +20,8 @@ import SRCommand
 import util
 import lvutil
 import lvmcache
+import lvmshell
+import devmapper
 import vhdutil
 import lvhdutil
 import scsiutil
@@ -30,11 +32,13 @@ import errno
 import xs_errors
 import cleanup
 import blktap2
+import thinmon
 from journaler import Journaler
 from lock import Lock
 from refcounter import RefCounter
 from ipc import IPCFlag
 from lvmanager import LVActivator
+from vgledger import VGLedger, VGLedgerNoSpace
 import XenAPI
 import re
 from srmetadata import ALLOCATION_TAG, NAME_LABEL_TAG, NAME_DESCRIPTION_TAG, \
@@ -44,8 +48,6 @@ from srmetadata import ALLOCATION_TAG, NAME_LABEL_TAG, NAME_DESCRIPTION_TAG, \
     METADATA_OBJECT_TYPE_SR, METADATA_UPDATE_OBJECT_TYPE_TAG
 from metadata import retrieveXMLfromFile, _parseXML
 from xmlrpclib import DateTime
-import glob
-DEV_MAPPER_ROOT = os.path.join('/dev/mapper', lvhdutil.VG_PREFIX)
 
 geneology = {}
 CAPABILITIES = ["SR_PROBE","SR_UPDATE",
@@ -162,6 +164,8 @@ class LVHDSR(SR.SR):
                         opterr='Failed to initialise the LVMCache')
         self.lvActivator = LVActivator(self.uuid, self.lvmCache)
         self.journaler = Journaler(self.lvmCache)
+        self.ledger = VGLedger(self.vgname)
+        lvmshell.start() # until cleanup()
         if not self.srcmd.params.get("sr_ref"):
             return # must be a probe call
         # Test for thick vs thin provisioning conf parameter
@@ -227,9 +231,15 @@ class LVHDSR(SR.SR):
             pass
 
     def cleanup(self):
+        # the operation is over: whatever space it needed is either allocated
+        # by now or not needed anymore
+        self.ledger.releaseAll()
         # we don't need to hold the lock to dec refcounts of activated LVs
-        if not self.lvActivator.deactivateAll():
-            raise util.SMException("failed to deactivate LVs")
+        try:
+            if not self.lvActivator.deactivateAll():
+                raise util.SMException("failed to deactivate LVs")
+        finally:
+            lvmshell.stop()
 
     def updateSRMetadata(self, allocation):
         try:
@@ -543,9 +553,9 @@ class LVHDSR(SR.SR):
         # Do a best effort cleanup of the dev mapper entries
         # go through all devmapper entries for this VG
         success = True
-        for fileName in \
-            filter(lambda x: util.extractSRFromDevMapper(x) == self.uuid, \
-                glob.glob(DEV_MAPPER_ROOT + '*')):
+        prefix = devmapper.getDMName(self.path + "/")
+        for fileName in map(lambda x: os.path.join(devmapper.DEV_MAPPER, x),
+                devmapper.getInventory().getNames(prefix)):
             #   check if any file has open handles
             if util.doesFileHaveOpenHandles(fileName):
                 #   if yes, log this and signal failure
@@ -605,7 +615,7 @@ class LVHDSR(SR.SR):
                 raise xs_errors.XenError('LVMMaster')
 
             self._loadvdis()
-            stats = lvutil._getVGstats(self.vgname)
+            stats = self._getVGStats()
             self.physical_size = stats['physical_size']
             self.physical_utilisation = stats['physical_utilisation']
 
@@ -738,7 +748,7 @@ class LVHDSR(SR.SR):
     def _updateStats(self, uuid, virtAllocDelta):
         valloc = int(self.session.xenapi.SR.get_virtual_allocation(self.sr_ref))
         self.virtual_allocation = valloc + virtAllocDelta
-        stats = lvutil._getVGstats(self.vgname)
+        stats = self._getVGStats()
         self.physical_size = stats['physical_size']
         self.physical_utilisation = stats['physical_utilisation']
         self._db_update()
@@ -783,13 +793,27 @@ class LVHDSR(SR.SR):
                 util.SMlog("Scan found hidden leaf (%s), ignoring" % uuid)
                 del self.vdis[uuid]
 
+    def _getVGStats(self):
+        try:
+            return self.ledger.getStats()
+        except util.SMException, e:
+            raise xs_errors.XenError('VDILoad', opterr=str(e))
+
     def _ensureSpaceAvailable(self, amount_needed):
-        space_available = lvutil._getVGstats(self.vgname)['freespace']
-        if (space_available < amount_needed):
-            util.SMlog("Not enough space! free space: %d, need: %d" % \
-                    (space_available, amount_needed))
+        """Reserve amount_needed in the VG ledger, so that concurrent
+        operations (and the GC) can't use the same free space. Return the
+        reservation ID, to be passed to _releaseSpace() as soon as the
+        allocation it covers is done or has failed: from then on the VG free
+        space accounts for it. (Anything left is released in cleanup())"""
+        try:
+            return self.ledger.reserve(amount_needed, "%s" % self.srcmd.cmd)
+        except VGLedgerNoSpace, e:
+            util.SMlog("Not enough space! %s" % e)
             raise xs_errors.XenError('SRNoSpace')
 
+    def _releaseSpace(self, resId):
+        self.ledger.release(resId)
+
     def _handleInterruptedCloneOps(self):
         entries = self.journaler.getAll(LVHDVDI.JRN_CLONE)
         for uuid, val in entries.iteritems():
@@ -1118,14 +1142,11 @@ class LVHDSR(SR.SR):
                 "uuid3"  : baseUuid}
 
         masterRef = util.get_this_host_ref(self.session)
-        for hostRef in hostRefs:
-            if hostRef == masterRef:
-                continue
-            util.SMlog("Updating %s, %s, %s on slave %s" % \
-                    (origOldLV, origLV, baseLV, hostRef))
-            text = self.session.xenapi.host.call_plugin( \
-                    hostRef, self.PLUGIN_ON_SLAVE, "multi", args)
-            util.SMlog("call-plugin returned: '%s'" % text)
+        slaves = filter(lambda x: x != masterRef, hostRefs)
+        util.SMlog("Updating %s, %s, %s on slaves %s" % \
+                (origOldLV, origLV, baseLV, slaves))
+        util.call_plugin_on_hosts(self.session, slaves,
+                self.PLUGIN_ON_SLAVE, "multi", args).check()
 
     def _cleanup(self, skipLockCleanup = False):
         """delete stale refcounter, flag, and lock files"""
@@ -1142,6 +1163,10 @@ class LVHDSR(SR.SR):
             util.SMlog("Setting env %s" % self.ENV_VAR_VHD_TEST[self.testMode])
 
     def _kickGC(self):
+        # a running instance may be scanning incrementally: make sure it 
+        # picks up any changes we made
+        cleanup.requestFullScan(self.uuid)
+
         # don't bother if an instance already running (this is just an 
         # optimization to reduce the overhead of forking a new process if we 
         # don't have to, but the process will check the lock anyways)
@@ -1239,9 +1264,11 @@ class LVHDVDI(VDI.VDI):
                 lvSize = lvhdutil.calcSizeVHDLV(long(size))
 
         self.sm_config = self.sr.srcmd.params["vdi_sm_config"]
-        self.sr._ensureSpaceAvailable(lvSize)
-
-        self.sr.lvmCache.create(self.lvname, lvSize)
+        resId = self.sr._ensureSpaceAvailable(lvSize)
+        try:
+            self.sr.lvmCache.create(self.lvname, lvSize)
+        finally:
+            self.sr._releaseSpace(resId)
         if self.vdi_type == vhdutil.VDI_TYPE_RAW:
             self.size = self.sr.lvmCache.getSize(self.lvname)
         else:
@@ -1328,7 +1355,12 @@ class LVHDVDI(VDI.VDI):
                 raise xs_errors.XenError('LVMProvisionAttach')
 
         try:
-            return self._attach()
+            ret = self._attach()
+            if needInflate and self.sr.thinpr and \
+                    self.utilisation < lvhdutil.calcSizeVHDLV(self.size):
+                # only inflated by the predicted increment: grow it online
+                thinmon.register(self.sr.uuid, self.uuid)
+            return ret
         finally:
             if not self.sr.lvActivator.deactivateAll():
                 util.SMlog("Failed to deactivate LVs back (%s)" % self.uuid)
@@ -1339,6 +1371,14 @@ class LVHDVDI(VDI.VDI):
         self._loadThis()
         already_deflated = (self.utilisation < \
                 lvhdutil.calcSizeVHDLV(self.size))
+        if already_deflated and self.sr.thinpr and \
+                self.vdi_type == vhdutil.VDI_TYPE_VHD:
+            # partially inflated by attach (see lvhdutil.attachThin)
+            thinmon.unregister(self.sr.uuid, self.uuid)
+            vdi_ref = self.sr.srcmd.params['vdi_ref']
+            sm_config = self.session.xenapi.VDI.get_sm_config(vdi_ref)
+            if sm_config.has_key(lvhdutil.THIN_KEY_ATTACH_SIZE):
+                already_deflated = False
         needDeflate = True
         if self.vdi_type == vhdutil.VDI_TYPE_RAW or already_deflated:
             needDeflate = False
@@ -1398,17 +1438,23 @@ class LVHDVDI(VDI.VDI):
                 lvSizeNew = lvSizeOld
         assert(lvSizeNew >= lvSizeOld)
         spaceNeeded = lvSizeNew - lvSizeOld
-        self.sr._ensureSpaceAvailable(spaceNeeded)
+        resId = self.sr._ensureSpaceAvailable(spaceNeeded)
 
         oldSize = self.size
         if self.vdi_type == vhdutil.VDI_TYPE_RAW:
-            self.sr.lvmCache.setSize(self.lvname, lvSizeNew)
+            try:
+                self.sr.lvmCache.setSize(self.lvname, lvSizeNew)
+            finally:
+                self.sr._releaseSpace(resId)
             self.size = self.sr.lvmCache.getSize(self.lvname)
             self.utilisation = self.size
         else:
-            if lvSizeNew != lvSizeOld:
-                lvhdutil.inflate(self.sr.journaler, self.sr.uuid, self.uuid,
-                        lvSizeNew)
+            try:
+                if lvSizeNew != lvSizeOld:
+                    lvhdutil.inflate(self.sr.journaler, self.sr.uuid,
+                            self.uuid, lvSizeNew)
+            finally:
+                self.sr._releaseSpace(resId)
             vhdutil.setSizeVirtFast(self.path, size)
             self.size = vhdutil.getSizeVirt(self.path)
             self.utilisation = self.sr.lvmCache.getSize(self.lvname)
@@ -1534,8 +1580,20 @@ class LVHDVDI(VDI.VDI):
             lvSizeBase = util.roundup(lvutil.LVM_SIZE_INCREMENT,
                     vhdutil.getSizePhys(self.path))
             size_req -= (self.utilisation - lvSizeBase)
-        self.sr._ensureSpaceAvailable(size_req)
+        resId = self.sr._ensureSpaceAvailable(size_req)
+        try:
+            (snapVDI, snapVDI2) = self._createSnaps(snapType, hostRefs,
+                    lvSizeOrig, lvSizeClon, lvSizeBase)
+        finally:
+            self.sr._releaseSpace(resId)
+
+        return self._finishSnapshot(snapVDI, snapVDI2, cloneOp)
 
+    def _createSnaps(self, snapType, hostRefs, lvSizeOrig, lvSizeClon,
+            lvSizeBase):
+        """Turn self into the base copy and create the snapshot VDIs on top
+        of it, in the space reserved by _snapshot(). Return the snapshot VDI
+        objects (the second one None for SNAPSHOT_SINGLE)"""
         baseUuid = util.gen_uuid()
         origUuid = self.uuid
         clonUuid = ""
@@ -1598,7 +1656,7 @@ class LVHDVDI(VDI.VDI):
         util.fistpoint.activate("LVHDRT_clone_vdi_before_remove_journal",self.sr.uuid)
         self.sr.journaler.remove(self.JRN_CLONE, origUuid)
 
-        return self._finishSnapshot(snapVDI, snapVDI2, cloneOp)
+        return (snapVDI, snapVDI2)
 
 
     def _createSnap(self, snapUuid, snapSizeLV, isNew):
@@ -1876,18 +1934,21 @@ class LVHDVDI(VDI.VDI):
         if self.vdi_type == vhdutil.VDI_TYPE_VHD:
             vdiList = vhdutil.getParentChain(self.lvname,
                     lvhdutil.extractUuid, self.sr.vgname)
+        lvs = []
         for uuid, lvName in vdiList.iteritems():
             binaryParam = binary
             if uuid != self.uuid:
                 binaryParam = False # binary param only applies to leaf nodes
             if active:
-                self.sr.lvActivator.activate(uuid, lvName, binaryParam,
-                        persistent)
+                lvs.append((uuid, lvName, binaryParam))
             else:
                 # just add the LVs for deactivation in the final (cleanup) 
                 # step. The LVs must not have been activated during the current 
                 # operation
                 self.sr.lvActivator.add(uuid, lvName, binaryParam)
+        if lvs:
+            # the whole chain in one lvchange
+            self.sr.lvActivator.activateMany(lvs, persistent)
 
     def _failClone(self, uuid, jval, msg):
         self.sr._handleInterruptedCloneOp(uuid, jval, True)
@@ -1906,29 +1967,39 @@ class LVHDVDI(VDI.VDI):
         if self.sr.isMaster:
             # the master can prepare the VDI locally
             if attach:
-                lvhdutil.attachThin(self.sr.journaler, self.sr.uuid, self.uuid)
+                session = None # inflate fully unless thin-provisioned
+                if self.sr.thinpr:
+                    session = self.session
+                lvhdutil.attachThin(self.sr.journaler, self.sr.uuid, self.uuid,
+                        session)
             else:
                 lvhdutil.detachThin(self.session, self.sr.lvmCache,
                         self.sr.uuid, self.uuid)
         else:
             fn = "attach"
-            if not attach:
+            args = {"srUuid": self.sr.uuid, "vdiUuid": self.uuid}
+            if attach:
+                args["thin"] = str(self.sr.thinpr)
+            else:
                 fn = "detach"
             pools = self.session.xenapi.pool.get_all()
             master = self.session.xenapi.pool.get_master(pools[0])
             text = self.session.xenapi.host.call_plugin( \
-                    master, self.sr.THIN_PLUGIN, fn, \
-                    {"srUuid": self.sr.uuid, "vdiUuid": self.uuid})
+                    master, self.sr.THIN_PLUGIN, fn, args)
             util.SMlog("call-plugin returned: '%s'" % text)
+            if text == str(False):
+                raise util.SMException("%s of %s failed on the master" % \
+                        (fn, self.uuid))
             # refresh to pick up the size change on this slave
             self.sr.lvmCache.activateNoRefcount(self.lvname, True)
+            self.sr.lvmCache.refresh()
 
         self.utilisation = self.sr.lvmCache.getSize(self.lvname)
         if origUtilisation != self.utilisation:
             vdi_ref = self.sr.srcmd.params['vdi_ref']
             self.session.xenapi.VDI.set_physical_utilisation(vdi_ref,
                     str(self.utilisation))
-            stats = lvutil._getVGstats(self.sr.vgname)
+            stats = self.sr._getVGStats()
             sr_utilisation = stats['physical_utilisation']
             self.session.xenapi.SR.set_physical_utilisation(self.sr.sr_ref,
                     str(sr_utilisation))
@@ -22,6 +22,7 @@ import util
 import xmlrpclib
 import errno
 import subprocess
+import threading
 import syslog as _syslog
 import glob
 import xs_errors
@@ -555,10 +556,187 @@ class Blktap(ClassDevice):
             raise TapdiskNotRunning(minor=self.minor)
         return tapdisk
 
+class TapdiskRegistry(object):
+    """The tapdisks of this host, as listed by a single tap-ctl list and
+    indexed by minor, pid and path.
+
+    Every tap-ctl list queries each tapdisk in turn, so one operation
+    should enumerate only once. The listing is reused until invalidate(),
+    which Tapdisk calls after it changes a tapdisk: for all of it after a
+    launch, and only for the entry of the tapdisk after a shutdown, pause
+    or unpause, so that pausing many tapdisks does not list them all
+    again for each one. Other processes start and stop tapdisks too: a
+    hit is checked against the task pid of its blktap in sysfs, a miss
+    lists the tapdisks again (unless sysfs shows no task for the minor
+    looked up), and the listing is dropped after MAX_AGE seconds. Callers
+    about to act on a lookup after waiting for a lock should invalidate()
+    first."""
+
+    MAX_AGE = 5
+
+    def __init__(self):
+        self._lock      = threading.RLock()
+        self._time      = None
+        self._all       = []
+        self._by_minor  = {}
+        self._by_pid    = {}
+        self._by_path   = {}
+        self._dropped   = {}
+
+    def invalidate(self, minor = None):
+        """Drop the listing, or only the entry of tapdisk 'minor'"""
+
+        self._lock.acquire()
+        try:
+            if minor is None:
+                self._time = None
+                return
+
+            minor = int(minor)
+            attrs = self._by_minor.pop(minor, None)
+            if attrs:
+                self._all.remove(attrs)
+                self._by_pid[attrs['pid']].remove(attrs)
+                self._by_path[attrs['path']].remove(attrs)
+            else:
+                attrs = { 'minor' : minor, 'pid' : None, 'path' : None }
+            self._dropped[minor] = attrs
+        finally:
+            self._lock.release()
+
+    def _stale(self, minor, pid, path):
+        if self._time is None or \
+                not (0 <= time.time() - self._time < self.MAX_AGE):
+            return True
+
+        if not self._dropped:
+            return False
+
+        if (minor, pid, path) == (None, None, None):
+            return True
+
+        for attrs in self._dropped.itervalues():
+            if minor is not None and attrs['minor'] == minor or \
+                    pid is not None and attrs['pid'] == pid or \
+                    path is not None and attrs['path'] == path:
+                return True
+
+        return False
+
+    def _load(self):
+        _all, by_minor, by_pid, by_path = [], {}, {}, {}
+
+        for row in TapCtl.list():
+
+            attrs = { 'pid'     : None,
+                      'minor'   : None,
+                      'state'   : None,
+                      '_type'   : None,
+                      'path'    : None }
+
+            for key, val in row.iteritems():
+                if key in attrs:
+                    attrs[key] = val
+
+            if 'args' in row:
+                image = Tapdisk.Arg.parse(row['args'])
+                attrs['_type'] = image.type
+                attrs['path']  = image.path
+
+            if None in attrs.values():
+                continue
+
+            _all.append(attrs)
+            by_minor[attrs['minor']] = attrs
+            by_pid.setdefault(attrs['pid'], []).append(attrs)
+            by_path.setdefault(attrs['path'], []).append(attrs)
+
+        self._all      = _all
+        self._by_minor = by_minor
+        self._by_pid   = by_pid
+        self._by_path  = by_path
+        self._dropped  = {}
+        self._time     = time.time()
+
+    def _select(self, minor, pid, _type, path):
+        if minor is not None:
+            attrs = self._by_minor.get(minor)
+            found = attrs and [ attrs ] or []
+        elif path is not None:
+            found = self._by_path.get(path, [])
+        elif pid is not None:
+            found = self._by_pid.get(pid, [])
+        else:
+            found = self._all
+
+        return [ attrs for attrs in found
+                 if (pid is None or attrs['pid'] == pid) and
+                 (_type is None or attrs['_type'] == _type) and
+                 (path is None or attrs['path'] == path) ]
+
+    @staticmethod
+    def _has_task(minor):
+        try:
+            return Blktap(minor).get_task_pid() is not None
+        except Attribute.NoSuchAttribute:
+            return False
+
+    @staticmethod
+    def _is_current(attrs):
+        try:
+            return Blktap(attrs['minor']).get_task_pid() == attrs['pid']
+        except Attribute.NoSuchAttribute:
+            return False
+
+    def lookup(self, minor = None, pid = None, _type = None, path = None):
+        """Attributes of the tapdisks matching all of the given keys"""
+
+        if minor is not None: minor = int(minor)
+        if pid is not None: pid = int(pid)
+
+        # NB. concurrent lookups wait for a single enumeration
+        self._lock.acquire()
+        try:
+            if self._stale(minor, pid, path):
+                self._load()
+                return self._select(minor, pid, _type, path)
+
+            found = self._select(minor, pid, _type, path)
+            if (minor, pid, path) == (None, None, None):
+                return found
+
+            if not found:
+                # NB. another process may have started it since we listed
+                if minor is not None and not self._has_task(minor):
+                    return found
+                self._load()
+                return self._select(minor, pid, _type, path)
+
+            for attrs in found:
+                if not self._is_current(attrs):
+                    self._load()
+                    return self._select(minor, pid, _type, path)
+
+            return found
+        finally:
+            self._lock.release()
+
+    def get_pids(self):
+        """Pids of all tapdisk processes"""
+        self._lock.acquire()
+        try:
+            if self._stale(None, None, None):
+                self._load()
+            return self._by_pid.keys()
+        finally:
+            self._lock.release()
+
 class Tapdisk(object):
 
     TYPES = [ 'aio', 'vhd' ]
 
+    registry = TapdiskRegistry()
+
     def __init__(self, pid, minor, _type, path, state):
         self.pid     = pid
         self.minor   = minor
@@ -576,27 +754,8 @@ class Tapdisk(object):
     @classmethod
     def list(cls, **args):
 
-        for row in TapCtl.list(**args):
-
-            args =  { 'pid'     : None,
-                      'minor'   : None,
-                      'state'   : None,
-                      '_type'   : None,
-                      'path'    : None }
-
-            for key, val in row.iteritems():
-                if key in args:
-                    args[key] = val
-
-            if 'args' in row:
-                image = Tapdisk.Arg.parse(row['args'])
-                args['_type'] = image.type
-                args['path']  = image.path
-
-            if None in args.values():
-                continue
-
-            yield Tapdisk(**args)
+        for attrs in cls.registry.lookup(**args):
+            yield Tapdisk(**attrs)
 
     @classmethod
     def find(cls, **args):
@@ -708,6 +867,7 @@ class Tapdisk(object):
 
         try:
             pid = TapCtl.spawn()
+            cls.registry.invalidate()
 
             try:
                 TapCtl.attach(pid, minor)
@@ -750,9 +910,12 @@ class Tapdisk(object):
 
     def shutdown(self, force = False):
 
-        TapCtl.close(self.pid, self.minor, force)
+        try:
+            TapCtl.close(self.pid, self.minor, force)
 
-        TapCtl.detach(self.pid, self.minor)
+            TapCtl.detach(self.pid, self.minor)
+        finally:
+            self.registry.invalidate(self.minor)
 
         self.get_blktap().free()
 
@@ -761,7 +924,10 @@ class Tapdisk(object):
         if not self.is_running():
             raise TapdiskInvalidState(self)
 
-        TapCtl.pause(self.pid, self.minor)
+        try:
+            TapCtl.pause(self.pid, self.minor)
+        finally:
+            self.registry.invalidate(self.minor)
 
         self._set_dirty()
 
@@ -774,10 +940,43 @@ class Tapdisk(object):
         if _type is None: _type = self.type
         if  path is None:  path = self.path
 
-        TapCtl.unpause(self.pid, self.minor, _type, path)
+        try:
+            TapCtl.unpause(self.pid, self.minor, _type, path)
+        finally:
+            self.registry.invalidate(self.minor)
 
         self._set_dirty()
 
+    @staticmethod
+    def tapdev_in_use(minor):
+        """Whether another tapdisk has tapdev 'minor' open, as the leaf
+        of a local cache does with its parent"""
+        # NB. look only at the open files of the tapdisks we know of,
+        # rather than at every process in /proc
+        try:
+            pids = Tapdisk.registry.get_pids()
+        except TapCtl.CommandFailure:
+            # err on the side of caution
+            util.logException("listing tapdisks")
+            return True
+
+        devname = "tapdev%d" % minor
+        for pid in pids:
+            fd_dir = "/proc/%d/fd" % pid
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError, e:
+                if e.errno == errno.ENOENT: continue # exited
+                return True
+            for fd in fds:
+                try:
+                    link = os.readlink(os.path.join(fd_dir, fd))
+                except OSError:
+                    continue
+                if os.path.basename(link) == devname:
+                    return True
+        return False
+
     def stats(self):
         import simplejson
         json = TapCtl.stats(self.pid, self.minor)
@@ -1227,6 +1426,78 @@ class VDI(object):
                 return False
         return True
 
+    @classmethod
+    def tap_pause_many(cls, session, sr_uuid, vdi_uuids):
+        """Pause VDIs vdi_uuids of SR sr_uuid with one tapdisk-pause call
+        per host they are attached to, all hosts at once. If any of them
+        fails, unpause them all again and return False"""
+        util.SMlog("Pause request for %s" % vdi_uuids)
+        vdi_refs = []
+        for vdi_uuid in vdi_uuids:
+            vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
+            session.xenapi.VDI.add_to_sm_config(vdi_ref, 'paused', 'true')
+            vdi_refs.append(vdi_ref)
+        by_host = cls._group_by_host(session, vdi_uuids, vdi_refs)
+        report = cls.call_pluginhandler_many(session, by_host, sr_uuid,
+                "pause_many")
+        failed = filter(lambda x: report.results.get(x) != "True",
+                by_host.keys())
+        if not failed:
+            return True
+
+        # a host that failed or timed out may still have paused some (or, if
+        # its call was merely slow, all) of its VDIs: the call has returned
+        # by now (see util.call_plugin_on_hosts), so unpause it as well
+        util.SMlog("Failed to pause on hosts %s" % failed)
+        cls.call_pluginhandler_many(session, by_host, sr_uuid, "unpause_many")
+        for vdi_ref in vdi_refs:
+            session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
+        return False
+
+    @classmethod
+    def tap_unpause_many(cls, session, sr_uuid, vdi_uuids):
+        """Unpause VDIs vdi_uuids of SR sr_uuid with one tapdisk-pause call
+        per host they are attached to, all hosts at once"""
+        util.SMlog("Unpause request for %s" % vdi_uuids)
+        vdi_refs = []
+        for vdi_uuid in vdi_uuids:
+            vdi_ref = session.xenapi.VDI.get_by_uuid(vdi_uuid)
+            session.xenapi.VDI.remove_from_sm_config(vdi_ref, 'paused')
+            vdi_refs.append(vdi_ref)
+        by_host = cls._group_by_host(session, vdi_uuids, vdi_refs)
+        report = cls.call_pluginhandler_many(session, by_host, sr_uuid,
+                "unpause_many")
+        for host_ref in by_host.iterkeys():
+            if report.results.get(host_ref) != "True":
+                # Failed to unpause node
+                return False
+        return True
+
+    @staticmethod
+    def _group_by_host(session, vdi_uuids, vdi_refs):
+        """Map each host to the VDIs (of vdi_uuids) attached to it"""
+        by_host = {}
+        for vdi_uuid, vdi_ref in zip(vdi_uuids, vdi_refs):
+            sm_config = session.xenapi.VDI.get_sm_config(vdi_ref)
+            for key in filter(lambda x: x.startswith('host_'),
+                    sm_config.keys()):
+                host_ref = key[len('host_'):]
+                by_host.setdefault(host_ref, []).append(vdi_uuid)
+        return by_host
+
+    @classmethod
+    def call_pluginhandler_many(cls, session, by_host, sr_uuid, action):
+        """Call tapdisk-pause 'action' on each host in by_host for the VDIs
+        it maps the host to, on all hosts at once"""
+        args = {}
+        for host_ref, vdi_uuids in by_host.iteritems():
+            util.SMlog("Calling tap-%s on host %s for %s" % \
+                    (action, host_ref, vdi_uuids))
+            args[host_ref] = {"sr_uuid": sr_uuid,
+                    "vdi_uuids": ",".join(vdi_uuids)}
+        return util.call_plugin_on_hosts(session, by_host.keys(),
+                PLUGIN_TAP_PAUSE, action, None, argsByHost = args)
+
     @classmethod
     def call_pluginhandler(cls, session, host_ref, sr_uuid, vdi_uuid, action):
         try:
@@ -1551,6 +1822,8 @@ class VDI(object):
         import EXTSR
         import NFSSR
         import XenAPI
+        import lcache
+        import prewarm
         from lock import Lock
         from FileSR import FileVDI
 
@@ -1567,18 +1840,34 @@ class VDI(object):
 
         SR.registerSR(EXTSR.EXTSR)
         local_sr = SR.SR.from_uuid(session, local_sr_uuid)
+        cache_sr = lcache.CacheFileSR(local_sr.path)
+
+        read_cache_path = "%s/%s.vhdcache" % (local_sr.path, shared_target.uuid)
+        if not util.pathexists(read_cache_path):
+            # NB. make room for the new read cache first. Not under our
+            # lock: eviction takes those of the other parents.
+            try:
+                sr_ref = session.xenapi.SR.get_by_uuid(local_sr_uuid)
+                other_config = session.xenapi.SR.get_other_config(sr_ref)
+                cache_sr.evict_with_config(other_config,
+                                           exclude = [parent_uuid])
+            except:
+                util.logException("evicting read caches")
 
         lock = Lock(self.LOCK_CACHE_SETUP, parent_uuid)
         lock.acquire()
+        # NB. the cache tapdisks may have come or gone while we waited
+        Tapdisk.registry.invalidate()
 
         # read cache
-        read_cache_path = "%s/%s.vhdcache" % (local_sr.path, shared_target.uuid)
+        read_cache_created = False
         if util.pathexists(read_cache_path):
             util.SMlog("Read cache node (%s) already exists, not creating" % \
                     read_cache_path)
         else:
             try:
                 vhdutil.snapshot(read_cache_path, shared_target.path, False)
+                read_cache_created = True
             except util.CommandException, e:
                 util.SMlog("Error creating parent cache: %s" % e)
                 self.alert_no_cache(session, vdi_uuid, local_sr_uuid, e.code)
@@ -1622,6 +1911,16 @@ class VDI(object):
                 blktap.free()
                 raise
 
+        cache_sr.get_last_use().update([parent_uuid])
+
+        if read_cache_created:
+            # NB. fill the new read cache in the background, rather than
+            # only as the guests miss
+            try:
+                prewarm.start(read_cache_path)
+            except:
+                util.logException("starting the read cache pre-warm")
+
         secondary = "%s:%s" % (self.target.get_vdi_type(),
                 self.PhyLink.from_uuid(sr_uuid, vdi_uuid).readlink())
 
@@ -1670,21 +1969,15 @@ class VDI(object):
         session.xenapi.session.logout()
 
     def _is_tapdisk_in_use(self, minor):
-        (retVal, links) = util.findRunningProcessOrOpenFile("tapdisk2")
-        if not retVal:
-            # err on the side of caution
-            return True
-        
-        for link in links:
-            if link.find("tapdev%d" % minor) != -1:
-                return True
-        return False
+        return Tapdisk.tapdev_in_use(minor)
 
     def _remove_cache(self, session, local_sr_uuid):
         import SR
         import EXTSR
         import NFSSR
         import XenAPI
+        import lcache
+        import prewarm
         from lock import Lock
         from FileSR import FileVDI
 
@@ -1705,6 +1998,8 @@ class VDI(object):
 
         lock = Lock(self.LOCK_CACHE_SETUP, parent_uuid)
         lock.acquire()
+        # NB. the cache tapdisks may have come or gone while we waited
+        Tapdisk.registry.invalidate()
 
         # local write node
         local_leaf_path = "%s/%s.vhdcache" % \
@@ -1721,15 +2016,20 @@ class VDI(object):
         elif not self._is_tapdisk_in_use(prt_tapdisk.minor):
             util.SMlog("Parent tapdisk not in use: shutting down %s" % \
                     read_cache_path)
+            prewarm_lock = prewarm.stop(read_cache_path)
             try:
-                prt_tapdisk.shutdown()
-            except:
-                util.logException("shutting down parent tapdisk")
+                try:
+                    prt_tapdisk.shutdown()
+                except:
+                    util.logException("shutting down parent tapdisk")
+            finally:
+                prewarm_lock.release()
         else:
             util.SMlog("Parent tapdisk still in use: %s" % read_cache_path)
 
-        # the parent cache files are removed during the local SR's background 
-        # GC run
+        # the parent cache files are evicted during the local SR's background
+        # GC run, least recently used first
+        lcache.CacheFileSR(local_sr.path).get_last_use().update([parent_uuid])
 
         lock.release()
 
@@ -25,20 +25,29 @@ import exceptions
 import traceback
 import base64
 import zlib
+import socket
+import select
+import fcntl
+import threading
+import cPickle
 
 import XenAPI
 import util
 import lvutil
 import vhdutil
+import vhdbitmap
 import lvhdutil
 import lvmcache
+import lvmshell
 import journaler
 import fjournaler
 import lock
 import blktap2
+import tapstats
 from refcounter import RefCounter
 from ipc import IPCFlag
 from lvmanager import LVActivator
+from vgledger import VGLedger
 import blktap2
 from srmetadata import LVMMetadataHandler
 
@@ -50,18 +59,42 @@ from srmetadata import LVMMetadataHandler
 AUTO_ONLINE_LEAF_COALESCE_ENABLED = True
 
 LOG_FILE = "/var/log/SMlog"
+CLEANUP_SCRIPT = "/opt/xensource/sm/cleanup.py"
 FLAG_TYPE_ABORT = "abort"     # flag to request aborting of GC/coalesce
+FLAG_TYPE_RESCAN = "rescan"   # SR changed outside of GC, do a full rescan
+# namespace prefix for FLAG_TYPE_RESCAN: it can't live in the SR namespace
+# because runAbortable clears all flags there
+NS_PREFIX_SCAN = "scan-"
+NS_PREFIX_COALESCE = "coalesce-" # result flags of concurrent VHD coalesces
 
 # process "lock", used simply as an indicator that a process already exists 
 # that is doing GC/coalesce on this SR (such a process holds the lock, and we 
 # check for the fact by trying the lock). 
 LOCK_TYPE_RUNNING = "running" 
-lockRunning = None
+locksRunning = {} # SR UUID -> lock (the GC service handles several SRs)
+forker = None     # ForkHelper of the GC service (see Util.fork)
 
 
 class AbortException(util.SMException):
     pass
 
+def _abortableChild(func, args, ret, ns):
+    "The body of the processes started by Util.startAbortable()"
+    os.setpgrp()
+    resultFlag = IPCFlag(ns)
+    try:
+        if func(*args) == ret:
+            resultFlag.set("success")
+        else:
+            resultFlag.set("failure")
+    except:
+        resultFlag.set("failure")
+    os._exit(0)
+
+def _runCommand(cmd):
+    Util.doexec(cmd, 0)
+    return True
+
 ################################################################################
 #
 #  Util
@@ -126,43 +159,102 @@ class Util:
         return stdout
     doexec = staticmethod(doexec)
 
-    def runAbortable(func, ret, ns, abortTest, pollInterval, timeOut):
-        """execute func in a separate thread and kill it if abortTest signals
-        so"""
+    def runAbortable(func, ret, ns, abortTest, pollInterval, timeOut,
+            throttle = None, task = None, args = ()):
+        """execute func(*args) in a separate process and kill it if abortTest
+        signals so. If a CoalesceThrottle is passed, the process is throttled
+        by it; if a GCProgress.Task is passed, the progress of the process is
+        tracked in it"""
         abortSignaled = abortTest() # check now before we clear resultFlag
-        resultFlag = IPCFlag(ns)
-        resultFlag.clearAll()
-        pid = os.fork()
-        if pid:
-            startTime = time.time()
+        pid = Util.startAbortable(func, ret, ns, args)
+        startTime = time.time()
+        if throttle:
+            throttle.add(pid, "child %d" % pid)
+        if task:
+            task.start(pid)
+        try:
             while True:
-                if resultFlag.test("success"):
+                if Util.checkAbortable(pid, ns):
                     Util.log("  Child process completed successfully")
-                    resultFlag.clear("success")
                     return
-                if resultFlag.test("failure"):
-                    resultFlag.clear("failure")
-                    raise util.SMException("Child process exited with error")
                 if abortTest() or abortSignaled:
-                    os.killpg(pid, signal.SIGKILL)
+                    Util.killAbortable(pid, ns)
                     raise AbortException("Aborting due to signal")
                 if timeOut and time.time() - startTime > timeOut:
-                    os.killpg(pid, signal.SIGKILL)
-                    resultFlag.clearAll()
+                    Util.killAbortable(pid, ns)
                     raise util.SMException("Timed out")
+                if throttle:
+                    throttle.update()
+                if task:
+                    task.update()
                 time.sleep(pollInterval)
-        else:
-            os.setpgrp()
-            try:
-                if func() == ret:
-                    resultFlag.set("success")
-                else:
-                    resultFlag.set("failure")
-            except:
-                resultFlag.set("failure")
-            os._exit(0)
+        finally:
+            if throttle:
+                throttle.remove(pid)
     runAbortable = staticmethod(runAbortable)
 
+    def startAbortable(func, ret, ns, args = ()):
+        """execute func(*args) in a separate process without waiting for it
+        to complete. Return the PID of the process, to be passed to 
+        checkAbortable() and killAbortable(). func and args must be picklable
+        (see Util.fork)"""
+        IPCFlag(ns).clearAll()
+        return Util.fork(_abortableChild, (func, args, ret, ns))
+    startAbortable = staticmethod(startAbortable)
+
+    def fork(func, args):
+        """Run func(*args) (which must not return) in a new process. Return
+        the PID of the process. In the GC service, the fork is done by the 
+        service's ForkHelper, so func must be a module-level function and 
+        args picklable"""
+        if forker:
+            return forker.fork(func, args)
+        pid = os.fork()
+        if not pid:
+            try:
+                lvmshell.afterFork()
+                func(*args)
+            finally:
+                os._exit(1)
+        return pid
+    fork = staticmethod(fork)
+
+    def reap(pid):
+        """Wait for the process started with fork() to exit. The children of
+        the ForkHelper are reaped by the helper: just wait for them to go"""
+        if not forker:
+            os.waitpid(pid, 0)
+            return
+        while True:
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                return
+            time.sleep(ForkHelper.REAP_INTERVAL / 10.0)
+    reap = staticmethod(reap)
+
+    def checkAbortable(pid, ns):
+        """Return True if the process started with startAbortable() completed
+        successfully, False if it is still running. Raise an exception if it
+        failed"""
+        resultFlag = IPCFlag(ns)
+        if resultFlag.test("success"):
+            resultFlag.clear("success")
+            Util.reap(pid)
+            return True
+        if resultFlag.test("failure"):
+            resultFlag.clear("failure")
+            Util.reap(pid)
+            raise util.SMException("Child process exited with error")
+        return False
+    checkAbortable = staticmethod(checkAbortable)
+
+    def killAbortable(pid, ns):
+        os.killpg(pid, signal.SIGKILL)
+        Util.reap(pid)
+        IPCFlag(ns).clearAll()
+    killAbortable = staticmethod(killAbortable)
+
     def num2str(number):
         for prefix in ("G", "M", "K"):
             if number >= Util.PREFIX[prefix]:
@@ -171,36 +263,44 @@ class Util:
     num2str = staticmethod(num2str)
 
     def numBits(val):
-        count = 0
-        while val:
-            count += val & 1
-            val = val >> 1
-        return count
+        return vhdbitmap.popcount(val)
     numBits = staticmethod(numBits)
 
     def countBits(bitmap1, bitmap2):
         """return bit count in the bitmap produced by ORing the two bitmaps"""
-        len1 = len(bitmap1)
-        len2 = len(bitmap2)
-        lenLong = len1
-        lenShort = len2
-        bitmapLong = bitmap1
-        if len2 > len1:
-            lenLong = len2
-            lenShort = len1
-            bitmapLong = bitmap2
-
-        count = 0
-        for i in range(lenShort):
-            val = ord(bitmap1[i]) | ord(bitmap2[i])
-            count += Util.numBits(val)
-
-        for i in range(i + 1, lenLong):
-            val = ord(bitmapLong[i])
-            count += Util.numBits(val)
-        return count
+        return vhdbitmap.countBits(bitmap1, bitmap2)
     countBits = staticmethod(countBits)
 
+    def getGroupIO(pgid):
+        """Return {pid: {counter: value}} with the /proc/<pid>/io counters of
+        all the processes in process group pgid"""
+        result = {}
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                f = open("/proc/%s/stat" % pid)
+                try:
+                    stat = f.read()
+                finally:
+                    f.close()
+                # the command name may contain spaces: skip past it
+                if int(stat[stat.rfind(")") + 2:].split()[2]) != pgid:
+                    continue
+                io = {}
+                f = open("/proc/%s/io" % pid)
+                try:
+                    for line in f.readlines():
+                        key, val = line.split(":")
+                        io[key] = long(val)
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                continue # exited meanwhile
+            result[pid] = io
+        return result
+    getGroupIO = staticmethod(getGroupIO)
+
     def getThisScript():
         thisScript = util.get_real_path(__file__)
         if thisScript.endswith(".pyc"):
@@ -352,6 +452,14 @@ class XAPI:
     def isSnapshot(self, vdi):
         return self.session.xenapi.VDI.get_is_a_snapshot(vdi.getRef())
 
+    def setConfigSR(self, key, val):
+        "Set key in the SR other-config"
+        try:
+            self.session.xenapi.SR.remove_from_other_config(self._srRef, key)
+        except XenAPI.Failure:
+            pass
+        self.session.xenapi.SR.add_to_other_config(self._srRef, key, val)
+
     def markCacheSRsDirty(self):
         sr_refs = self.session.xenapi.SR.get_all_records_where( \
                 'field "local_cache_enabled" = "true"')
@@ -559,6 +667,10 @@ class VDI:
     def getSizeVHD(self):
         return self._sizeVHD
 
+    def getSizePhys(self):
+        "Space taken up by the VDI in the SR"
+        return self.getSizeVHD()
+
     def getTreeRoot(self):
         "Get the root of the tree that self belongs to"
         root = self
@@ -646,34 +758,49 @@ class VDI:
         VHD, but not the subsequent relinking. We'll do that as the next step,
         after reloading the entire SR in case things have changed while we
         were coalescing"""
+        task = self.sr.startCoalesceTask(self)
+        try:
+            self._prepareCoalesce()
+            try:
+                self._coalesceVHD(0, self.sr.getCoalesceThrottle(), task)
+                self._checkCoalesced()
+            finally:
+                self._cleanupCoalesce()
+        finally:
+            task.finish()
+
+    def _prepareCoalesce(self):
+        """Get the parent ready for having self coalesced onto it"""
         self.validate()
         self.parent.validate()
         self.parent._increaseSizeVirt(self.sizeVirt)
         self.sr._updateSlavesOnResize(self.parent)
-        self._coalesceVHD(0)
+
+    def _checkCoalesced(self):
         self.parent.validate()
         #self._verifyContents(0)
         self.parent.updateBlockInfo()
 
+    def _cleanupCoalesce(self):
+        """Undo any temporary changes made by _prepareCoalesce(). Called
+        whether or not the coalesce succeeded"""
+        pass
+
     def _verifyContents(self, timeOut):
         Util.log("  Coalesce verification on %s" % self)
         abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
-        Util.runAbortable(lambda: self._runTapdiskDiff(), True,
-                self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut)
-        Util.log("  Coalesce verification succeeded")
-
-    def _runTapdiskDiff(self):
         cmd = "tapdisk-diff -n %s:%s -m %s:%s" % \
                 (self.getDriverName(), self.path, \
                 self.parent.getDriverName(), self.parent.path)
-        Util.doexec(cmd, 0)
-        return True
+        Util.runAbortable(_runCommand, True, self.sr.uuid, abortTest,
+                VDI.POLL_INTERVAL, timeOut, args = (cmd,))
+        Util.log("  Coalesce verification succeeded")
 
-    def _coalesceVHD(self, timeOut):
+    def _coalesceVHD(self, timeOut, throttle = None, task = None):
         Util.log("  Running VHD coalesce on %s" % self)
         abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
-        Util.runAbortable(lambda: vhdutil.coalesce(self.path), None,
-                self.sr.uuid, abortTest, VDI.POLL_INTERVAL, timeOut)
+        Util.runAbortable(vhdutil.coalesce, None, self.sr.uuid, abortTest,
+                VDI.POLL_INTERVAL, timeOut, throttle, task, (self.path,))
         util.fistpoint.activate("LVHDRT_coalescing_VHD_data",self.sr.uuid)
 
     def _relinkSkip(self):
@@ -782,19 +909,23 @@ class VDI:
         parent. We calculate the actual size by using the VHD block allocation
         information (as opposed to just adding up the two VHD sizes to get an
         upper bound)"""
-        # make sure we don't use stale BAT info from vdi_rec since the child 
-        # was writable all this time
-        self.delConfig(VDI.DB_VHD_BLOCKS)
-        blocksChild = self.getVHDBlocks()
-        blocksParent = self.parent.getVHDBlocks()
-        numBlocks = Util.countBits(blocksChild, blocksParent)
+        bitmaps = self.sr.getCoalesceBitmaps([self])
+        counts = vhdbitmap.getCoalescedCounts({self.uuid: self.parent.uuid},
+                bitmaps)
+        return self._getSizeData(counts[self.uuid])
+
+    def _getSizeData(self, numBlocks):
+        "The data size of the coalesced VHD, given its number of blocks"
         Util.log("Num combined blocks = %d" % numBlocks)
         sizeData = numBlocks * vhdutil.VHD_BLOCK_SIZE
         assert(sizeData <= self.sizeVirt)
         return sizeData
 
-    def _calcExtraSpaceForCoalescing(self):
-        sizeData = self._getCoalescedSizeData()
+    def _calcExtraSpaceForCoalescing(self, sizeData = None):
+        """sizeData: the result of _getCoalescedSizeData() if the caller 
+        already has it"""
+        if sizeData is None:
+            sizeData = self._getCoalescedSizeData()
         sizeCoalesced = sizeData + vhdutil.calcOverheadBitmap(sizeData) + \
                 vhdutil.calcOverheadEmpty(self.sizeVirt)
         Util.log("Coalesced size = %s" % Util.num2str(sizeCoalesced))
@@ -948,8 +1079,14 @@ class LVHDVDI(VDI):
             return
         inc = self._calcExtraSpaceForCoalescing()
         if inc > 0:
-            util.fistpoint.activate("LVHDRT_coalescing_before_inflate_grandparent",self.sr.uuid)
-            self.parent.inflate(self.parent.sizeLV + inc)
+            # claim the space first so that an SM operation can't take it
+            # between our free space check and the inflate
+            resId = self.sr.ledger.reserve(inc, "coalesce-%s" % self.uuid)
+            try:
+                util.fistpoint.activate("LVHDRT_coalescing_before_inflate_grandparent",self.sr.uuid)
+                self.parent.inflate(self.parent.sizeLV + inc)
+            finally:
+                self.sr.ledger.release(resId)
 
     def updateBlockInfo(self):
         if not self.raw:
@@ -992,6 +1129,9 @@ class LVHDVDI(VDI):
             self._loadInfoSizeVHD()
         return self._sizeVHD
 
+    def getSizePhys(self):
+        return self.sizeLV
+
     def _loadInfoSizeVHD(self):
         """Get the physical utilization of the VHD file. We do it individually
         (and not using the VHD batch scanner) as an optimization: this info is
@@ -1041,18 +1181,22 @@ class LVHDVDI(VDI):
         if not self.raw:
             VDI.validate(self)
 
-    def _doCoalesce(self):
+    def _prepareCoalesce(self):
         """LVHD parents must first be activated, inflated, and made writable"""
         try:
             self._activateChain()
             self.sr.lvmCache.setReadonly(self.parent.fileName, False)
             self.parent.validate()
             self.inflateParentForCoalesce()
-            VDI._doCoalesce(self)
-        finally:
-            self.parent._loadInfoSizeVHD()
-            self.parent.deflate()
-            self.sr.lvmCache.setReadonly(self.parent.fileName, True)
+            VDI._prepareCoalesce(self)
+        except:
+            self._cleanupCoalesce()
+            raise
+
+    def _cleanupCoalesce(self):
+        self.parent._loadInfoSizeVHD()
+        self.parent.deflate()
+        self.sr.lvmCache.setReadonly(self.parent.fileName, True)
 
     def _setParent(self, parent):
         self._activate()
@@ -1119,9 +1263,8 @@ class LVHDVDI(VDI):
                     str(offset))
         Util.log("  Zeroing %s: from %d, %dB" % (self.path, offset, length))
         abortTest = lambda:IPCFlag(self.sr.uuid).test(FLAG_TYPE_ABORT)
-        func = lambda: util.zeroOut(self.path, offset, length)
-        Util.runAbortable(func, True, self.sr.uuid, abortTest,
-                VDI.POLL_INTERVAL, 0)
+        Util.runAbortable(util.zeroOut, True, self.sr.uuid, abortTest,
+                VDI.POLL_INTERVAL, 0, args = (self.path, offset, length))
         self.sr.journaler.remove(self.JRN_ZERO, self.uuid)
 
     def _setSizeVirt(self, size):
@@ -1141,10 +1284,12 @@ class LVHDVDI(VDI):
         self._activate()
         return VDI._queryVHDBlocks(self)
 
-    def _calcExtraSpaceForCoalescing(self):
+    def _calcExtraSpaceForCoalescing(self, sizeData = None):
         if self.parent.raw:
             return 0 # raw parents are never deflated in the first place
-        sizeCoalesced = lvhdutil.calcSizeVHDLV(self._getCoalescedSizeData())
+        if sizeData is None:
+            sizeData = self._getCoalescedSizeData()
+        sizeCoalesced = lvhdutil.calcSizeVHDLV(sizeData)
         Util.log("Coalesced size = %s" % Util.num2str(sizeCoalesced))
         return sizeCoalesced - self.parent.sizeLV
 
@@ -1161,6 +1306,745 @@ class LVHDVDI(VDI):
 
 
 
+################################################################################
+#
+#  Coalesce scheduling
+#
+class CoalesceScheduler:
+    """Rank coalesce candidates according to a cost model: the amount of data 
+    that has to be copied (from the block bitmaps), the space that will be 
+    reclaimed, how close the VHD chain is to vhdutil.MAX_CHAIN_SIZE, and how 
+    many times coalescing the VDI has failed recently. 
+    
+    The costs of the candidates (which are expensive to compute) and the 
+    failure history are kept on disk, so that a GC process started after an 
+    abort or a restart can reuse the costs of all candidates that have not 
+    changed since"""
+
+    BASE_DIR = "/var/run/sm/gc"
+    FILE_EXT = ".queue"
+
+    # fixed overhead of any coalesce operation, in terms of bytes copied
+    COST_FIXED = 64 * 1024 * 1024
+
+    # chains this long are coalesced before anything else to prevent 
+    # snapshots from failing (SnapshotChainTooLong)
+    CHAIN_URGENT = vhdutil.MAX_CHAIN_SIZE * 3 / 4
+    URGENT_FACTOR = 100
+
+    FAILURE_EXPIRY = 24 * 60 * 60 # seconds
+
+    # candidates costed at a time
+    COST_BATCH = 4
+
+    def __init__(self, srUuid):
+        self.path = os.path.join(self.BASE_DIR, srUuid + self.FILE_EXT)
+        # uuid -> (parentUuid, sizeChild, sizeParent, spaceNeeded, sizeCopy)
+        self.costs = {}
+        # uuid -> (numFailures, timeOfLastFailure)
+        self.failures = {}
+        self._load()
+
+    def rank(self, candidates):
+        """Generate (vdi, spaceNeeded) for the coalesce candidates, best first.
+        The candidates whose cost is not known from the last run are ordered 
+        by a pessimistic estimate from their physical size (all of it copied,
+        nothing freed) and are only costed, COST_BATCH at a time, when the 
+        caller gets to them, so that it can stop at the first ones that fit"""
+        costs = {}
+        for vdi in candidates:
+            cost = self._getCachedCost(vdi)
+            if cost:
+                costs[vdi.uuid] = cost
+        self.costs = costs
+        remaining = candidates[:]
+        self._sortByScore(remaining)
+        while remaining:
+            vdi = remaining.pop(0)
+            if not self.costs.has_key(vdi.uuid):
+                batch = [vdi]
+                for other in remaining:
+                    if len(batch) >= self.COST_BATCH:
+                        break
+                    if not self.costs.has_key(other.uuid):
+                        batch.append(other)
+                self.costs.update(self._computeCosts(batch))
+                self._save()
+                self._sortByScore(remaining)
+                if remaining and \
+                        self._getScore(vdi) < self._getScore(remaining[0]):
+                    # the estimate was off, let the next one go first
+                    remaining.append(vdi)
+                    self._sortByScore(remaining)
+                    continue
+            (parentUuid, sizeChild, sizeParent, spaceNeeded, sizeCopy) = \
+                    self.costs[vdi.uuid]
+            Util.log("  Coalesce score of %s: %.3f (copy %s, free %s)" % \
+                    (vdi, self._getScore(vdi), Util.num2str(sizeCopy), 
+                    Util.num2str(max(sizeChild - spaceNeeded, 0))))
+            yield (vdi, spaceNeeded)
+
+    def rankLeaves(self, candidates):
+        """Return the leaf-coalesce candidates, best first: the least data to
+        copy (which also gives live leaf-coalesce the best chance of success)
+        and the longest chains"""
+        ranked = []
+        for vdi in candidates:
+            score = self._getUrgency(vdi) * self._getPenalty(vdi.uuid) / \
+                    (max(vdi.getSizeVHD(), 0) + self.COST_FIXED)
+            ranked.append((score, vdi))
+        ranked.sort(lambda a, b: cmp(b[0], a[0]))
+        return map(lambda x: x[1], ranked)
+
+    def getSizeCopy(self, uuid):
+        """The amount of data to be copied when coalescing VDI uuid, as of 
+        the last ranking (0 if unknown)"""
+        cost = self.costs.get(uuid)
+        if not cost:
+            return 0
+        return cost[4]
+
+    def recordFailure(self, uuid):
+        (num, t) = self.failures.get(uuid, (0, 0))
+        self.failures[uuid] = (num + 1, int(time.time()))
+        self._save()
+
+    def _getScore(self, vdi):
+        """The amount of space freed per amount of data copied, adjusted for 
+        the chain length and past failures"""
+        cost = self.costs.get(vdi.uuid)
+        if cost:
+            (parentUuid, sizeChild, sizeParent, spaceNeeded, sizeCopy) = cost
+        else:
+            sizeChild = vdi.getSizePhys()
+            spaceNeeded = sizeCopy = sizeChild
+        sizeFreed = max(sizeChild - spaceNeeded, 0)
+        score = float(sizeFreed + self.COST_FIXED) / \
+                (sizeCopy + self.COST_FIXED)
+        return score * self._getUrgency(vdi) * self._getPenalty(vdi.uuid)
+
+    def _sortByScore(self, vdis):
+        scores = {}
+        for vdi in vdis:
+            scores[vdi.uuid] = self._getScore(vdi)
+        vdis.sort(lambda a, b: cmp(scores[b.uuid], scores[a.uuid]))
+
+    def _getCachedCost(self, vdi):
+        """The cost entry for coalescing vdi from the last ranking, if neither
+        VHD has changed since (None otherwise)"""
+        cost = self.costs.get(vdi.uuid)
+        if cost and cost[0:3] == (vdi.parent.uuid, vdi.getSizePhys(),
+                vdi.parent.getSizePhys()):
+            return cost
+        return None
+
+    def _computeCosts(self, vdis):
+        """Cost entries for coalescing vdis, by uuid. The block bitmaps are 
+        fetched once for the whole batch and both the coalesced size and the 
+        amount of data to copy come from them"""
+        bitmaps = vdis[0].sr.getCoalesceBitmaps(vdis)
+        parents = {}
+        for vdi in vdis:
+            parents[vdi.uuid] = vdi.parent.uuid
+        counts = vhdbitmap.getCoalescedCounts(parents, bitmaps)
+        costs = {}
+        for vdi in vdis:
+            sizeData = None
+            if counts.has_key(vdi.uuid):
+                sizeData = vdi._getSizeData(counts[vdi.uuid])
+            spaceNeeded = vdi._calcExtraSpaceForCoalescing(sizeData)
+            sizeCopy = bitmaps[vdi.uuid].count() * vhdutil.VHD_BLOCK_SIZE
+            costs[vdi.uuid] = (vdi.parent.uuid, vdi.getSizePhys(),
+                    vdi.parent.getSizePhys(), spaceNeeded, sizeCopy)
+        return costs
+
+    def _getUrgency(self, vdi):
+        "Favour the VDIs in the longest VHD chains"
+        depth = 0
+        parent = vdi.parent
+        while parent:
+            depth += 1
+            parent = parent.parent
+        chainLen = depth + vdi.getTreeHeight()
+        if chainLen >= self.CHAIN_URGENT:
+            return float(self.URGENT_FACTOR)
+        return 1.0 + float(chainLen) / vhdutil.MAX_CHAIN_SIZE
+
+    def _getPenalty(self, uuid):
+        "Halve the score for every recent failure"
+        (num, t) = self.failures.get(uuid, (0, 0))
+        if time.time() - t > self.FAILURE_EXPIRY:
+            return 1.0
+        return 1.0 / (2 ** num)
+
+    def _load(self):
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return
+        try:
+            try:
+                for line in f.readlines():
+                    fields = line.split()
+                    if not fields:
+                        continue
+                    if fields[0] == "C" and len(fields) == 7:
+                        self.costs[fields[1]] = (fields[2],) + \
+                                tuple(map(long, fields[3:7]))
+                    elif fields[0] == "F" and len(fields) == 4:
+                        self.failures[fields[1]] = \
+                                (int(fields[2]), int(fields[3]))
+            except ValueError:
+                Util.log("Ignoring corrupt coalesce queue %s" % self.path)
+                self.costs = {}
+                self.failures = {}
+        finally:
+            f.close()
+
+    def _save(self):
+        "Write out the costs and the failures"
+        lines = []
+        for uuid, cost in self.costs.items():
+            lines.append("C %s %s %d %d %d %d\n" % ((uuid,) + cost))
+        now = time.time()
+        for uuid, (num, t) in self.failures.items():
+            if now - t > self.FAILURE_EXPIRY:
+                del self.failures[uuid]
+                continue
+            lines.append("F %s %d %d\n" % (uuid, num, t))
+        try:
+            if not util.pathexists(self.BASE_DIR):
+                os.makedirs(self.BASE_DIR)
+            tmpPath = self.path + ".tmp"
+            f = open(tmpPath, 'w')
+            try:
+                f.writelines(lines)
+            finally:
+                f.close()
+            os.rename(tmpPath, self.path)
+        except (IOError, OSError), e:
+            Util.log("Failed to save the coalesce queue: %s" % e)
+
+class CoalesceThrottle:
+    """Keep the VHD coalesce processes of an SR within the I/O budget set in 
+    the SR other-config (bytes/s and I/O operations/s), by stopping and 
+    continuing them as needed. Independently of the budget, if a latency 
+    limit is set, back off while the average latency of the guest I/O to the
+    SR (as seen on the tapdevs of the SR's tapdisks) is above it, and speed 
+    up again once it drops. Without any of these settings the coalesce 
+    processes are left alone"""
+
+    DB_MAX_BANDWIDTH = "coalesce-max-bandwidth" # bytes per second
+    DB_MAX_IOPS = "coalesce-max-iops"
+    DB_MAX_LATENCY = "coalesce-max-latency"     # ms, unset or 0 to disable
+
+    LATENCY_SAMPLE_INTERVAL = 5 # seconds
+    MIN_FACTOR = 1.0 / 32       # never back off below this share of the budget
+    BURST = 1                   # seconds of unused budget that may accumulate
+
+    SYSFS_BLOCK = "/sys/block"
+
+    def __init__(self, srPath, otherConfig):
+        self.srPath = srPath
+        self.maxBandwidth = self._getConfig(otherConfig, self.DB_MAX_BANDWIDTH,
+                0)
+        self.maxIOPS = self._getConfig(otherConfig, self.DB_MAX_IOPS, 0)
+        self.maxLatency = self._getConfig(otherConfig, self.DB_MAX_LATENCY, 0)
+        self.factor = 1.0
+        self.peakBandwidth = 0
+        self.peakIOPS = 0
+        self.stopped = False
+        # process group -> [name, startTime, bytes, ops, {pid: (bytes, ops)}]
+        self.groups = {}
+        self.lastUpdate = time.time()
+        self.creditBytes = 0
+        self.creditOps = 0
+        self.lastSample = self.lastUpdate
+        self.sampleBytes = 0
+        self.sampleOps = 0
+        self.sampleStopped = False
+        self.latencyCounters = self._getLatencyCounters()
+
+    def isActive(self):
+        return self.maxBandwidth or self.maxIOPS or self.maxLatency
+
+    def add(self, pgid, name):
+        "Start throttling the process group pgid"
+        self.groups[pgid] = [name, time.time(), 0, 0, {}]
+        if self.stopped:
+            self._signal(pgid, signal.SIGSTOP)
+
+    def remove(self, pgid):
+        "Stop throttling the process group pgid and log the throughput it got"
+        group = self.groups.get(pgid)
+        if not group:
+            return
+        del self.groups[pgid]
+        if self.stopped:
+            self._signal(pgid, signal.SIGCONT)
+        (name, startTime, numBytes, numOps, counters) = group
+        elapsed = max(time.time() - startTime, 1)
+        Util.log("  I/O by %s: %s in %ds (%s/s, %d IOPS)" % \
+                (name, Util.num2str(numBytes), elapsed, 
+                Util.num2str(int(numBytes / elapsed)), numOps / elapsed))
+
+    def close(self):
+        "Make sure nothing is left stopped"
+        for pgid in self.groups.keys():
+            self.remove(pgid)
+
+    def update(self):
+        """Account for the I/O done since the last call, then stop or 
+        continue the processes. To be called every poll interval"""
+        now = time.time()
+        elapsed = now - self.lastUpdate
+        self.lastUpdate = now
+        deltaBytes = 0
+        deltaOps = 0
+        for pgid, group in self.groups.iteritems():
+            (numBytes, numOps) = self._getGroupIO(group[4], pgid)
+            group[2] += numBytes
+            group[3] += numOps
+            deltaBytes += numBytes
+            deltaOps += numOps
+        self.sampleBytes += deltaBytes
+        self.sampleOps += deltaOps
+        if self.stopped:
+            self.sampleStopped = True
+        if now - self.lastSample >= self.LATENCY_SAMPLE_INTERVAL:
+            self._sample(now)
+
+        limitBytes = self._getLimit(self.maxBandwidth, self.peakBandwidth)
+        limitOps = self._getLimit(self.maxIOPS, self.peakIOPS)
+        stop = False
+        if limitBytes:
+            self.creditBytes = min(self.creditBytes + elapsed * limitBytes - \
+                    deltaBytes, limitBytes * self.BURST)
+            stop = self.creditBytes < 0
+        if limitOps:
+            self.creditOps = min(self.creditOps + elapsed * limitOps - \
+                    deltaOps, limitOps * self.BURST)
+            stop = stop or self.creditOps < 0
+        if stop != self.stopped:
+            self.stopped = stop
+            sig = signal.SIGCONT
+            if stop:
+                sig = signal.SIGSTOP
+            for pgid in self.groups.iterkeys():
+                self._signal(pgid, sig)
+
+    def _getLimit(self, budget, peak):
+        if budget:
+            return budget * self.factor
+        if self.factor < 1 and peak:
+            return peak * self.factor
+        return 0
+
+    def _sample(self, now):
+        """Adjust the back-off factor according to the guest latency. Also 
+        keep track of the unthrottled rates: when there is no budget, backing
+        off is relative to them"""
+        elapsed = now - self.lastSample
+        if not self.sampleStopped and self.factor == 1:
+            self.peakBandwidth = max(self.peakBandwidth, 
+                    self.sampleBytes / elapsed)
+            self.peakIOPS = max(self.peakIOPS, self.sampleOps / elapsed)
+        self.lastSample = now
+        self.sampleBytes = 0
+        self.sampleOps = 0
+        self.sampleStopped = self.stopped
+
+        if not self.maxLatency:
+            return
+        latency = self._getCollectedLatency()
+        if latency is None:
+            counters = self._getLatencyCounters()
+            latency = 0
+            for dev, (ios, ticks) in counters.iteritems():
+                if self.latencyCounters.has_key(dev):
+                    (prevIOs, prevTicks) = self.latencyCounters[dev]
+                    if ios > prevIOs:
+                        latency = max(latency,
+                                (ticks - prevTicks) / (ios - prevIOs))
+            self.latencyCounters = counters
+        else:
+            self.latencyCounters = {}
+        if latency > self.maxLatency and self.factor > self.MIN_FACTOR:
+            self.factor = max(self.factor / 2, self.MIN_FACTOR)
+            Util.log("  Guest I/O latency %dms: coalesce throttled to %d%%" % \
+                    (latency, self.factor * 100))
+        elif latency < self.maxLatency / 2 and self.factor < 1:
+            self.factor = min(self.factor * 2, 1.0)
+            Util.log("  Guest I/O latency %dms: coalesce throttled to %d%%" % \
+                    (latency, self.factor * 100))
+
+    def _getCollectedLatency(self):
+        """Get the highest latency (ms) over the last sample of the tapstats
+        collector among the tapdisks serving VDIs in this SR, or None if the
+        collector isn't running"""
+        summary = tapstats.load()
+        if not summary:
+            return None
+        latency = 0
+        for vdi in summary["vdis"].itervalues():
+            if vdi["path"].startswith(self.srPath + "/"):
+                latency = max(latency, int(vdi["latency"]))
+        return latency
+
+    def _getLatencyCounters(self):
+        """Get the (I/Os completed, ms spent on them) block-layer counters of 
+        the tapdevs of all tapdisks serving VDIs in this SR"""
+        counters = {}
+        if not self.maxLatency:
+            return counters
+        try:
+            tapdisks = list(blktap2.Tapdisk.list())
+        except blktap2.TapCtl.CommandFailure:
+            Util.logException("CoalesceThrottle")
+            return counters
+        for tapdisk in tapdisks:
+            if not tapdisk.path.startswith(self.srPath + "/"):
+                continue
+            dev = "tapdev%d" % int(tapdisk.minor)
+            try:
+                f = open(os.path.join(self.SYSFS_BLOCK, dev, "stat"))
+                try:
+                    fields = map(long, f.readline().split())
+                finally:
+                    f.close()
+            except (IOError, ValueError):
+                continue # gone meanwhile
+            # reads completed, writes completed; read ms, write ms
+            counters[dev] = (fields[0] + fields[4], fields[3] + fields[7])
+        return counters
+
+    def _getGroupIO(self, counters, pgid):
+        """Get the bytes read/written and the read/write calls made by the 
+        processes in the group since the last call. 'counters' keeps the
+        previous values for each process"""
+        deltaBytes = 0
+        deltaOps = 0
+        for pid, io in Util.getGroupIO(pgid).iteritems():
+            numBytes = io["read_bytes"] + io["write_bytes"]
+            numOps = io["syscr"] + io["syscw"]
+            (prevBytes, prevOps) = counters.get(pid, (0, 0))
+            counters[pid] = (numBytes, numOps)
+            deltaBytes += numBytes - prevBytes
+            deltaOps += numOps - prevOps
+        return (deltaBytes, deltaOps)
+
+    def _signal(self, pgid, sig):
+        try:
+            os.killpg(pgid, sig)
+        except OSError:
+            pass # already exited
+
+    def _getConfig(self, otherConfig, key, default):
+        val = otherConfig.get(key)
+        if not val:
+            return default
+        try:
+            return max(int(val), 0)
+        except ValueError:
+            Util.log("Invalid %s: %s" % (key, val))
+            return default
+
+################################################################################
+#
+#  GC progress
+#
+class GCProgress:
+    """Progress and timing of GC/coalesce in an SR: the VDIs being coalesced 
+    (bytes copied, rate, ETA), and the wall time spent in each phase of the 
+    current GC run or, when nothing is running, of the last one. Phases nest 
+    (e.g. a relink includes the slave updates it does), and their times are 
+    inclusive. 
+    
+    The state is written atomically to a file for "cleanup.py --query", and 
+    mirrored into the SR other-config key DB_PROGRESS if DB_PUBLISH is set to
+    "true" there"""
+
+    BASE_DIR = CoalesceScheduler.BASE_DIR
+    FILE_EXT = ".progress"
+
+    DB_PUBLISH = "gc-publish-progress"
+    DB_PROGRESS = "gc-progress"
+
+    STATE_RUNNING = "running"
+    STATE_DONE = "done"
+
+    PHASE_SCAN = "scan"
+    PHASE_DELETE = "delete"
+    PHASE_COALESCE = "coalesce"
+    PHASE_LEAF_COALESCE = "leaf-coalesce"
+    PHASE_RELINK = "relink"
+    PHASE_RENAME = "update-slaves-rename"
+    PHASE_RESIZE = "update-slaves-resize"
+
+    WRITE_INTERVAL = 5    # seconds
+    PUBLISH_INTERVAL = 60 # seconds, keep the load on XAPI down
+
+    class Task:
+        """A VHD coalesce in progress. The bytes copied are the bytes written 
+        by the process group doing the coalesce"""
+
+        def __init__(self, progress, vdi, bytesTotal):
+            self.progress = progress
+            self.uuid = vdi.uuid
+            self.parentUuid = vdi.parent.uuid
+            self.bytesTotal = bytesTotal
+            self.bytesDone = 0
+            self.pgid = None
+            self.counters = {} # pid -> bytes written
+            self.phase = progress.startPhase(GCProgress.PHASE_COALESCE)
+            self.startTime = self.phase[1]
+
+        def start(self, pgid):
+            "Follow the process group pgid, which does the coalesce"
+            self.pgid = pgid
+
+        def update(self):
+            self.progress.update()
+
+        def finish(self):
+            self.progress._endTask(self)
+
+        def _sample(self):
+            if self.pgid is None:
+                return
+            for pid, io in Util.getGroupIO(self.pgid).iteritems():
+                prev = self.counters.get(pid, 0)
+                self.counters[pid] = io["wchar"]
+                self.bytesDone += io["wchar"] - prev
+
+    def __init__(self, srUuid):
+        self.path = os.path.join(self.BASE_DIR, srUuid + self.FILE_EXT)
+        self.xapi = None
+        self.running = False
+        self.startTime = 0
+        self.lastWrite = 0
+        self.lastPublish = 0
+        self.tasks = []
+        self.current = []  # [[phase, startTime]] of the phases in progress
+        self.phases = {}   # phase -> [count, seconds]
+
+    def reset(self):
+        "Forget the phase times accumulated so far (nothing is written)"
+        self.phases = {}
+
+    def startRun(self, xapi):
+        """Start reporting a GC run (no-op if already started). The phase 
+        times accumulated since reset() are included"""
+        if self.running:
+            return
+        self.running = True
+        self.startTime = time.time()
+        self.xapi = None
+        if xapi.srRecord["other_config"].get(self.DB_PUBLISH) == "true":
+            self.xapi = xapi
+        self.lastPublish = 0
+        self.update(True)
+
+    def endRun(self):
+        if not self.running:
+            return
+        self.running = False
+        self.tasks = []
+        self.lastPublish = 0
+        self.update(True)
+        self.xapi = None
+
+    def startPhase(self, phase):
+        "Return the entry to pass to endPhase()"
+        entry = [phase, time.time()]
+        self.current.append(entry)
+        return entry
+
+    def endPhase(self, entry):
+        (phase, startTime) = entry
+        if entry in self.current:
+            self.current.remove(entry)
+        stats = self.phases.setdefault(phase, [0, 0.0])
+        stats[0] += 1
+        stats[1] += time.time() - startTime
+        self.update()
+
+    def startTask(self, vdi, bytesTotal):
+        """Start tracking the coalesce of vdi, which is going to copy about
+        bytesTotal bytes (0 if unknown)"""
+        task = self.Task(self, vdi, bytesTotal)
+        self.tasks.append(task)
+        self.update(True)
+        return task
+
+    def update(self, force = False):
+        """Write out the state if WRITE_INTERVAL has passed since the last 
+        time (or if forced), and publish it every PUBLISH_INTERVAL"""
+        if not self.running and not force:
+            return
+        now = time.time()
+        if not force and now - self.lastWrite < self.WRITE_INTERVAL:
+            return
+        self.lastWrite = now
+        for task in self.tasks:
+            task._sample()
+        self._write(now)
+        if now - self.lastPublish >= self.PUBLISH_INTERVAL:
+            self._publish()
+
+    def getReport(srUuid):
+        "Return the lines describing the state in the file of SR srUuid"
+        path = os.path.join(GCProgress.BASE_DIR, srUuid + GCProgress.FILE_EXT)
+        try:
+            f = open(path, 'r')
+        except IOError:
+            return ["No GC progress recorded"]
+        try:
+            records = map(lambda x: x.split(), f.readlines())
+        finally:
+            f.close()
+
+        state = ""
+        startTime = updateTime = 0.0
+        tasks = []
+        current = []
+        phases = []
+        try:
+            for fields in records:
+                if not fields:
+                    continue
+                if fields[0] == "S" and len(fields) == 4:
+                    state = fields[1]
+                    startTime = float(fields[2])
+                    updateTime = float(fields[3])
+                elif fields[0] == "T" and len(fields) == 6:
+                    tasks.append((fields[1], fields[2], long(fields[3]),
+                            long(fields[4]), float(fields[5])))
+                elif fields[0] == "C" and len(fields) == 3:
+                    current.append((fields[1], float(fields[2])))
+                elif fields[0] == "P" and len(fields) == 4:
+                    phases.append((fields[1], int(fields[2]), 
+                            float(fields[3])))
+        except ValueError:
+            return ["Corrupt GC progress file %s" % path]
+
+        if state == GCProgress.STATE_RUNNING:
+            lines = ["GC running since %s (updated %ds ago)" % \
+                    (GCProgress._fmtTime(startTime), 
+                    max(time.time() - updateTime, 0))]
+        else:
+            lines = ["Last GC run: %s - %s" % (GCProgress._fmtTime(startTime),
+                    GCProgress._fmtTime(updateTime))]
+        for task in tasks:
+            lines.append("  Coalescing %s" % \
+                    GCProgress._describeTask(task, updateTime))
+        for (phase, t) in current:
+            lines.append("  In phase %s for %ds" % (phase, updateTime - t))
+        if phases:
+            lines.append("  Phase wall times:")
+        for (phase, count, seconds) in phases:
+            lines.append("    %-22s %5d x %10.1fs" % (phase, count, seconds))
+        return lines
+    getReport = staticmethod(getReport)
+
+    def _describeTask(task, now):
+        (uuid, parentUuid, bytesDone, bytesTotal, startTime) = task
+        text = "%s -> %s: %s" % (uuid, parentUuid, Util.num2str(bytesDone))
+        if bytesTotal:
+            text += " of %s (%d%%)" % (Util.num2str(bytesTotal),
+                    min(bytesDone * 100 / bytesTotal, 100))
+        elapsed = now - startTime
+        if elapsed >= 1 and bytesDone:
+            rate = bytesDone / elapsed
+            text += ", %s/s" % Util.num2str(int(rate))
+            if bytesTotal > bytesDone:
+                text += ", ETA %ds" % ((bytesTotal - bytesDone) / rate)
+        return text
+    _describeTask = staticmethod(_describeTask)
+
+    def _fmtTime(t):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+    _fmtTime = staticmethod(_fmtTime)
+
+    def _endTask(self, task):
+        if task in self.tasks:
+            task._sample()
+            self.tasks.remove(task)
+        self.endPhase(task.phase)
+        self.update(True)
+
+    def _getTaskInfo(self, task):
+        return (task.uuid, task.parentUuid, task.bytesDone, task.bytesTotal,
+                task.startTime)
+
+    def _getState(self):
+        if self.running:
+            return self.STATE_RUNNING
+        return self.STATE_DONE
+
+    def _write(self, now):
+        """Replace the state file with lines (in the style of the coalesce
+        queue): 
+            S state startTime updateTime
+            T uuid parentUuid bytesDone bytesTotal startTime
+            C phase startTime
+            P phase count seconds"""
+        lines = ["S %s %.1f %.1f\n" % (self._getState(), self.startTime, now)]
+        for task in self.tasks:
+            lines.append("T %s %s %d %d %.1f\n" % self._getTaskInfo(task))
+        for (phase, startTime) in self.current:
+            lines.append("C %s %.1f\n" % (phase, startTime))
+        phases = self.phases.keys()
+        phases.sort()
+        for phase in phases:
+            lines.append("P %s %d %.1f\n" % ((phase,) + \
+                    tuple(self.phases[phase])))
+        try:
+            if not util.pathexists(self.BASE_DIR):
+                os.makedirs(self.BASE_DIR)
+            tmpPath = self.path + ".tmp"
+            f = open(tmpPath, 'w')
+            try:
+                f.writelines(lines)
+            finally:
+                f.close()
+            os.rename(tmpPath, self.path)
+        except (IOError, OSError), e:
+            Util.log("Failed to save the GC progress: %s" % e)
+
+    def _publish(self):
+        """Mirror a one-line summary into the SR other-config"""
+        if not self.xapi:
+            return
+        now = time.time()
+        self.lastPublish = now
+        items = [self._getState()]
+        for task in self.tasks:
+            items.append("coalescing " + \
+                    self._describeTask(self._getTaskInfo(task), now))
+        phases = self.phases.keys()
+        phases.sort()
+        items.append(", ".join(map(lambda x: "%s %dx %ds" % \
+                (x, self.phases[x][0], self.phases[x][1]), phases)))
+        try:
+            self.xapi.setConfigSR(self.DB_PROGRESS, "; ".join(items))
+        except XenAPI.Failure:
+            Util.logException("GCProgress")
+
+
+def timedPhase(phase):
+    """Decorator for SR methods: account the wall time spent in the method to
+    the GC phase 'phase' (see GCProgress)"""
+    def decorator(op):
+        def wrapper(self, *args, **kwargs):
+            entry = self.progress.startPhase(phase)
+            try:
+                return op(self, *args, **kwargs)
+            finally:
+                self.progress.endPhase(entry)
+        return wrapper
+    return decorator
+
 ################################################################################
 #
 # SR
@@ -1223,12 +2107,23 @@ class SR:
 
     SCAN_RETRY_ATTEMPTS = 3
 
+    # incremental scans: fall back to a full scan if more VDIs than this 
+    # changed, and do a full one at least every SCAN_FULL_INTERVAL seconds
+    SCAN_INCREMENTAL_MAX = 16
+    SCAN_FULL_INTERVAL = 300
+
     JRN_CLONE = "clone" # journal entry type for the clone operation (from SM)
     TMP_RENAME_PREFIX = "OLD_"
 
     KEY_OFFLINE_COALESCE_NEEDED = "leaf_coalesce_need_offline"
     KEY_OFFLINE_COALESCE_OVERRIDE = "leaf_coalesce_offline_override"
 
+    # SR other-config key: how many VDI pairs (in separate VHD trees) may be
+    # coalesced at the same time
+    DB_COALESCE_CONCURRENCY = "coalesce-concurrency"
+    COALESCE_CONCURRENCY_DEFAULT = 2
+    COALESCE_CONCURRENCY_MAX = 8
+
     def getInstance(uuid, xapiSession, createLock = True, force = False):
         xapi = XAPI(xapiSession, uuid)
         type = normalizeType(xapi.srRecord["type"])
@@ -1256,6 +2151,11 @@ class SR:
             Util.log("Requested no SR locking")
         self.name = unicode(self.xapi.srRecord["name_label"]).encode("utf-8", "replace")
         self._failedCoalesceTargets = []
+        self.scheduler = CoalesceScheduler(self.uuid)
+        self.progress = GCProgress(self.uuid)
+        self.incrementalScan = False
+        self._scanState = None
+        self._lastFullScan = 0
 
         if not self.xapi.isPluggedHere():
             if force:
@@ -1282,6 +2182,26 @@ class SR:
         update VDI objects if they already exist"""
         pass # abstract
 
+    def invalidateScan(self):
+        """Make the next scan a full one"""
+        self._scanState = None
+
+    def _useIncrementalScan(self):
+        """Can the next scan be incremental, i.e. only reload the VDIs that
+        changed since the last scan? We need a full scan if anything outside
+        of GC could have modified VHD metadata without changing the SR
+        (signalled through FLAG_TYPE_RESCAN, see requestFullScan())"""
+        if not self.incrementalScan or self._scanState == None:
+            return False
+        if time.time() - self._lastFullScan > self.SCAN_FULL_INTERVAL:
+            return False
+        scanFlag = IPCFlag(NS_PREFIX_SCAN + self.uuid)
+        if scanFlag.test(FLAG_TYPE_RESCAN):
+            scanFlag.clear(FLAG_TYPE_RESCAN)
+            return False
+        return True
+
+    @timedPhase(GCProgress.PHASE_SCAN)
     def scanLocked(self, force = False):
         self.lock()
         try:
@@ -1289,6 +2209,23 @@ class SR:
         finally:
             self.unlock()
 
+    def getCoalesceBitmaps(self, vdis):
+        """The block bitmaps (vhdbitmap.Bitmap) of vdis and of their VHD 
+        parents, by uuid, each VHD queried only once. The BAT info of vdis is
+        re-read rather than taken from vdi_rec, since they were writable all 
+        this time"""
+        bitmaps = {}
+        for vdi in vdis:
+            vdi.delConfig(VDI.DB_VHD_BLOCKS)
+            bitmaps[vdi.uuid] = vhdbitmap.Bitmap.fromString(vdi.getVHDBlocks())
+        for vdi in vdis:
+            parent = vdi.parent
+            if parent.raw or bitmaps.has_key(parent.uuid):
+                continue
+            bitmaps[parent.uuid] = \
+                    vhdbitmap.Bitmap.fromString(parent.getVHDBlocks())
+        return bitmaps
+
     def getVDI(self, uuid):
         return self.vdis.get(uuid)
 
@@ -1303,44 +2240,75 @@ class SR:
             return True
         return False
 
+    def getCoalesceConcurrency(self):
+        "How many VDI pairs we may coalesce at once in this SR"
+        val = self.xapi.srRecord["other_config"].get( \
+                self.DB_COALESCE_CONCURRENCY)
+        if not val:
+            return self.COALESCE_CONCURRENCY_DEFAULT
+        try:
+            num = int(val)
+        except ValueError:
+            Util.log("Invalid %s: %s" % (self.DB_COALESCE_CONCURRENCY, val))
+            return self.COALESCE_CONCURRENCY_DEFAULT
+        return max(1, min(num, self.COALESCE_CONCURRENCY_MAX))
+
+    def getCoalesceThrottle(self):
+        """The throttle to apply to (non-leaf) coalescing in this SR, or None
+        if there is neither an I/O budget nor a latency limit"""
+        throttle = CoalesceThrottle(self.path, 
+                self.xapi.srRecord["other_config"])
+        if not throttle.isActive():
+            return None
+        return throttle
+
     def findCoalesceable(self):
         """Find a coalesceable VDI. Return a vdi that should be coalesced
         (choosing one among all coalesceable candidates according to some
         criteria) or None if there is no VDI that could be coalesced"""
+        candidates = self.findCoalesceables(1)
+        if candidates:
+            return candidates[0]
+        return None
+
+    def findCoalesceables(self, maxNum):
+        """Find up to maxNum VDIs that can be coalesced at the same time: no
+        two in the same VHD tree, and with enough free space in the SR for all
+        of them. Return them in the order of preference"""
         # finish any VDI for which a relink journal entry exists first
         journals = self.journaler.getAll(VDI.JRN_RELINK)
         for uuid in journals.iterkeys():
             vdi = self.getVDI(uuid)
             if vdi and vdi not in self._failedCoalesceTargets:
-                return vdi
+                return [vdi]
 
         candidates = []
         for vdi in self.vdis.values():
             if vdi.isCoalesceable() and vdi not in self._failedCoalesceTargets:
                 candidates.append(vdi)
+        if not candidates:
+            return []
 
-        # pick one in the tallest tree
-        treeHeight = dict()
-        for c in candidates:
-            height = c.getTreeRoot().getTreeHeight()
-            if treeHeight.get(height):
-                treeHeight[height].append(c)
-            else:
-                treeHeight[height] = [c]
-
+        # the space needed is reserved for each VDI chosen, since the parents
+        # of all of them will be inflated at the same time
         freeSpace = self.getFreeSpace()
-        heights = treeHeight.keys()
-        heights.sort(reverse=True)
-        for h in heights:
-            for c in treeHeight[h]:
-                spaceNeeded = c._calcExtraSpaceForCoalescing()
-                if spaceNeeded <= freeSpace:
-                    Util.log("Coalesce candidate: %s (tree height %d)" % (c, h))
-                    return c
-                else:
-                    Util.log("No space to coalesce %s (free space: %d)" % \
-                            (c, freeSpace))
-        return None
+        chosen = []
+        roots = []
+        for c, spaceNeeded in self.scheduler.rank(candidates):
+            root = c.getTreeRoot()
+            if root in roots:
+                continue
+            if spaceNeeded <= freeSpace:
+                Util.log("Coalesce candidate: %s" % c)
+                chosen.append(c)
+                roots.append(root)
+                freeSpace -= max(spaceNeeded, 0)
+                if len(chosen) >= maxNum:
+                    break
+            else:
+                Util.log("No space to coalesce %s (free space: %d)" % \
+                        (c, freeSpace))
+        return chosen
 
     def findLeafCoalesceable(self):
         """Find leaf-coalesceable VDIs in each VHD tree"""
@@ -1364,7 +2332,7 @@ class SR:
             candidates.append(vdi)
 
         freeSpace = self.getFreeSpace()
-        for candidate in candidates:
+        for candidate in self.scheduler.rankLeaves(candidates):
             # check the space constraints to see if leaf-coalesce is actually 
             # feasible for this candidate
             spaceNeeded = candidate._calcExtraSpaceForSnapshotCoalescing()
@@ -1399,11 +2367,91 @@ class SR:
                 self.cleanup()
                 raise
             else:
-                self._failedCoalesceTargets.append(vdi)
-                Util.logException("coalesce")
-                Util.log("Coalesce failed, skipping")
+                self._coalesceFailed(vdi, "coalesce")
         self.cleanup()
 
+    def coalesceMany(self, vdiList, dryRun):
+        """Coalesce each VDI in vdiList onto its parent, running the VHD
+        coalesce step for all of them in parallel. The VDIs must be in
+        separate VHD trees (see findCoalesceables)"""
+        if len(vdiList) == 1:
+            self.coalesce(vdiList[0], dryRun)
+            return
+
+        for vdi in vdiList:
+            Util.log("Coalescing %s -> %s" % (vdi, vdi.parent))
+        if dryRun:
+            return
+
+        # the SR preparation steps and the relinking are done one VDI at a 
+        # time: only the (long-running) VHD coalesce is done concurrently
+        # the I/O budget is shared by all of them
+        tasks = {}
+        progressTasks = {}
+        throttle = self.getCoalesceThrottle()
+        try:
+            for vdi in vdiList:
+                progressTasks[vdi] = self.startCoalesceTask(vdi)
+                try:
+                    tasks[vdi] = self._startCoalesce(vdi)
+                    progressTasks[vdi].start(tasks[vdi])
+                    if throttle:
+                        throttle.add(tasks[vdi], str(vdi))
+                except util.SMException, e:
+                    if isinstance(e, AbortException):
+                        raise
+                    progressTasks.pop(vdi).finish()
+                    self._coalesceFailed(vdi, "coalesce")
+
+            abortFlag = IPCFlag(self.uuid)
+            while tasks:
+                if abortFlag.test(FLAG_TYPE_ABORT):
+                    raise AbortException("Aborting due to signal")
+                for vdi, pid in tasks.items():
+                    try:
+                        if not Util.checkAbortable(pid,
+                                self._getCoalesceNS(vdi)):
+                            continue
+                    except util.SMException:
+                        del tasks[vdi]
+                        if throttle:
+                            throttle.remove(pid)
+                        progressTasks.pop(vdi).finish()
+                        self._coalesceFailed(vdi, "coalesce")
+                        try:
+                            vdi._cleanupCoalesce()
+                        except util.SMException:
+                            Util.logException("coalesce cleanup")
+                        continue
+                    del tasks[vdi]
+                    if throttle:
+                        throttle.remove(pid)
+                    progressTasks.pop(vdi).finish()
+                    try:
+                        self._finishCoalesce(vdi)
+                    except util.SMException, e:
+                        if isinstance(e, AbortException):
+                            raise
+                        self._coalesceFailed(vdi, "coalesce")
+                if tasks:
+                    if throttle:
+                        throttle.update()
+                    self.progress.update()
+                    time.sleep(VDI.POLL_INTERVAL)
+        finally:
+            if throttle:
+                throttle.close()
+            for task in progressTasks.itervalues():
+                task.finish()
+            for vdi, pid in tasks.iteritems():
+                Util.log("Aborting coalesce of %s" % vdi)
+                try:
+                    Util.killAbortable(pid, self._getCoalesceNS(vdi))
+                    vdi._cleanupCoalesce()
+                except:
+                    Util.logException("coalesceMany")
+            self.cleanup()
+
     def coalesceLeaf(self, vdi, dryRun):
         """Leaf-coalesce vdi onto parent"""
         Util.log("Leaf-coalescing %s -> %s" % (vdi, vdi.parent))
@@ -1424,9 +2472,7 @@ class SR:
                 self.cleanup()
                 raise
             else:
-                self._failedCoalesceTargets.append(vdi)
-                Util.logException("leaf-coalesce")
-                Util.log("Leaf-coalesce failed, skipping")
+                self._coalesceFailed(vdi, "leaf-coalesce")
         self.cleanup()
 
     def garbageCollect(self, dryRun = False):
@@ -1444,6 +2490,7 @@ class SR:
             vdiList.extend(vdi.getAllPrunable())
         return vdiList
 
+    @timedPhase(GCProgress.PHASE_DELETE)
     def deleteVDIs(self, vdiList):
         for vdi in vdiList:
             if IPCFlag(self.uuid).test(FLAG_TYPE_ABORT):
@@ -1452,42 +2499,43 @@ class SR:
             self.deleteVDI(vdi)
 
     def deleteVDI(self, vdi):
+        self._unlinkVDI(vdi)
+        vdi.delete()
+
+    def _unlinkVDI(self, vdi):
+        "Remove vdi from the SR's VDI trees"
         assert(len(vdi.children) == 0)
         del self.vdis[vdi.uuid]
         if vdi.parent:
             vdi.parent.children.remove(vdi)
         if vdi in self.vdiTrees:
             self.vdiTrees.remove(vdi)
-        vdi.delete()
 
     def forgetVDI(self, vdiUuid):
         self.xapi.forgetVDI(self.uuid, vdiUuid)
 
     def pauseVDIs(self, vdiList):
-        paused = []
-        failed = False
-        for vdi in vdiList:
-            try:
-                vdi.pause()
-                paused.append(vdi)
-            except:
-                Util.logException("pauseVDIs")
-                failed = True
-                break
-
-        if failed:
-            self.unpauseVDIs(paused)
+        """Pause all VDIs in vdiList at once, with one call per host"""
+        uuids = map(lambda x: x.uuid, vdiList)
+        try:
+            paused = blktap2.VDI.tap_pause_many(self.xapi.session, self.uuid,
+                    uuids)
+        except:
+            Util.logException("pauseVDIs")
+            paused = False
+        if not paused:
             raise util.SMException("Failed to pause VDIs")
         
     def unpauseVDIs(self, vdiList):
-        failed = False
-        for vdi in vdiList:
-            try:
-                vdi.unpause()
-            except:
-                Util.log("ERROR: Failed to unpause VDI %s" % vdi)
-                failed = True
-        if failed:
+        uuids = map(lambda x: x.uuid, vdiList)
+        try:
+            unpaused = blktap2.VDI.tap_unpause_many(self.xapi.session,
+                    self.uuid, uuids)
+        except:
+            Util.logException("unpauseVDIs")
+            unpaused = False
+        if not unpaused:
+            Util.log("ERROR: Failed to unpause VDIs %s" % uuids)
             raise util.SMException("Failed to unpause VDIs")
 
     def getFreeSpace(self):
@@ -1497,6 +2545,14 @@ class SR:
         Util.log("In cleanup")
         return
 
+    def beginGC(self):
+        """Called at the start of a GC run"""
+        pass
+
+    def endGC(self):
+        """Called at the end of a GC run"""
+        pass
+
     def __str__(self):
         if self.name:
             ret = "%s ('%s')" % (self.uuid[0:4], self.name)
@@ -1555,8 +2611,9 @@ class SR:
 
     def cleanupJournals(self, dryRun):
         """delete journal entries for non-existing VDIs"""
+        journals = self.journaler.getAllJournals()
         for t in [LVHDVDI.JRN_ZERO, VDI.JRN_RELINK, SR.JRN_CLONE]:
-            entries = self.journaler.getAll(t)
+            entries = journals.get(t, {})
             for uuid, jval in entries.iteritems():
                 if self.getVDI(uuid):
                     continue
@@ -1572,6 +2629,24 @@ class SR:
     def cleanupCache(self):
         pass
 
+    def _coalesceFailed(self, vdi, tag):
+        self._failedCoalesceTargets.append(vdi)
+        self.scheduler.recordFailure(vdi.uuid)
+        self.invalidateScan()
+        Util.logException(tag)
+        if tag == "leaf-coalesce":
+            Util.log("Leaf-coalesce failed, skipping")
+        else:
+            Util.log("Coalesce failed, skipping")
+
+    def _getCoalesceNS(self, vdi):
+        return NS_PREFIX_COALESCE + vdi.uuid
+
+    def startCoalesceTask(self, vdi):
+        "Start tracking the progress of coalescing vdi"
+        return self.progress.startTask(vdi, 
+                self.scheduler.getSizeCopy(vdi.uuid))
+
     def _coalesce(self, vdi):
         if self.journaler.get(vdi.JRN_RELINK, vdi.uuid):
             # this means we had done the actual coalescing already and just 
@@ -1584,16 +2659,43 @@ class SR:
             # don't expect the rest of the process to take long
             self.journaler.create(vdi.JRN_COALESCE, vdi.uuid, "1")
             vdi._doCoalesce()
-            self.journaler.remove(vdi.JRN_COALESCE, vdi.uuid)
+            self._startRelink(vdi)
+        self._relink(vdi)
+
+    def _startCoalesce(self, vdi):
+        """Prepare the VDI pair and start the VHD coalesce in a separate
+        process. Return the PID of the process"""
+        assert(not self.journaler.get(vdi.JRN_RELINK, vdi.uuid))
+        self.journaler.create(vdi.JRN_COALESCE, vdi.uuid, "1")
+        vdi._prepareCoalesce()
+        Util.log("  Running VHD coalesce on %s" % vdi)
+        return Util.startAbortable(vhdutil.coalesce, None,
+                self._getCoalesceNS(vdi), (vdi.path,))
+
+    def _finishCoalesce(self, vdi):
+        """Complete the coalesce started by _startCoalesce() once the VHD 
+        coalesce is done"""
+        util.fistpoint.activate("LVHDRT_coalescing_VHD_data", self.uuid)
+        try:
+            vdi._checkCoalesced()
+        finally:
+            vdi._cleanupCoalesce()
+        self._startRelink(vdi)
+        self._relink(vdi)
+
+    def _startRelink(self, vdi):
+        self.journaler.remove(vdi.JRN_COALESCE, vdi.uuid)
 
-            util.fistpoint.activate("LVHDRT_before_create_relink_journal",self.uuid)
+        util.fistpoint.activate("LVHDRT_before_create_relink_journal",self.uuid)
 
-            # we now need to relink the children: lock the SR to prevent ops 
-            # like SM.clone from manipulating the VDIs we'll be relinking and 
-            # rescan the SR first in case the children changed since the last 
-            # scan
-            self.journaler.create(vdi.JRN_RELINK, vdi.uuid, "1")
+        # we now need to relink the children: lock the SR to prevent ops 
+        # like SM.clone from manipulating the VDIs we'll be relinking and 
+        # rescan the SR first in case the children changed since the last 
+        # scan
+        self.journaler.create(vdi.JRN_RELINK, vdi.uuid, "1")
 
+    @timedPhase(GCProgress.PHASE_RELINK)
+    def _relink(self, vdi):
         self.lock()
         try:
             self.scan()
@@ -1604,6 +2706,7 @@ class SR:
         vdi.parent._reloadChildren(vdi)
         self.journaler.remove(vdi.JRN_RELINK, vdi.uuid)
 
+    @timedPhase(GCProgress.PHASE_LEAF_COALESCE)
     def _coalesceLeaf(self, vdi):
         """Leaf-coalesce VDI vdi. Return true if we succeed, false if we cannot
         complete due to external changes, namely vdi_delete and vdi_snapshot 
@@ -1789,6 +2892,10 @@ class SR:
 
     def _buildTree(self, force):
         self.vdiTrees = []
+        for vdi in self.vdis.values():
+            # VDIs not reloaded by an incremental scan keep their old links
+            vdi.parent = None
+            vdi.children = []
         for vdi in self.vdis.values():
             if vdi.parentUuid:
                 parent = self.getVDI(vdi.parentUuid)
@@ -1818,6 +2925,7 @@ class FileSR(SR):
         SR.__init__(self, uuid, xapi, createLock, force)
         self.path = "/var/run/sr-mount/%s" % self.uuid
         self.journaler = fjournaler.Journaler(self.path)
+        self._lastScanTime = 0
 
     def findLeafCoalesceable(self):
         """Disable leaf-coalesce for File-based SRs"""
@@ -1826,7 +2934,17 @@ class FileSR(SR):
     def scan(self, force = False):
         if not util.pathexists(self.path):
             raise util.SMException("directory %s not found!" % self.uuid)
-        vhds = self._scan(force)
+        vhds = None
+        if self._useIncrementalScan():
+            vhds, uuidsPresent = self._scanIncremental()
+        if vhds == None:
+            scanTime = time.time()
+            state = self._getScanState()
+            vhds = self._scan(force)
+            uuidsPresent = vhds.keys()
+            self._scanState = state
+            self._lastScanTime = scanTime
+            self._lastFullScan = scanTime
         for uuid, vhdInfo in vhds.iteritems():
             vdi = self.getVDI(uuid)
             if not vdi:
@@ -1834,7 +2952,6 @@ class FileSR(SR):
                 vdi = FileVDI(self, uuid, False)
                 self.vdis[uuid] = vdi
             vdi.load(vhdInfo)
-        uuidsPresent = vhds.keys()
         rawList = filter(lambda x: x.endswith(vhdutil.FILE_EXTN_RAW),
                 os.listdir(self.path))
         for rawName in rawList:
@@ -1892,10 +3009,22 @@ class FileSR(SR):
             cacheLock = lock.Lock(blktap2.VDI.LOCK_CACHE_SETUP, lockId)
             cacheLock.acquire()
             try:
+                blktap2.Tapdisk.registry.invalidate()
                 self._cleanupCache(uuid)
             finally:
                 cacheLock.release()
 
+        self._evictCache()
+
+    def _evictCache(self):
+        """Evict the read caches no tapdisk uses any more, if short of
+        space or idle for long"""
+        import lcache
+        cacheSR = lcache.CacheFileSR(self.path)
+        evicted = cacheSR.evict_with_config(self.xapi.srRecord["other_config"])
+        Util.log("Evicted %d read caches, %d%% free" % \
+                (len(evicted), cacheSR.free_percent()))
+
     def _cleanupCache(self, uuid):
         rec = self.xapi.getRecordVDI(uuid)
         if rec and (rec["allow_caching"] or not rec["managed"]):
@@ -1915,6 +3044,52 @@ class FileSR(SR):
         return (len(name) == Util.UUID_LEN + len(self.CACHE_FILE_EXT)) and \
                 name.endswith(self.CACHE_FILE_EXT)
 
+    def _getScanState(self):
+        """Get the (inode, size, mtime) of all VHD files"""
+        state = {}
+        for name in os.listdir(self.path):
+            if not name.endswith(vhdutil.FILE_EXTN_VHD):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue # deleted meanwhile
+            state[FileVDI.extractUuid(name)] = \
+                    (st.st_ino, st.st_size, st.st_mtime)
+        return state
+
+    def _scanIncremental(self):
+        """Reload only the VHDs whose files changed since the last scan.
+        Return (VHD info for the changed VHDs, UUIDs of all VHDs present), or
+        (None, None) if a full scan is needed instead"""
+        scanTime = time.time()
+        state = self._getScanState()
+        changed = []
+        for uuid, sig in state.iteritems():
+            vdi = self.getVDI(uuid)
+            # files modified around the time of the last scan may have 
+            # changed again within the mtime granularity
+            if not vdi or vdi.scanError or self._scanState.get(uuid) != sig \
+                    or sig[2] >= self._lastScanTime - 1:
+                changed.append(uuid)
+        if len(changed) > self.SCAN_INCREMENTAL_MAX:
+            Util.log("%d VHDs changed, doing a full scan" % len(changed))
+            return (None, None)
+
+        vhds = {}
+        for uuid in changed:
+            path = os.path.join(self.path, uuid + vhdutil.FILE_EXTN_VHD)
+            try:
+                vhds[uuid] = vhdutil.getVHDInfo(path, FileVDI.extractUuid)
+            except util.SMException:
+                Util.log("Failed to reload %s, doing a full scan" % path)
+                return (None, None)
+        Util.log("Incremental scan: %d/%d VHDs changed" % \
+                (len(changed), len(state)))
+        self._scanState = state
+        self._lastScanTime = scanTime
+        return (vhds, state.keys())
+
     def _scan(self, force):
         for i in range(SR.SCAN_RETRY_ATTEMPTS):
             error = False
@@ -2034,6 +3209,10 @@ class LVHDSR(SR):
         self.lvmCache = lvmcache.LVMCache(self.vgName)
         self.lvActivator = LVActivator(self.uuid, self.lvmCache)
         self.journaler = journaler.Journaler(self.lvmCache)
+        self.ledger = VGLedger(self.vgName)
+        self._scanSeqno = None
+
+    DELETE_BATCH_SIZE = 100 # VDIs deleted at once by deleteVDIs
 
     def deleteVDI(self, vdi):
         if self.lvActivator.get(vdi.uuid, False):
@@ -2041,19 +3220,57 @@ class LVHDSR(SR):
         self._checkSlaves(vdi)
         SR.deleteVDI(self, vdi)
 
+    @timedPhase(GCProgress.PHASE_DELETE)
+    def deleteVDIs(self, vdiList):
+        """Delete the VDIs in batches: one slave plugin call per slave and a 
+        single lvremove per batch, rather than per VDI"""
+        abortFlag = IPCFlag(self.uuid)
+        for i in range(0, len(vdiList), self.DELETE_BATCH_SIZE):
+            if abortFlag.test(FLAG_TYPE_ABORT):
+                raise AbortException("Aborting due to signal")
+            batch = vdiList[i:i + self.DELETE_BATCH_SIZE]
+            for vdi in batch:
+                Util.log("Deleting unlinked VDI %s" % vdi)
+                if self.lvActivator.get(vdi.uuid, False):
+                    self.lvActivator.deactivate(vdi.uuid, False)
+            self._checkSlavesMany(batch)
+            for vdi in batch:
+                self._unlinkVDI(vdi)
+            self._deleteVDIBatch(batch)
+
+    def _deleteVDIBatch(self, vdiList):
+        "Like LVHDVDI.delete for all VDIs in vdiList, with one lvremove"
+        self.lock()
+        try:
+            self.lvmCache.removeMany(map(lambda x: x.fileName, vdiList))
+            for vdi in vdiList:
+                self.forgetVDI(vdi.uuid)
+        finally:
+            self.unlock()
+        RefCounter.setMany(dict(map(lambda x: (x.uuid, (0, 0)), vdiList)),
+                lvhdutil.NS_PREFIX_LVM + self.uuid)
+        for vdi in vdiList:
+            VDI.delete(vdi)
+
     def forgetVDI(self, vdiUuid):
         SR.forgetVDI(self, vdiUuid)
         mdpath = os.path.join(self.path, lvutil.MDVOLUME_NAME)        
         LVMMetadataHandler(mdpath).deleteVdiFromMetadata(vdiUuid)
 
     def getFreeSpace(self):
-        stats = lvutil._getVGstats(self.vgName)
-        return stats['physical_size'] - stats['physical_utilisation']
+        return self.ledger.getFreeSpace()
 
     def cleanup(self):
+        self.ledger.releaseAll()
         if not self.lvActivator.deactivateAll():
             Util.log("ERROR deactivating LVs while cleaning up")
 
+    def beginGC(self):
+        lvmshell.start()
+
+    def endGC(self):
+        lvmshell.stop()
+
     def needUpdateBlockInfo(self):
         for vdi in self.vdis.values():
             if vdi.scanError or vdi.raw or len(vdi.children) == 0:
@@ -2078,7 +3295,16 @@ class LVHDSR(SR):
             self.cleanup()
 
     def scan(self, force = False):
-        vdis = self._scan(force)
+        vdis = None
+        if self._useIncrementalScan():
+            vdis, uuidsPresent = self._scanIncremental()
+        if vdis == None:
+            seqno = lvutil.getVGSeqno(self.vgName)
+            vdis = self._scan(force)
+            uuidsPresent = vdis.keys()
+            self._scanSeqno = seqno
+            self._scanState = self._getScanState()
+            self._lastFullScan = time.time()
         for uuid, vdiInfo in vdis.iteritems():
             vdi = self.getVDI(uuid)
             if not vdi:
@@ -2087,7 +3313,7 @@ class LVHDSR(SR):
                         vdiInfo.vdiType == vhdutil.VDI_TYPE_RAW)
                 self.vdis[uuid] = vdi
             vdi.load(vdiInfo)
-        self._removeStaleVDIs(vdis.keys())
+        self._removeStaleVDIs(uuidsPresent)
         self._buildTree(force)
         self.logFilter.logState()
         self._handleInterruptedCoalesceLeaf()
@@ -2108,6 +3334,53 @@ class LVHDSR(SR):
             return vdis
         raise util.SMException("Scan error")
 
+    def _getScanState(self):
+        """Get the LV attributes that change along with the VHD metadata for
+        all VDI LVs (from the LVM cache)"""
+        state = {}
+        for uuid, lvInfo in lvhdutil.getLVInfo(self.lvmCache).iteritems():
+            state[uuid] = (lvInfo.name, lvInfo.size, lvInfo.readonly,
+                    lvInfo.hidden)
+        return state
+
+    def _scanIncremental(self):
+        """Reload only the VDIs whose LVs changed since the last scan: if the
+        VG seqno is unchanged, nothing did. VHD metadata changes that are not
+        accompanied by an LV change are not detected: SM signals these
+        through requestFullScan(). Return (VDI info for the changed VDIs, UUIDs
+        of all VDIs present), or (None, None) if a full scan is needed"""
+        seqno = lvutil.getVGSeqno(self.vgName)
+        if seqno == self._scanSeqno:
+            Util.log("Incremental scan: VG unchanged")
+            changed = []
+        else:
+            self.lvmCache.refresh()
+            state = self._getScanState()
+            changed = []
+            for uuid, sig in state.iteritems():
+                vdi = self.getVDI(uuid)
+                if not vdi or vdi.scanError or \
+                        self._scanState.get(uuid) != sig:
+                    changed.append(uuid)
+            if len(changed) > self.SCAN_INCREMENTAL_MAX:
+                Util.log("%d LVs changed, doing a full scan" % len(changed))
+                return (None, None)
+            self._scanState = state
+            self._scanSeqno = seqno
+
+        vdis = lvhdutil.getVDIInfoPartial(self.lvmCache, changed)
+        for uuid, vdiInfo in vdis.iteritems():
+            if vdiInfo.scanError:
+                Util.log("Failed to reload %s, doing a full scan" % uuid)
+                return (None, None)
+        Util.log("Incremental scan: %d/%d VDIs changed" % \
+                (len(changed), len(self._scanState)))
+        # the physical utilization of the others is reloaded on demand
+        for uuid, vdi in self.vdis.iteritems():
+            if not vdis.get(uuid):
+                vdi._sizeVHD = -1
+        return (vdis, self._scanState.keys())
+
     def _removeStaleVDIs(self, uuidsPresent):
         for uuid in self.vdis.keys():
             if not uuid in uuidsPresent:
@@ -2246,12 +3519,19 @@ class LVHDSR(SR):
         try to check all slaves, including those that the Agent believes are
         offline, but ignore failures for offline hosts. This is to avoid cases
         where the Agent thinks a host is offline but the host is up."""
-        args = {"vgName" : self.vgName,
-                "action1": "deactivateNoRefcount",
-                "lvName1": vdi.fileName,
-                "action2": "cleanupLock",
-                "uuid2"  : vdi.uuid,
-                "ns2"    : lvhdutil.NS_PREFIX_LVM + self.uuid}
+        self._checkSlavesMany([vdi])
+
+    def _checkSlavesMany(self, vdiList):
+        "Like _checkSlaves, for all VDIs in vdiList with one call per slave"
+        args = {"vgName" : self.vgName}
+        i = 1
+        for vdi in vdiList:
+            args["action%d" % i] = "deactivateNoRefcount"
+            args["lvName%d" % i] = vdi.fileName
+            args["action%d" % (i + 1)] = "cleanupLock"
+            args["uuid%d" % (i + 1)] = vdi.uuid
+            args["ns%d" % (i + 1)] = lvhdutil.NS_PREFIX_LVM + self.uuid
+            i += 2
         onlineHosts = self.xapi.getOnlineHosts()
         abortFlag = IPCFlag(self.uuid)
         for pbdRecord in self.xapi.getAttachedPBDs():
@@ -2260,7 +3540,8 @@ class LVHDSR(SR):
                 continue
             if abortFlag.test(FLAG_TYPE_ABORT):
                 raise AbortException("Aborting due to signal")
-            Util.log("Checking with slave %s (path %s)" % (hostRef, vdi.path))
+            Util.log("Checking with slave %s (%d VDIs)" % (hostRef, 
+                    len(vdiList)))
             try:
                 self.xapi.ensureInactive(hostRef, args)
             except XenAPI.Failure:
@@ -2285,13 +3566,12 @@ class LVHDSR(SR):
                 "lvName3": child.fileName,
                 "action4": "refresh",
                 "lvName4": parent.fileName}
-        for slave in slaves:
-            Util.log("Updating %s, %s, %s on slave %s" % \
-                    (tmpName, child.fileName, parent.fileName, slave))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
-            Util.log("call-plugin returned: '%s'" % text)
+        Util.log("Updating %s, %s, %s on slaves %s" % \
+                (tmpName, child.fileName, parent.fileName, slaves))
+        util.call_plugin_on_hosts(self.xapi.session, slaves,
+                self.xapi.PLUGIN_ON_SLAVE, "multi", args).check()
 
+    @timedPhase(GCProgress.PHASE_RENAME)
     def _updateSlavesOnRename(self, vdi, oldNameLV):
         slaves = util.get_slaves_attached_on(self.xapi.session, [vdi.uuid])
         if not slaves:
@@ -2303,13 +3583,12 @@ class LVHDSR(SR):
                 "lvName1": oldNameLV,
                 "action2": "refresh",
                 "lvName2": vdi.fileName}
-        for slave in slaves:
-            Util.log("Updating %s to %s on slave %s" % \
-                    (oldNameLV, vdi.fileName, slave))
-            text = self.xapi.session.xenapi.host.call_plugin( \
-                    slave, self.xapi.PLUGIN_ON_SLAVE, "multi", args)
-            Util.log("call-plugin returned: '%s'" % text)
+        Util.log("Updating %s to %s on slaves %s" % \
+                (oldNameLV, vdi.fileName, slaves))
+        util.call_plugin_on_hosts(self.xapi.session, slaves,
+                self.xapi.PLUGIN_ON_SLAVE, "multi", args).check()
 
+    @timedPhase(GCProgress.PHASE_RESIZE)
     def _updateSlavesOnResize(self, vdi):
         uuids = map(lambda x: x.uuid, vdi.getAllLeaves())
         slaves = util.get_slaves_attached_on(self.xapi.session, uuids)
@@ -2330,6 +3609,7 @@ def daemonize():
         os.waitpid(pid, 0)
         Util.log("New PID [%d]" % pid)
         return False
+    lvmshell.afterFork()
     os.chdir("/")
     os.setsid()
     pid = os.fork()
@@ -2347,6 +3627,367 @@ def daemonize():
     sys.stdout = open("/dev/null", 'w')
     return True
 
+def requestFullScan(srUuid):
+    """Tell GC that VHD metadata in the SR may have changed in a way that an
+    incremental scan would not pick up (e.g. a VHD was marked hidden)"""
+    IPCFlag(NS_PREFIX_SCAN + srUuid).set(FLAG_TYPE_RESCAN)
+
+################################################################################
+#
+#  GC service
+#
+class ForkHelper:
+    """A process forked by the GC service before it starts any thread, which
+    forks the abortable processes (see Util.startAbortable) on behalf of the
+    service's threads: a fork of the threaded service itself could inherit 
+    locks held by other threads at the time, never to be released. Each 
+    request is a (function, args) pair sent pickled over a pipe; the helper
+    replies with the PID of the new process, and reaps its children itself"""
+
+    REAP_INTERVAL = 1 # seconds
+
+    def __init__(self):
+        (reqRead, reqWrite) = os.pipe()
+        (repRead, repWrite) = os.pipe()
+        self.mutex = threading.Lock()
+        self.pid = os.fork()
+        if not self.pid:
+            try:
+                os.close(reqWrite)
+                os.close(repRead)
+                lvmshell.afterFork()
+                self._serve(os.fdopen(reqRead, 'r'), os.fdopen(repWrite, 'w'))
+            finally:
+                os._exit(0)
+        os.close(reqRead)
+        os.close(repWrite)
+        self.requests = os.fdopen(reqWrite, 'w')
+        self.replies = os.fdopen(repRead, 'r')
+
+    def fork(self, func, args):
+        """Run func(*args) (which must not return) in a new process. Return 
+        the PID of the process"""
+        data = cPickle.dumps((func, args))
+        self.mutex.acquire()
+        try:
+            self.requests.write("%d\n%s" % (len(data), data))
+            self.requests.flush()
+            reply = self.replies.readline().strip()
+        finally:
+            self.mutex.release()
+        if not reply:
+            raise util.SMException("GC fork helper died")
+        if reply.startswith("E "):
+            raise OSError(reply[2:])
+        return int(reply)
+
+    def stop(self):
+        self.requests.close()
+        self.replies.close()
+        os.waitpid(self.pid, 0)
+
+    def _serve(self, requests, replies):
+        # NB. there is only ever one request in flight (see fork()), so no 
+        # request can get stuck in the read buffer while we select
+        while True:
+            (readable, w, x) = select.select([requests], [], [],
+                    self.REAP_INTERVAL)
+            self._reap()
+            if not readable:
+                continue
+            line = requests.readline()
+            if not line:
+                return # the service is gone
+            (func, args) = cPickle.loads(requests.read(int(line)))
+            try:
+                pid = os.fork()
+            except OSError, e:
+                replies.write("E %s\n" % e)
+                replies.flush()
+                continue
+            if not pid:
+                try:
+                    func(*args)
+                finally:
+                    os._exit(1)
+            replies.write("%d\n" % pid)
+            replies.flush()
+
+    def _reap(self):
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                return # no children
+            if not pid:
+                return
+
+class GCService:
+    """A long-running process that does GC/coalesce for all SRs on this host
+    on request, so that kicking GC doesn't need to fork a process that logs 
+    in to XAPI and scans the SR from scratch every time. The SR objects (with
+    their XAPI sessions and scan state) are kept between requests. Each SR is
+    handled in its own thread; the main loop only accepts requests. 
+    
+    A request is one line "<command> <SR UUID>" over a Unix socket, to which
+    the service replies with one line. The service exits after being idle for 
+    IDLE_TIMEOUT, and is started again on demand by gc()"""
+
+    SOCKET_PATH = "/var/run/sm/gc.sock"
+    LOCK_TYPE_SERVICE = "gc-service"
+
+    CMD_GC = "gc"         # reply "ok"
+    CMD_ABORT = "abort"   # reply "ok" once no GC is running in the SR
+    CMD_QUERY = "query"   # reply STATE_RUNNING or STATE_IDLE
+    STATE_RUNNING = "running"
+    STATE_IDLE = "idle"
+    REPLY_OK = "ok"
+    REPLY_ERROR = "error"
+
+    POLL_INTERVAL = 5
+    IDLE_TIMEOUT = 30 * 60
+    REQUEST_TIMEOUT = 10
+    CLIENT_TIMEOUT = 2 # the service answers every request right away
+
+    def __init__(self):
+        self.srs = {}     # SR UUID -> SR, kept between GC runs
+        self.workers = {} # SR UUID -> thread doing GC
+        self.pending = {} # SR UUID -> True if kicked again while running
+        self.stale = {}   # SR UUID -> True if to be dropped after the run
+        self.mutex = threading.Lock()
+        self.lastActive = time.time()
+
+    def run(self, srUuid = None):
+        """Serve requests until idle, starting with GC on srUuid. Return 
+        False if another instance of the service is already running"""
+        global forker
+        serviceLock = lock.Lock(self.LOCK_TYPE_SERVICE)
+        if not serviceLock.acquireNoblock():
+            return False
+        # before any thread is started
+        forker = ForkHelper()
+        try:
+            if util.pathexists(self.SOCKET_PATH):
+                os.unlink(self.SOCKET_PATH) # left over by a dead instance
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.bind(self.SOCKET_PATH)
+                os.chmod(self.SOCKET_PATH, 0600)
+                sock.listen(16)
+                Util.log("GC service started")
+                if srUuid:
+                    self._kick(srUuid)
+                self._serve(sock)
+            finally:
+                os.unlink(self.SOCKET_PATH)
+                sock.close()
+        finally:
+            forker.stop()
+            forker = None
+            serviceLock.release()
+        Util.log("GC service exiting")
+        return True
+
+    def _serve(self, sock):
+        while True:
+            (readable, w, x) = select.select([sock], [], [], self.POLL_INTERVAL)
+            if sock in readable:
+                (conn, addr) = sock.accept()
+                self.lastActive = time.time()
+                try:
+                    self._handle(conn)
+                except (socket.error, util.SMException):
+                    Util.logException("GCService")
+                    conn.close()
+
+            self.mutex.acquire()
+            try:
+                if self.workers:
+                    self.lastActive = time.time()
+                elif time.time() - self.lastActive > self.IDLE_TIMEOUT:
+                    break
+            finally:
+                self.mutex.release()
+
+        # drop the SRs while we can still log out of the XAPI sessions
+        self.srs.clear()
+
+    def _handle(self, conn):
+        """Handle one request. Requests that can take a while are handled in
+        a separate thread so as not to hold up the others"""
+        conn.settimeout(self.REQUEST_TIMEOUT)
+        fields = conn.makefile('r').readline().split()
+        if len(fields) != 2:
+            self._reply(conn, "%s: bad request" % self.REPLY_ERROR)
+            return
+        (cmd, srUuid) = fields
+        if cmd == self.CMD_GC:
+            self._kick(srUuid)
+            self._reply(conn, self.REPLY_OK)
+        elif cmd == self.CMD_QUERY:
+            self.mutex.acquire()
+            try:
+                running = self.workers.has_key(srUuid)
+            finally:
+                self.mutex.release()
+            if running:
+                self._reply(conn, self.STATE_RUNNING)
+            else:
+                self._reply(conn, self.STATE_IDLE)
+        elif cmd == self.CMD_ABORT:
+            self._abort(srUuid)
+            self._reply(conn, self.REPLY_OK)
+        else:
+            self._reply(conn, "%s: unknown command %s" % \
+                    (self.REPLY_ERROR, cmd))
+
+    def _reply(self, conn, text):
+        try:
+            conn.sendall("%s\n" % text)
+        finally:
+            conn.close()
+
+    def _kick(self, srUuid):
+        self.mutex.acquire()
+        try:
+            if self.workers.has_key(srUuid):
+                # it might be just about to finish: make it go round again
+                self.pending[srUuid] = True
+                return
+            thread = threading.Thread(target = self._work, args = (srUuid,))
+            thread.setDaemon(True)
+            self.workers[srUuid] = thread
+            thread.start()
+        finally:
+            self.mutex.release()
+
+    def _work(self, srUuid):
+        while True:
+            try:
+                self._gc(srUuid)
+            except AbortException:
+                Util.log("Aborted")
+                self._dropSR(srUuid)
+            except Exception:
+                Util.logException("gc")
+                Util.log("* * * * * SR %s: ERROR\n" % srUuid)
+                self._dropSR(srUuid)
+
+            self.mutex.acquire()
+            try:
+                if self.stale.has_key(srUuid):
+                    del self.stale[srUuid]
+                    self._dropSR(srUuid)
+                if not self.pending.get(srUuid):
+                    del self.workers[srUuid]
+                    return
+                del self.pending[srUuid]
+            finally:
+                self.mutex.release()
+
+    def _gc(self, srUuid):
+        Util.log("=== SR %s: gc (service) ===" % srUuid)
+        sr = self.srs.get(srUuid)
+        if not sr:
+            sr = SR.getInstance(srUuid, None)
+            sr.incrementalScan = True
+            self.srs[srUuid] = sr
+        if not sr.gcEnabled():
+            return
+
+        sr.cleanupCache()
+        try:
+            _gcLoop(sr, False)
+        finally:
+            sr.cleanup()
+            sr.logFilter.logState()
+
+    def _dropSR(self, srUuid):
+        if self.srs.has_key(srUuid):
+            del self.srs[srUuid]
+
+    def _abort(self, srUuid):
+        """Forget the state of the SR (which may be invalidated by whatever
+        the requester is about to do). Any GC running in it is stopped by
+        the requester, through the abort flag and the running lock, as for
+        a GC process: the worker drops the SR when it is done"""
+        self.mutex.acquire()
+        try:
+            if self.pending.has_key(srUuid):
+                del self.pending[srUuid]
+            if self.workers.has_key(srUuid):
+                Util.log("SR %s changing under the GC service" % srUuid)
+                self.stale[srUuid] = True
+                requestFullScan(srUuid)
+            else:
+                self._dropSR(srUuid)
+        finally:
+            self.mutex.release()
+
+
+def _serviceRequest(cmd, srUuid):
+    """Send a request to the GC service. Return the reply, or None if the 
+    service is not running"""
+    if not util.pathexists(GCService.SOCKET_PATH):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.settimeout(GCService.CLIENT_TIMEOUT)
+            sock.connect(GCService.SOCKET_PATH)
+            sock.sendall("%s %s\n" % (cmd, srUuid))
+            return sock.makefile('r').readline().strip()
+        except socket.error, e:
+            Util.log("GC service request '%s' failed: %s" % (cmd, e))
+            return None
+    finally:
+        sock.close()
+
+def _serviceAbort(srUuid):
+    reply = _serviceRequest(GCService.CMD_ABORT, srUuid)
+    if reply and reply != GCService.REPLY_OK:
+        raise util.SMException("SR %s: error aborting GC service: %s" % \
+                (srUuid, reply))
+
+def _startService(srUuid):
+    """Run the GC service (in this process, which must be a fresh one: see
+    gc()), with GC kicked off on srUuid. Return False if GC on srUuid could
+    not be handed over to the service"""
+    if GCService().run(srUuid):
+        return True
+    # another process is running the service (or just starting it)
+    for i in range(SR.LOCK_RETRY_ATTEMPTS):
+        if _serviceRequest(GCService.CMD_GC, srUuid) == GCService.REPLY_OK:
+            return True
+        time.sleep(1)
+    return False
+
+def _execService(srUuid):
+    """Replace this process with one running the GC service (or else GC on
+    srUuid, as gc() does). Return only if that could not be done"""
+    # leave behind the descriptors inherited from the SM driver (XAPI
+    # sessions, LVM shell pipes...), but only if the exec succeeds
+    for fd in range(3, os.sysconf("SC_OPEN_MAX")):
+        try:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        except IOError:
+            pass # not open
+    try:
+        os.execv(CLEANUP_SCRIPT, [CLEANUP_SCRIPT, "--service", "-u", srUuid])
+    except OSError, e:
+        Util.log("Failed to exec %s: %s" % (CLEANUP_SCRIPT, e))
+
+def _service(srUuid):
+    try:
+        if not _startService(srUuid):
+            _gc(None, srUuid, False)
+    except AbortException:
+        Util.log("Aborted")
+    except Exception:
+        Util.logException("gc")
+        Util.log("* * * * * SR %s: ERROR\n" % srUuid)
+
 def normalizeType(type):
     if type in LVHDSR.SUBTYPES:
         type = SR.TYPE_LVHD
@@ -2361,56 +4002,75 @@ def normalizeType(type):
 
 def _gcLoop(sr, dryRun):
     failedCandidates = []
-    while True:
-        if not sr.xapi.poolOK():
-            Util.log("Pool is not ready, exiting")
-            break
-        if not sr.xapi.isPluggedHere():
-            Util.log("SR no longer attached, exiting")
-            break
-        sr.scanLocked()
-        if not sr.hasWork():
-            Util.log("No work, exiting")
-            break
-
-        if not lockRunning.acquireNoblock():
-            Util.log("Another instance already running, exiting")
-            break
-        try:
-            if not sr.gcEnabled():
+    lockRunning = init(sr.uuid)
+    abortFlag = IPCFlag(sr.uuid)
+    sr.progress.reset()
+    sr.beginGC()
+    try:
+        while True:
+            if abortFlag.test(FLAG_TYPE_ABORT):
+                raise AbortException("Aborting due to signal")
+            if not sr.xapi.poolOK():
+                Util.log("Pool is not ready, exiting")
+                break
+            if not sr.xapi.isPluggedHere():
+                Util.log("SR no longer attached, exiting")
                 break
-            sr.cleanupCoalesceJournals()
             sr.scanLocked()
-            sr.updateBlockInfo()
+            if not sr.hasWork():
+                Util.log("No work, exiting")
+                break
 
-            if len(sr.findGarbage()) > 0:
-                sr.garbageCollect(dryRun)
-                sr.xapi.srUpdate()
-                continue
+            if not lockRunning.acquireNoblock():
+                Util.log("Another instance already running, exiting")
+                break
+            try:
+                if not sr.gcEnabled():
+                    break
+                sr.progress.startRun(sr.xapi)
+                if not _gcStep(sr, dryRun):
+                    Util.log("No work left")
+                    sr.cleanup()
+            finally:
+                lockRunning.release()
+    finally:
+        sr.progress.endRun()
+        sr.endGC()
 
-            candidate = sr.findCoalesceable()
-            if candidate:
-                util.fistpoint.activate("LVHDRT_finding_a_suitable_pair",sr.uuid)
-                sr.coalesce(candidate, dryRun)
-                sr.xapi.srUpdate()
-                continue
+def _gcStep(sr, dryRun):
+    """One round of the GC loop: collect all garbage, or else coalesce, or 
+    else leaf-coalesce. Return False if there was nothing to do. (Also used 
+    by the GC planner, gcplan.py, to replay the decisions on an SR model)"""
+    sr.cleanupCoalesceJournals()
+    sr.scanLocked()
+    sr.updateBlockInfo()
 
-            candidate = sr.findLeafCoalesceable()
-            if candidate:
-                sr.coalesceLeaf(candidate, dryRun)
-                sr.xapi.srUpdate()
-                continue
+    if len(sr.findGarbage()) > 0:
+        sr.garbageCollect(dryRun)
+        sr.xapi.srUpdate()
+        return True
 
-            Util.log("No work left")
-            sr.cleanup()
-        finally:
-            lockRunning.release()
+    candidates = sr.findCoalesceables(sr.getCoalesceConcurrency())
+    if candidates:
+        util.fistpoint.activate("LVHDRT_finding_a_suitable_pair",sr.uuid)
+        sr.coalesceMany(candidates, dryRun)
+        sr.xapi.srUpdate()
+        return True
+
+    candidate = sr.findLeafCoalesceable()
+    if candidate:
+        sr.coalesceLeaf(candidate, dryRun)
+        sr.xapi.srUpdate()
+        return True
+
+    return False
 
 def _gc(session, srUuid, dryRun):
     init(srUuid)
     sr = SR.getInstance(srUuid, session)
     if not sr.gcEnabled(False):
         return
+    sr.incrementalScan = True
 
     sr.cleanupCache()
     try:
@@ -2424,7 +4084,7 @@ def _abort(srUuid):
     """If successful, we return holding lockRunning; otherwise exception
     raised."""
     Util.log("=== SR %s: abort ===" % (srUuid))
-    init(srUuid)
+    lockRunning = init(srUuid)
     if not lockRunning.acquireNoblock():
         gotLock = False
         Util.log("Aborting currently-running instance (SR %s)" % srUuid)
@@ -2441,9 +4101,10 @@ def _abort(srUuid):
                     srUuid)
 
 def init(srUuid):
-    global lockRunning
-    if not lockRunning:
-        lockRunning = lock.Lock(LOCK_TYPE_RUNNING, srUuid) 
+    "Return the process lock for SR srUuid"
+    if not locksRunning.has_key(srUuid):
+        locksRunning[srUuid] = lock.Lock(LOCK_TYPE_RUNNING, srUuid) 
+    return locksRunning[srUuid]
 
 def usage():
     output = """Garbage collect and/or coalesce VHDs in a VHD-based SR
@@ -2455,6 +4116,7 @@ Parameters:
     -G --gc_force    garbage collect once, aborting any current operations
     -a --abort       abort any currently running operation (GC or coalesce)
     -q --query       query the current state (GC'ing, coalescing or not running)
+                     and the progress/phase timings of the current or last run
     -x --disable     disable GC/coalesce (will be in effect until you exit)
     -t --debug       see Debug below
 
@@ -2485,9 +4147,10 @@ Debug:
 def abort(srUuid):
     """Abort GC/coalesce if we are currently GC'ing or coalescing a VDI pair.
     """
+    _serviceAbort(srUuid)
     _abort(srUuid)
     Util.log("abort: releasing the process lock")
-    lockRunning.release()
+    init(srUuid).release()
 
 def gc(session, srUuid, inBackground, dryRun = False):
     """Garbage collect all deleted VDIs in SR "srUuid". Fork & return 
@@ -2506,12 +4169,19 @@ def gc(session, srUuid, inBackground, dryRun = False):
     """
     Util.log("=== SR %s: gc ===" % srUuid)
     if inBackground:
+        # hand the SR over to the GC service, starting it if necessary
+        if not dryRun and _serviceRequest(GCService.CMD_GC, srUuid) == "ok":
+            return
         if daemonize():
             # we are now running in the background. Catch & log any errors 
             # because there is no other way to propagate them back at this 
             # point
             
             try:
+                if not dryRun:
+                    # NB. the service outlives this request: run it in a
+                    # clean process rather than in a fork of the SM driver
+                    _execService(srUuid)
                 _gc(None, srUuid, dryRun)
             except AbortException:
                 Util.log("Aborted")
@@ -2532,7 +4202,9 @@ def gc_force(session, srUuid, force = False, dryRun = False, lockSR = False):
     4. return
     """
     Util.log("=== SR %s: gc_force ===" % srUuid)
-    init(srUuid)
+    lockRunning = init(srUuid)
+    # the state the GC service keeps for the SR is not valid after this
+    _serviceAbort(srUuid)
     sr = SR.getInstance(srUuid, session, lockSR, True)
     if not lockRunning.acquireNoblock():
         _abort(srUuid)
@@ -2544,10 +4216,12 @@ def gc_force(session, srUuid, force = False, dryRun = False, lockSR = False):
     sr.scanLocked(force)
     sr.cleanupCoalesceJournals()
 
+    sr.progress.startRun(sr.xapi)
     try:
         sr.cleanupCache()
         sr.garbageCollect(dryRun)
     finally:
+        sr.progress.endRun()
         sr.cleanup()
         sr.logFilter.logState()
         lockRunning.release()
@@ -2557,7 +4231,10 @@ def get_state(srUuid):
     is not guaranteed for any length of time if the call is not protected by
     locking.
     """
-    init(srUuid)
+    # the GC service doesn't hold the lock between GC iterations
+    if _serviceRequest(GCService.CMD_QUERY, srUuid) == GCService.STATE_RUNNING:
+        return True
+    lockRunning = init(srUuid)
     if lockRunning.acquireNoblock():
         lockRunning.release()
         return False
@@ -2568,13 +4245,11 @@ def should_preempt(session, srUuid):
     entries = sr.journaler.getAll(VDI.JRN_COALESCE)
     if len(entries) == 0:
         return False
-    elif len(entries) > 1:
-        raise util.SMException("More than one coalesce entry: " + entries)
+    # there is one entry for each VDI being coalesced concurrently
     sr.scanLocked()
-    coalescedUuid = entries.popitem()[0]
     garbage = sr.findGarbage()
     for vdi in garbage:
-        if vdi.uuid == coalescedUuid:
+        if entries.has_key(vdi.uuid):
             return True
     return False
 
@@ -2632,7 +4307,8 @@ def main():
     vdi_uuid   = ""
     shortArgs  = "gGaqxu:bfdt:v:"
     longArgs   = ["gc", "gc_force", "abort", "query", "disable",
-            "uuid=", "background", "force", "dry-run", "debug=", "vdi_uuid="]
+            "uuid=", "background", "force", "dry-run", "debug=", "vdi_uuid=",
+            "service"]
 
     try:
         opts, args = getopt.getopt(sys.argv[1:], shortArgs, longArgs)
@@ -2649,6 +4325,8 @@ def main():
             action = "query"
         if o in ("-x", "--disable"):
             action = "disable"
+        if o == "--service":
+            action = "service"
         if o in ("-u", "--uuid"):
             uuid = a
         if o in ("-b", "--background"):
@@ -2670,6 +4348,11 @@ def main():
             action != "debug" and (debug_cmd or vdi_uuid):
         usage()
 
+    if action == "service":
+        # started by gc() in the background, with nowhere to print to
+        _service(uuid)
+        return
+
     if action != "query" and action != "debug":
         print "All output goes in %s" % LOG_FILE
 
@@ -2681,12 +4364,15 @@ def main():
         abort(uuid)
     elif action == "query":
         print "Currently running: %s" % get_state(uuid)
+        for line in GCProgress.getReport(uuid):
+            print line
     elif action == "disable":
         print "Disabling GC/coalesce for %s" % uuid
+        _serviceAbort(uuid)
         _abort(uuid)
         raw_input("Press enter to re-enable...")
         print "GC/coalesce re-enabled"
-        lockRunning.release()
+        init(uuid).release()
     elif action == "debug":
         debug(uuid, debug_cmd, vdi_uuid)
 
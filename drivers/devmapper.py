@@ -0,0 +1,220 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Device-mapper device inventory read from sysfs.
+#
+# Every mapped device appears as /sys/block/dm-<minor>, with its name in
+# dm/name and the devices stacked on top of it in holders/. The inventory
+# indexes the devices by name, and keeps the index up to date: a hit is
+# confirmed by re-reading the name of that one device (minors, and so dm-N
+# entries, are reused as soon as a device is removed), while a miss re-reads
+# the names of all dm-* entries, since any of them may have been reused for
+# another device since it was indexed. This answers "is this LV mapped"
+# without forking dmsetup.
+#
+
+import os
+
+import util
+
+SYS_BLOCK = "/sys/block"
+DEV_MAPPER = "/dev/mapper"
+
+def getDMName(path):
+    """The device-mapper name of LV /dev/<VG>/<LV>: "<VG>-<LV>" with any "-"
+    in the names doubled"""
+    return path[5:].replace("-", "--").replace("/", "-")
+
+def getInventory():
+    "The inventory of this process"
+    global _inventory
+    if not _inventory:
+        _inventory = DMInventory()
+    return _inventory
+
+_inventory = None
+
+
+class DMInventory:
+    """Index of the device-mapper devices of this host by name"""
+
+    def __init__(self):
+        self.devs = {}  # name -> sysfs entry ("dm-N")
+        self.names = {} # sysfs entry -> name
+        self._update()
+
+    def lookup(self, name):
+        """Return the sysfs entry ("dm-N") of device 'name', or None if there
+        is no such device"""
+        dev = self.devs.get(name)
+        if dev:
+            if self._readName(dev) == name:
+                return dev
+        self._update()
+        return self.devs.get(name)
+
+    def exists(self, name):
+        return self.lookup(name) != None
+
+    def getHolders(self, name):
+        """Names of the devices holding device 'name' open (stacked on it),
+        or None if there is no such device"""
+        dev = self.lookup(name)
+        if not dev:
+            return None
+        holders = []
+        try:
+            entries = os.listdir(os.path.join(SYS_BLOCK, dev, "holders"))
+        except OSError:
+            return None
+        for entry in entries:
+            holders.append(self._readName(entry) or entry)
+        return holders
+
+    def getSlaves(self, name):
+        """Paths of the block devices underneath device 'name', or None if
+        there is no such device"""
+        dev = self.lookup(name)
+        if not dev:
+            return None
+        try:
+            entries = os.listdir(os.path.join(SYS_BLOCK, dev, "slaves"))
+        except OSError:
+            return None
+        slaves = []
+        for entry in entries:
+            slaveName = None
+            if entry.startswith("dm-"):
+                slaveName = self._readName(entry)
+            if slaveName:
+                slaves.append(os.path.join(DEV_MAPPER, slaveName))
+            else:
+                slaves.append(os.path.join("/dev", entry.replace("!", "/")))
+        return slaves
+
+    def getNames(self, prefix = ""):
+        """Names of all current devices starting with 'prefix'"""
+        self._update()
+        return filter(lambda x: x.startswith(prefix), self.devs.keys())
+
+    def _update(self):
+        try:
+            current = filter(lambda x: x.startswith("dm-"),
+                    os.listdir(SYS_BLOCK))
+        except OSError, e:
+            raise util.SMException("Failed to list %s: %s" % (SYS_BLOCK, e))
+        devs = {}
+        names = {}
+        for dev in current:
+            name = self._readName(dev)
+            if name:
+                devs[name] = dev
+                names[dev] = name
+        self.devs = devs
+        self.names = names
+
+    def _readName(self, dev):
+        try:
+            f = open(os.path.join(SYS_BLOCK, dev, "dm", "name"), 'r')
+            try:
+                return f.read().strip()
+            finally:
+                f.close()
+        except IOError:
+            return None # just removed
+
+
+###########################################################################
+#
+#  Unit tests
+#
+def _runTests():
+    """Unit testing, on a fake /sys/block"""
+    import tempfile
+    import shutil
+    global SYS_BLOCK
+    print "Running unit tests..."
+
+    def mkdev(dev, name, holders = [], slaves = []):
+        os.makedirs(os.path.join(SYS_BLOCK, dev, "dm"))
+        f = open(os.path.join(SYS_BLOCK, dev, "dm", "name"), 'w')
+        f.write(name + "\n")
+        f.close()
+        for subdir, entries in [("holders", holders), ("slaves", slaves)]:
+            os.makedirs(os.path.join(SYS_BLOCK, dev, subdir))
+            for entry in entries:
+                os.mkdir(os.path.join(SYS_BLOCK, dev, subdir, entry))
+
+    def rmdev(dev):
+        shutil.rmtree(os.path.join(SYS_BLOCK, dev))
+
+    savedSysBlock = SYS_BLOCK
+    SYS_BLOCK = tempfile.mkdtemp()
+    try:
+        lv1 = getDMName("/dev/VG_XenStorage-a/VHD-1")
+        lv2 = getDMName("/dev/VG_XenStorage-a/VHD-2")
+        if lv1 != "VG_XenStorage--a-VHD--1":
+            print "getDMName failed: %s" % lv1
+            return 1
+        os.mkdir(os.path.join(SYS_BLOCK, "sda"))
+        mkdev("dm-0", lv1, slaves = ["sdb"])
+        mkdev("dm-1", lv2, holders = ["dm-2"], slaves = ["dm-0"])
+        mkdev("dm-2", "other")
+
+        inv = DMInventory()
+        if inv.lookup(lv1) != "dm-0" or not inv.exists(lv2) or \
+                inv.exists("nosuchdev"):
+            print "lookup failed"
+            return 1
+        names = inv.getNames(getDMName("/dev/VG_XenStorage-a/"))
+        names.sort()
+        if names != [lv1, lv2]:
+            print "getNames failed: %s" % names
+            return 1
+        if inv.getHolders(lv2) != ["other"] or inv.getHolders(lv1) != []:
+            print "getHolders failed: %s" % inv.getHolders(lv2)
+            return 1
+        if inv.getSlaves(lv1) != ["/dev/sdb"] or \
+                inv.getSlaves(lv2) != [os.path.join(DEV_MAPPER, lv1)]:
+            print "getSlaves failed: %s" % inv.getSlaves(lv2)
+            return 1
+
+        # a device removed and its minor reused by another one: the new
+        # device is found, even before the old one is looked up
+        rmdev("dm-0")
+        mkdev("dm-0", "VG_XenStorage--a-VHD--3")
+        if inv.lookup("VG_XenStorage--a-VHD--3") != "dm-0":
+            print "reused minor not found"
+            return 1
+        if inv.exists(lv1):
+            print "removed device still found after minor reuse"
+            return 1
+        if inv.getSlaves(lv2) != \
+                [os.path.join(DEV_MAPPER, "VG_XenStorage--a-VHD--3")]:
+            print "getSlaves failed after minor reuse"
+            return 1
+
+        # and removed without reuse
+        rmdev("dm-2")
+        if inv.exists("other") or inv.getHolders(lv2) != ["dm-2"]:
+            print "removed device still found"
+            return 1
+    finally:
+        shutil.rmtree(SYS_BLOCK)
+        SYS_BLOCK = savedSysBlock
+    print "All tests passed"
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(_runTests())
@@ -23,10 +23,18 @@ SEPARATOR = "_"
 
 class Journaler:
     """Simple file-based journaler. A journal is a id-value pair, and there
-    can be only one journal for a given id."""
+    can be only one journal for a given id.
+
+    The directory is listed on every query, since its mtime can't be relied
+    upon to reveal the journals created or removed by others (it may have a 
+    granularity as coarse as a second). What is cached are the values of the
+    journals, which are only read again if the file has changed (a journal
+    removed and created again by another process, or read while it was
+    still being written)."""
 
     def __init__(self, dir):
         self.dir = dir
+        self.values = dict() # journal file name -> (file stamp, value)
 
     def create(self, type, id, val):
         """Create an entry of type "type" for "id" with the value "val".
@@ -48,13 +56,59 @@ class Journaler:
             raise JournalerException("No journal for '%s:%s'" % (type, id))
         path = self._getPath(type, id)
         os.unlink(path)
+        self.values.pop(os.path.basename(path), None)
 
     def get(self, type, id):
         """Get the value for the journal entry of type "type" for "id".
         Return None if no such entry exists"""
-        path = self._getPath(type, id)
-        if not util.pathexists(path):
-            return None
+        return self._getAllEntries().get(type, {}).get(id)
+
+    def getAll(self, type):
+        """Get a mapping id->value for all entries of type "type" """
+        return self._getAllEntries().get(type, {})
+
+    def getAllJournals(self):
+        """Get a mapping type->(id->value) for all entries of all types"""
+        return self._getAllEntries()
+
+    def _getPath(self, type, id):
+        name = "%s%s%s" % (type, SEPARATOR, id)
+        path = os.path.join(self.dir, name)
+        return path
+
+    def _getAllEntries(self):
+        entries = dict()
+        values = dict()
+        for fileName in os.listdir(self.dir):
+            parts = fileName.split(SEPARATOR)
+            if len(parts) != 2 or not parts[0].isalpha():
+                continue # not a journal (e.g. a VHD file)
+            type, id = parts
+            stamp = self._getStamp(self._getPath(type, id))
+            if not stamp:
+                continue # just removed
+            (cachedStamp, val) = self.values.get(fileName, (None, None))
+            if stamp != cachedStamp:
+                val = self._read(self._getPath(type, id))
+                if not val:
+                    continue # being created (or removed) right now
+            values[fileName] = (stamp, val)
+            if not entries.get(type):
+                entries[type] = dict()
+            entries[type][id] = val
+        self.values = values
+        return entries
+
+    def _getStamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _read(self, path):
         try:
             f = open(path, "r")
         except IOError, e:
@@ -63,31 +117,9 @@ class Journaler:
                 return None 
             raise
         val = f.readline()
+        f.close()
         return val
 
-    def getAll(self, type):
-        """Get a mapping id->value for all entries of type "type" """
-        fileList = os.listdir(self.dir)
-        entries = dict()
-        for fileName in fileList:
-            if not fileName.startswith(type):
-                continue
-            parts = fileName.split(SEPARATOR, 2)
-            if len(parts) != 2:
-                raise JournalerException("Bad file name: %s" % fileName)
-            t, id = parts
-            if t != type:
-                continue
-            val = self.get(type, id)
-            if val:
-                entries[id] = val
-        return entries
-
-    def _getPath(self, type, id):
-        name = "%s%s%s" % (type, SEPARATOR, id)
-        path = os.path.join(self.dir, name)
-        return path
-
 
 ###########################################################################
 #
@@ -140,6 +172,39 @@ def _runTests():
     if j.get("modify", "Z"):
         print "remove(Z) failed"
         return 1
+
+    # journals changed by another instance (i.e. process)
+    other = Journaler(dir)
+    j.create("relink", "X", "1")
+    if other.get("relink", "X") != "1":
+        print "create by another failed"
+        return 1
+    j.remove("relink", "X")
+    if other.get("relink", "X") or other.getAll("relink"):
+        print "remove by another failed"
+        return 1
+    j.create("relink", "X", "1")
+    other.get("relink", "X")
+    j.remove("relink", "X")
+    j.create("relink", "X", "23")
+    if other.get("relink", "X") != "23":
+        print "re-create by another failed"
+        return 1
+    f = open(os.path.join(dir, "relink%sY" % SEPARATOR), "w")
+    f.write("par")
+    f.close()
+    other.get("relink", "Y")
+    f = open(os.path.join(dir, "relink%sY" % SEPARATOR), "a")
+    f.write("tial")
+    f.close()
+    if other.get("relink", "Y") != "partial":
+        print "partially written journal still cached"
+        return 1
+    j.remove("relink", "X")
+    j.remove("relink", "Y")
+    if other.getAllJournals().get("relink"):
+        print "remove all failed"
+        return 1
     print "All tests passed"
     return 0
 
@@ -0,0 +1,595 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Offline GC/coalesce planner: dump the VHD forest of an SR to a JSON file,
+# and replay the decisions of the GC loop (cleanup._gcStep) against such a
+# dump without touching any storage. The SR and VDI classes of cleanup are
+# reused as they are, with only the operations that touch storage or XAPI
+# replaced by ones that update the in-memory model.
+#
+
+import sys
+import time
+import getopt
+import base64
+import zlib
+
+import simplejson
+
+import XenAPI
+import util
+import vhdutil
+import vhdbitmap
+import lvhdutil
+import cleanup
+from cleanup import Util, VDI
+
+DUMP_VERSION = 1
+
+
+################################################################################
+#
+#  Dump
+#
+def dump(srUuid, fileName):
+    """Scan SR srUuid the way GC does and write out its VHD forest"""
+    sr = cleanup.SR.getInstance(srUuid, None)
+    records = []
+    try:
+        sr.scanLocked()
+        for vdi in sr.vdis.values():
+            records.append(_dumpVDI(sr, vdi))
+        journals = sr.journaler.getAllJournals()
+        data = {
+                "version": DUMP_VERSION,
+                "uuid": sr.uuid,
+                "type": sr.TYPE,
+                "time": int(time.time()),
+                "freeSpace": sr.getFreeSpace(),
+                "otherConfig": sr.xapi.srRecord["other_config"],
+                "journals": journals,
+                "vdis": records }
+    finally:
+        sr.cleanup()
+    f = open(fileName, 'w')
+    try:
+        simplejson.dump(data, f)
+    finally:
+        f.close()
+    print "Dumped %d VDIs of SR %s to %s" % (len(records), sr.uuid, fileName)
+
+def _dumpVDI(sr, vdi):
+    rec = {
+            "uuid": vdi.uuid,
+            "parent": vdi.parentUuid,
+            "hidden": bool(vdi.hidden),
+            "raw": bool(vdi.raw),
+            "scanError": bool(vdi.scanError),
+            "sizeVirt": vdi.sizeVirt,
+            "config": {} }
+    if isinstance(vdi, cleanup.LVHDVDI):
+        rec["sizeLV"] = vdi.sizeLV
+    if vdi.raw:
+        rec["sizeVHD"] = vdi.sizeVirt
+        return rec
+
+    bitmap = None
+    if vdi.hidden:
+        # hidden VHDs don't change: use the bitmap GC has stored
+        bitmap = _getConfig(vdi, VDI.DB_VHD_BLOCKS)
+    else:
+        leafClsc = _getConfig(vdi, VDI.DB_LEAFCLSC)
+        if leafClsc:
+            rec["config"][VDI.DB_LEAFCLSC] = leafClsc
+    if not bitmap:
+        bitmap = base64.b64encode(vdi._queryVHDBlocks())
+    rec["bitmap"] = bitmap
+    numBlocks = vhdbitmap.Bitmap.fromCompressed(base64.b64decode(bitmap)).count()
+    rec["blocks"] = numBlocks
+
+    if isinstance(vdi, cleanup.LVHDVDI) and vdi.hidden:
+        # reading the VHD size would mean activating every LV: for hidden
+        # VHDs (deflated to their data) the size follows from the bitmap
+        sizeData = numBlocks * vhdutil.VHD_BLOCK_SIZE
+        rec["sizeVHD"] = sizeData + vhdutil.calcOverheadBitmap(sizeData) + \
+                vhdutil.calcOverheadEmpty(vdi.sizeVirt)
+    else:
+        rec["sizeVHD"] = vdi.getSizeVHD()
+    return rec
+
+def _getConfig(vdi, key):
+    "Get a VDI config value, or None if the VDI has no record in XAPI"
+    try:
+        return vdi.getConfig(key)
+    except XenAPI.Failure:
+        return None
+
+
+################################################################################
+#
+#  SR model
+#
+class PlanXAPI:
+    """Stands in for cleanup.XAPI: the VDI config comes from the dump and
+    changes to it are kept in memory"""
+
+    def __init__(self, srRecord, configs):
+        self.srRecord = srRecord
+        self.configs = configs # VDI UUID -> {key: value}
+        self.session = None
+
+    def poolOK(self):
+        return True
+
+    def isPluggedHere(self):
+        return True
+
+    def isMaster(self):
+        return True
+
+    def srUpdate(self):
+        pass
+
+    def isSnapshot(self, vdi):
+        return False
+
+    def getConfigVDI(self, vdi, key):
+        return self.configs.setdefault(vdi.uuid, {})
+
+    def removeFromConfigVDI(self, vdi, key):
+        config = self.configs.setdefault(vdi.uuid, {})
+        if config.has_key(key):
+            del config[key]
+
+    def addToConfigVDI(self, vdi, key, val):
+        self.configs.setdefault(vdi.uuid, {})[key] = val
+
+    def setConfigSR(self, key, val):
+        pass
+
+
+class PlanJournaler:
+    "Stands in for the SR journaler, with the entries from the dump"
+
+    def __init__(self, entries):
+        self.entries = entries # type -> {id: value}
+
+    def create(self, type, id, val):
+        self.entries.setdefault(type, {})[id] = val
+
+    def remove(self, type, id):
+        entries = self.entries.get(type, {})
+        if entries.has_key(id):
+            del entries[id]
+
+    def get(self, type, id):
+        return self.entries.get(type, {}).get(id)
+
+    def getAll(self, type):
+        return self.entries.get(type, {}).copy()
+
+
+class PlanScheduler(cleanup.CoalesceScheduler):
+    "The coalesce scheduler, without the persistent queue"
+
+    def _load(self):
+        pass
+
+    def _save(self):
+        pass
+
+
+class PlanVDI:
+    "Mixin for the VDI classes of cleanup: a VDI loaded from the dump"
+
+    def loadRecord(self, rec):
+        self.parentUuid = rec["parent"] or ""
+        self.hidden = rec["hidden"]
+        self.scanError = rec["scanError"]
+        self.sizeVirt = rec["sizeVirt"]
+        self._sizeVHD = rec["sizeVHD"]
+        self.bitmap = rec.get("bitmap")
+
+    def getSizeVHD(self):
+        return self._sizeVHD
+
+    def getNumBlocks(self):
+        if not self.bitmap:
+            return 0
+        return self._getBitmap().count()
+
+    def mergeInto(self, parent):
+        """Account for the data of self having been copied into parent"""
+        parent.sizeVirt = max(parent.sizeVirt, self.sizeVirt)
+        if parent.raw:
+            return
+        bitmap = self._getBitmap() | parent._getBitmap()
+        parent.bitmap = base64.b64encode(zlib.compress(bitmap.toString()))
+        parent.delConfig(VDI.DB_VHD_BLOCKS)
+        parent.setSizeData(bitmap.count() * vhdutil.VHD_BLOCK_SIZE)
+
+    def setSizeData(self, sizeData):
+        self._sizeVHD = sizeData + vhdutil.calcOverheadBitmap(sizeData) + \
+                vhdutil.calcOverheadEmpty(self.sizeVirt)
+
+    def inflateFully(self):
+        pass
+
+    def _queryVHDBlocks(self):
+        if not self.bitmap:
+            raise util.SMException("No block bitmap for %s in the dump" % \
+                    self.uuid)
+        return base64.b64decode(self.bitmap)
+
+    def _getBitmap(self):
+        return vhdbitmap.Bitmap.fromCompressed(self._queryVHDBlocks())
+
+
+class PlanFileVDI(PlanVDI, cleanup.FileVDI):
+    pass
+
+
+class PlanLVHDVDI(PlanVDI, cleanup.LVHDVDI):
+
+    def loadRecord(self, rec):
+        PlanVDI.loadRecord(self, rec)
+        self.sizeLV = rec["sizeLV"]
+        self.fileName = lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD] + self.uuid
+        if self.raw:
+            self.fileName = lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_RAW] + \
+                    self.uuid
+        self.lvActive = False
+        self.lvOpen = False
+        self.lvReadonly = False
+
+    def setSizeData(self, sizeData):
+        if self.raw:
+            return
+        PlanVDI.setSizeData(self, sizeData)
+        # deflated by _cleanupCoalesce
+        self.sizeLV = lvhdutil.calcSizeLV(self._sizeVHD)
+
+    def inflateFully(self):
+        if not self.raw:
+            self.sizeLV = lvhdutil.calcSizeVHDLV(self.sizeVirt)
+
+
+class PlanSR:
+    """Mixin for the SR classes of cleanup: an SR loaded from the dump, on
+    which GC operations only update the model and add to the plan.
+    Coalescing takes time at 'rate' bytes/s, during which the guests use up
+    'growth' bytes/s of free space"""
+
+    VDI_CLASS = None
+
+    def __init__(self, data, rate, growth):
+        self.logFilter = cleanup.SR.LogFilter(self)
+        self.uuid = data["uuid"]
+        self.name = self.uuid
+        self.path = ""
+        self.vdis = {}
+        self.vdiTrees = []
+        self._locked = 0
+        self._srLock = None
+        self._failedCoalesceTargets = []
+        self.incrementalScan = False
+        self._scanState = None
+        self._lastFullScan = 0
+        srRecord = {"uuid": self.uuid, "type": data["type"],
+                "other_config": data.get("otherConfig", {})}
+        configs = {}
+        for rec in data["vdis"]:
+            configs[rec["uuid"]] = rec.get("config", {}).copy()
+        self.xapi = PlanXAPI(srRecord, configs)
+        self.journaler = PlanJournaler(data.get("journals", {}))
+        self.scheduler = PlanScheduler(self.uuid)
+        self.progress = cleanup.GCProgress(self.uuid)
+
+        for rec in data["vdis"]:
+            vdi = self.VDI_CLASS(self, rec["uuid"], rec["raw"])
+            vdi.loadRecord(rec)
+            self.vdis[vdi.uuid] = vdi
+        self._buildTree(True)
+        self.numVDIs = len(self.vdis)
+
+        self.rate = rate
+        self.growth = growth
+        self.freeSpace = data["freeSpace"]
+        self.startFree = self.freeSpace
+        self.minFree = self.freeSpace
+        self.fullAt = None
+        self.elapsed = 0.0
+        self.bytesMoved = 0
+        self.numSteps = 0
+        self.numDeleted = 0
+        self.numCoalesced = 0
+        self.numLeafCoalesced = 0
+        self.plan = []
+
+    def scan(self, force = False):
+        pass
+
+    def scanLocked(self, force = False):
+        pass
+
+    def lock(self):
+        pass
+
+    def unlock(self):
+        pass
+
+    def gcEnabled(self, refresh = True):
+        return True
+
+    def getFreeSpace(self):
+        return self.freeSpace
+
+    def needUpdateBlockInfo(self):
+        return False
+
+    def updateBlockInfo(self):
+        pass
+
+    def cleanup(self):
+        pass
+
+    def cleanupCache(self):
+        pass
+
+    def cleanupCoalesceJournals(self):
+        pass
+
+    def cleanupJournals(self, dryRun):
+        pass
+
+    def deleteVDIs(self, vdiList):
+        freed = 0
+        for vdi in vdiList:
+            self._unlinkVDI(vdi)
+            freed += vdi.getSizePhys()
+        self.freeSpace += freed
+        self.numDeleted += len(vdiList)
+        self._addStep("delete %d VDIs, freeing %s" % \
+                (len(vdiList), Util.num2str(freed)))
+
+    def coalesceMany(self, vdiList, dryRun):
+        """The VDIs are coalesced concurrently: all the parents are inflated
+        first, and the copying shares the throughput"""
+        pending = []
+        numBytes = 0
+        for vdi in vdiList:
+            if self.journaler.get(vdi.JRN_RELINK, vdi.uuid):
+                self._relink(vdi)
+                self._addStep("finish the interrupted coalesce of %s" % \
+                        vdi.uuid)
+                continue
+            spaceNeeded = max(vdi._calcExtraSpaceForCoalescing(), 0)
+            sizeCopy = vdi.getNumBlocks() * vhdutil.VHD_BLOCK_SIZE
+            self._addStep("coalesce %s -> %s: copy %s, inflate by %s" % \
+                    (vdi.uuid, vdi.parent.uuid, Util.num2str(sizeCopy),
+                    Util.num2str(spaceNeeded)))
+            self._use(spaceNeeded)
+            pending.append((vdi, spaceNeeded))
+            numBytes += sizeCopy
+        self._copy(numBytes)
+        for vdi, spaceNeeded in pending:
+            parent = vdi.parent
+            sizePhys = parent.getSizePhys()
+            vdi.mergeInto(parent)
+            self.freeSpace += spaceNeeded
+            self._use(parent.getSizePhys() - sizePhys)
+            self._relink(vdi)
+            self.numCoalesced += 1
+
+    def _coalesceLeaf(self, vdi):
+        """The parent takes over the identity of the leaf, which is deleted.
+        Any snapshot-coalescing is assumed to reduce the leaf to a size that
+        can be live-coalesced in one go"""
+        parent = vdi.parent
+        if vdi.canLiveCoalesce():
+            spaceNeeded = vdi._calcExtraSpaceForLeafCoalescing()
+            how = "live"
+        else:
+            spaceNeeded = vdi._calcExtraSpaceForSnapshotCoalescing()
+            how = "snapshot"
+        spaceNeeded = max(spaceNeeded, 0)
+        sizeCopy = vdi.getNumBlocks() * vhdutil.VHD_BLOCK_SIZE
+        self._addStep("leaf-coalesce (%s) %s -> %s: copy %s, needs %s" % \
+                (how, vdi.uuid, parent.uuid, Util.num2str(sizeCopy),
+                Util.num2str(spaceNeeded)))
+        self._use(spaceNeeded)
+        self._copy(sizeCopy)
+        self.freeSpace += spaceNeeded
+
+        sizePhys = parent.getSizePhys()
+        vdi.mergeInto(parent)
+        parent.inflateFully()
+        # like _doCoalesceLeaf, delete the old leaf first only if the space 
+        # is needed for inflating the parent
+        extraSpace = parent.getSizePhys() - sizePhys
+        uuid = vdi.uuid
+        config = self.xapi.configs.get(uuid, {})
+        self._unlinkVDI(vdi)
+        if self.freeSpace < extraSpace:
+            self.freeSpace += vdi.getSizePhys()
+            self._use(extraSpace)
+        else:
+            self._use(extraSpace)
+            self.freeSpace += vdi.getSizePhys()
+        del self.vdis[parent.uuid]
+        self.xapi.configs.pop(parent.uuid, None)
+        parent.uuid = uuid
+        parent.hidden = False
+        self.vdis[uuid] = parent
+        self.xapi.configs[uuid] = config
+        self.numLeafCoalesced += 1
+        return True
+
+    def _relink(self, vdi):
+        for child in vdi.children:
+            child.parent = vdi.parent
+            child.parentUuid = vdi.parent.uuid
+            vdi.parent.children.append(child)
+        vdi.children = []
+        self.journaler.remove(vdi.JRN_RELINK, vdi.uuid)
+
+    def _use(self, size):
+        self.freeSpace -= size
+        self.minFree = min(self.minFree, self.freeSpace)
+        if self.freeSpace < 0 and self.fullAt is None:
+            self.fullAt = self.elapsed
+
+    def _copy(self, numBytes):
+        if not numBytes:
+            return
+        self.bytesMoved += numBytes
+        duration = float(numBytes) / self.rate
+        self.elapsed += duration
+        self._use(int(duration * self.growth))
+
+    def _addStep(self, text):
+        self.plan.append("%8ds  %s" % (self.elapsed, text))
+
+
+class PlanFileSR(PlanSR, cleanup.FileSR):
+    VDI_CLASS = PlanFileVDI
+
+
+class PlanLVHDSR(PlanSR, cleanup.LVHDSR):
+    VDI_CLASS = PlanLVHDVDI
+
+
+def load(fileName, rate, growth):
+    "Load a dump into a PlanFileSR or PlanLVHDSR"
+    f = open(fileName, 'r')
+    try:
+        data = simplejson.load(f)
+    finally:
+        f.close()
+    if data.get("version") != DUMP_VERSION:
+        raise util.SMException("Unsupported dump version: %s" % \
+                data.get("version"))
+    if data["type"] == cleanup.SR.TYPE_LVHD:
+        return PlanLVHDSR(data, rate, growth)
+    return PlanFileSR(data, rate, growth)
+
+def plan(sr):
+    """Replay the GC loop on sr until there is no more work that fits.
+    Return the CPU time spent on the decisions"""
+    # just in case the model stops changing
+    sr.maxSteps = 4 * len(sr.vdis) + 16
+    startTime = time.clock()
+    while sr.numSteps < sr.maxSteps and sr.hasWork():
+        if not cleanup._gcStep(sr, False):
+            break
+        sr.numSteps += 1
+    return time.clock() - startTime
+
+def report(sr, cpuTime):
+    for line in sr.plan:
+        print line
+    print
+    print "Rounds of the GC loop:  %d" % sr.numSteps
+    if sr.numSteps >= sr.maxSteps:
+        print "Gave up after %d rounds: the plan doesn't converge" % \
+                sr.numSteps
+    print "VDIs deleted:           %d" % sr.numDeleted
+    print "VDIs coalesced:         %d" % sr.numCoalesced
+    print "VDIs leaf-coalesced:    %d" % sr.numLeafCoalesced
+    print "Data copied:            %s" % Util.num2str(sr.bytesMoved)
+    print "Time at %s/s:       %ds" % (Util.num2str(sr.rate), sr.elapsed)
+    print "Free space: start %s, minimum %s, end %s" % \
+            (Util.num2str(sr.startFree), Util.num2str(sr.minFree),
+            Util.num2str(sr.freeSpace))
+    print "Peak free space needed: %s" % \
+            Util.num2str(max(sr.startFree - sr.minFree, 0))
+    if sr.fullAt is not None:
+        print "The SR runs out of space after %ds" % sr.fullAt
+    left = filter(lambda x: x.isCoalesceable(), sr.vdis.values())
+    if left:
+        print "Backlog does not drain: %d VDIs left to coalesce" % len(left)
+    else:
+        print "Backlog drains"
+    print "Planning took %.2fs CPU for %d VDIs" % (cpuTime, sr.numVDIs)
+
+def parseSize(val):
+    "Parse a number with an optional K/M/G suffix"
+    val = val.strip().upper()
+    if val and Util.PREFIX.has_key(val[-1]):
+        return long(float(val[:-1]) * Util.PREFIX[val[-1]])
+    return long(val)
+
+
+################################################################################
+#
+#  CLI
+#
+def usage():
+    output = """Plan GC/coalesce of a VHD-based SR offline
+
+    -u --uuid UUID   dump the VHD forest of SR UUID to FILE (on the master)
+    -o --output FILE
+
+    -p --plan FILE   show what GC would do with the dump in FILE
+    -r --rate RATE   coalesce throughput in bytes/s (K/M/G suffix) [50M]
+    -g --growth RATE free space used up by the guests in bytes/s [0]
+    -c --concurrency N  override the SR coalesce-concurrency
+    -l --log FILE    log the GC decisions to FILE [/dev/null]
+    """
+    print output
+    sys.exit(1)
+
+def main():
+    srUuid = ""
+    output = ""
+    planFile = ""
+    rate = 50 * Util.PREFIX["M"]
+    growth = 0
+    concurrency = ""
+    logFile = "/dev/null"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "u:o:p:r:g:c:l:", ["uuid=",
+            "output=", "plan=", "rate=", "growth=", "concurrency=", "log="])
+        for o, a in opts:
+            if o in ("-u", "--uuid"):
+                srUuid = a
+            if o in ("-o", "--output"):
+                output = a
+            if o in ("-p", "--plan"):
+                planFile = a
+            if o in ("-r", "--rate"):
+                rate = parseSize(a)
+            if o in ("-g", "--growth"):
+                growth = parseSize(a)
+            if o in ("-c", "--concurrency"):
+                concurrency = str(int(a))
+            if o in ("-l", "--log"):
+                logFile = a
+    except (getopt.GetoptError, ValueError):
+        usage()
+
+    if srUuid and output:
+        dump(srUuid, output)
+    elif planFile and rate > 0:
+        cleanup.LOG_FILE = logFile
+        sr = load(planFile, rate, growth)
+        if concurrency:
+            sr.xapi.srRecord["other_config"][ \
+                    cleanup.SR.DB_COALESCE_CONCURRENCY] = concurrency
+        report(sr, plan(sr))
+    else:
+        usage()
+
+
+if __name__ == '__main__':
+    main()
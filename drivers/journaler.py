@@ -21,7 +21,11 @@ class JournalerException(util.SMException):
 class Journaler:
     """Simple journaler that uses LVM namespace for persistent "storage".
     A journal is a id-value pair, and there can be only one journal for a
-    given id."""
+    given id.
+
+    The entries are indexed by type and id. The index is built from the
+    LVMCache and kept until the tagged LVs in the cache change (e.g. on 
+    LVMCache.refresh()), so that it sees exactly what the cache sees."""
 
     LV_SIZE = 4 * 1024 * 1024 # minimum size
     LV_TAG = "journaler"
@@ -30,6 +34,8 @@ class Journaler:
     def __init__(self, lvmCache):
         self.vgName = lvmCache.vgName
         self.lvmCache = lvmCache
+        self.entries = None
+        self.entriesVersion = None
 
     def create(self, type, id, val):
         """Create an entry of type "type" for "id" with the value "val".
@@ -40,6 +46,7 @@ class Journaler:
                     % (type, id, valExisting))
         lvName = self._getNameLV(type, id, val)
         self.lvmCache.create(lvName, self.LV_SIZE, self.LV_TAG, False)
+        self._updateIndex(type, id, val)
 
     def remove(self, type, id):
         """Remove the entry of type "type" for "id". Error if the entry doesn't
@@ -49,6 +56,7 @@ class Journaler:
             raise JournalerException("No journal for '%s:%s'" % (type, id))
         lvName = self._getNameLV(type, id, val)
         self.lvmCache.remove(lvName)
+        self._updateIndex(type, id, None)
 
     def get(self, type, id):
         """Get the value for the journal entry of type "type" for "id".
@@ -63,7 +71,14 @@ class Journaler:
         entries = self._getAllEntries()
         if not entries.get(type):
             return dict()
-        return entries[type]
+        return entries[type].copy()
+
+    def getAllJournals(self):
+        """Get a mapping type->(id->value) for all entries of all types"""
+        entries = dict()
+        for type, ids in self._getAllEntries().iteritems():
+            entries[type] = ids.copy()
+        return entries
 
     def hasJournals(self, id):
         """Return True if there any journals for "id", False otherwise"""
@@ -78,6 +93,9 @@ class Journaler:
 
     def _getAllEntries(self):
         lvList = self.lvmCache.getTagged(self.LV_TAG)
+        if self.entries != None and \
+                self.entriesVersion == self.lvmCache.tagsVersion:
+            return self.entries
         entries = dict()
         for lvName in lvList:
             parts = lvName.split(self.SEPARATOR, 2)
@@ -87,8 +105,25 @@ class Journaler:
             if not entries.get(type):
                 entries[type] = dict()
             entries[type][id] = val
+        self.entries = entries
+        self.entriesVersion = self.lvmCache.tagsVersion
         return entries
 
+    def _updateIndex(self, type, id, val):
+        """Apply our own create/remove to the index rather than rebuilding 
+        it. Only valid right after the corresponding LVMCache operation"""
+        if self.entries == None:
+            return
+        if val:
+            if not self.entries.get(type):
+                self.entries[type] = dict()
+            self.entries[type][id] = val
+        elif self.entries.get(type) and self.entries[type].has_key(id):
+            del self.entries[type][id]
+            if not self.entries[type]:
+                del self.entries[type]
+        self.entriesVersion = self.lvmCache.tagsVersion
+
 
 ###########################################################################
 #
@@ -1,9 +1,16 @@
 #!/usr/bin/env python
 
 import os
+import time
+import errno
+import simplejson
+import util
 import blktap2
+import tapstats
+import prewarm
 import glob
 import SR
+from lock import Lock
 from stat import * # S_ISBLK(), ...
 
 SECTOR_SHIFT = 9
@@ -133,6 +140,74 @@ class LeafCachingTap(CachingTap):
             (self.__class__.__name__,
              self.tapdisk.path, self.tapdisk.minor)
 
+class CacheNode(object):
+    """A node on the cache SR: a read cache of a shared parent VHD, or
+    the local leaf of a VDI on top of one."""
+
+    def __init__(self, path, parent_name, st):
+        self.path        = path
+        self.uuid        = os.path.basename(path)
+        self.uuid        = self.uuid[:-len(CacheFileSR.CACHE_NODE_EXT)]
+        self.parent_name = parent_name
+        self.size        = st.st_blocks * 512 # space used, nodes are sparse
+        self.mtime       = st.st_mtime
+        self.leaves      = []
+
+    def is_leaf(self):
+        return self.parent_name.endswith(CacheFileSR.CACHE_NODE_EXT)
+
+    def __str__(self):
+        return "%s(%s, size=%d)" % \
+            (self.__class__.__name__, self.path, self.size)
+
+class CacheLastUse(object):
+    """Last use of each read cache node, by parent uuid. Kept on the
+    cache SR itself, so that it survives reboots."""
+
+    FILE_NAME = '.vhdcache-lastuse'
+    LOCK_NS   = 'lcache-lastuse'
+
+    def __init__(self, sr_path):
+        self.path = os.path.join(sr_path, self.FILE_NAME)
+        self.lock = Lock(os.path.basename(sr_path), self.LOCK_NS)
+
+    def _load(self):
+        try:
+            f = open(self.path)
+            try:
+                return simplejson.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, times):
+        tmp_path = "%s.%d" % (self.path, os.getpid())
+        f = open(tmp_path, 'w')
+        try:
+            simplejson.dump(times, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.path)
+
+    def get_all(self):
+        return self._load()
+
+    def update(self, used = [], forgotten = []):
+        """Record that the nodes of parent uuids 'used' are in use now,
+        and drop those of 'forgotten'."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            times = self._load()
+            for uuid in used:
+                times[uuid] = now
+            for uuid in forgotten:
+                times.pop(uuid, None)
+            self._save(times)
+        finally:
+            self.lock.release()
+
 class CacheFileSR(object):
 
     CACHE_NODE_EXT = '.vhdcache'
@@ -227,15 +302,213 @@ class CacheFileSR(object):
                 fs_size - fs_free - fs_cache_total
             }
 
+    #
+    # Eviction: read cache nodes nothing uses any more are deleted,
+    # least recently used (or biggest, per idle time) first, when the
+    # free space drops below a low watermark, until it is back above a
+    # high watermark. Nodes idle for longer than MAX_IDLE days go
+    # regardless.
+    #
+
+    CONF_KEY_FREE_LOW  = 'cache-free-low'      # percent
+    CONF_KEY_FREE_HIGH = 'cache-free-high'     # percent
+    CONF_KEY_MAX_IDLE  = 'cache-max-idle-days' # 0 to disable
+    CONF_KEY_POLICY    = 'cache-eviction-policy'
+
+    FREE_LOW     = 10
+    FREE_HIGH    = 20
+    MAX_IDLE     = 30
+
+    POLICY_LRU   = 'lru'  # least recently used first
+    POLICY_SIZE  = 'size' # biggest idle time * size first
+    POLICIES     = [ POLICY_LRU, POLICY_SIZE ]
+
+    def get_last_use(self):
+        return CacheLastUse(self.sr_path)
+
+    def free_percent(self):
+        f = self.statvfs()
+        if not f.f_blocks:
+            return 100
+        return f.f_bavail * 100 / f.f_blocks
+
+    def scan_nodes(self):
+        """All read cache nodes, by path, with their leaves."""
+        from vhdreader import VHDFile, VHDFormatError
+
+        nodes  = {}
+        leaves = []
+
+        for path in self._fast_find_nodes():
+            try:
+                st  = os.stat(path)
+                vhd = VHDFile(path)
+                try:
+                    parent_name = vhd.getParentName()
+                finally:
+                    vhd.close()
+            except (OSError, VHDFormatError), e:
+                util.SMlog("lcache: ignoring %s: %s" % (path, e))
+                continue
+            if not parent_name:
+                continue
+
+            node = CacheNode(path, parent_name, st)
+            if node.is_leaf():
+                leaves.append(node)
+            else:
+                nodes[path] = node
+
+        for leaf in leaves:
+            parent_path = os.path.join(self.sr_path,
+                                       os.path.basename(leaf.parent_name))
+            if parent_path in nodes:
+                nodes[parent_path].leaves.append(leaf)
+
+        return nodes
+
+    @staticmethod
+    def _list_tapdisks():
+        """The tapdisks of this host, by path. NB. a single listing for
+        all nodes: looking up the many nodes without a tapdisk one by one
+        would list the tapdisks again for each."""
+        tapdisks = {}
+        for tapdisk in blktap2.Tapdisk.list():
+            tapdisks[tapdisk.path] = tapdisk
+        return tapdisks
+
+    @staticmethod
+    def _in_use(node, tapdisks):
+        """Whether a tapdisk serves the node, or a leaf on top of it,
+        to anything: the parent tapdisk counts if a leaf tapdisk has its
+        tapdev open."""
+        for leaf in node.leaves:
+            if tapdisks.has_key(leaf.path):
+                return True
+
+        tapdisk = tapdisks.get(node.path)
+        if tapdisk and blktap2.Tapdisk.tapdev_in_use(tapdisk.minor):
+            return True
+
+        return False
+
+    def _evict_node(self, node):
+        """Delete node, its idle parent tapdisk and any stale leaves,
+        unless it got used meanwhile. Return whether it was deleted."""
+        lock = Lock(blktap2.VDI.LOCK_CACHE_SETUP, node.uuid)
+        if not lock.acquireNoblock():
+            util.SMlog("lcache: %s is being set up, not evicting" % node)
+            return False
+        try:
+            blktap2.Tapdisk.registry.invalidate()
+            tapdisks = self._list_tapdisks()
+            if self._in_use(node, tapdisks):
+                return False
+
+            prewarm_lock = prewarm.stop(node.path)
+            try:
+                tapdisk = tapdisks.get(node.path)
+                if tapdisk:
+                    util.SMlog("lcache: shutting down idle %s" % tapdisk)
+                    tapdisk.shutdown()
+
+                for leaf in node.leaves:
+                    util.SMlog("lcache: deleting stale leaf %s" % leaf)
+                    os.unlink(leaf.path)
+
+                util.SMlog("lcache: evicting %s" % node)
+                os.unlink(node.path)
+                return True
+            finally:
+                prewarm_lock.release()
+        finally:
+            lock.release()
+
+    def evict(self, free_low = FREE_LOW, free_high = FREE_HIGH,
+              max_idle = MAX_IDLE, policy = POLICY_LRU, exclude = []):
+        """Evict unused read cache nodes, as described above. Nodes of
+        the parent uuids in 'exclude' are kept. Return the evicted
+        nodes."""
+
+        if policy not in self.POLICIES:
+            raise util.SMException("Unknown cache eviction policy: %s" % \
+                                       policy)
+
+        nodes     = self.scan_nodes()
+        last_use  = self.get_last_use()
+        times     = last_use.get_all()
+        tapdisks  = self._list_tapdisks()
+        now       = time.time()
+
+        used = []
+        idle = []
+        for node in nodes.itervalues():
+            if node.uuid in exclude or self._in_use(node, tapdisks):
+                used.append(node.uuid)
+            else:
+                idle_time = now - times.get(node.uuid, node.mtime)
+                idle.append((max(idle_time, 0), node))
+
+        if policy == self.POLICY_SIZE:
+            key = lambda (idle_time, node): idle_time * node.size
+        else:
+            key = lambda (idle_time, node): idle_time
+        idle.sort(lambda x, y: cmp(key(y), key(x)))
+
+        evicted  = []
+        evicting = self.free_percent() < free_low
+        for idle_time, node in idle:
+            expired = max_idle and idle_time > max_idle * 24 * 3600
+            if evicting and self.free_percent() >= free_high:
+                evicting = False
+            if not (evicting or expired):
+                continue
+            try:
+                if self._evict_node(node):
+                    evicted.append(node)
+            except (OSError, blktap2.TapCtl.CommandFailure), e:
+                util.SMlog("lcache: failed to evict %s: %s" % (node, e))
+
+        gone = [ uuid for uuid in times.iterkeys()
+                 if os.path.join(self.sr_path, uuid + self.CACHE_NODE_EXT)
+                 not in nodes ]
+        last_use.update(used, gone + map(lambda node: node.uuid, evicted))
+
+        if evicting and self.free_percent() < free_high:
+            util.SMlog("lcache: %d%% free on %s after eviction, below %d%%" % \
+                           (self.free_percent(), self.sr_path, free_high))
+
+        return evicted
+
+    def evict_with_config(self, other_config, exclude = []):
+        """evict(), with the settings in the SR other-config."""
+
+        def get(key, default):
+            try:
+                return int(other_config.get(key, default))
+            except ValueError:
+                util.SMlog("lcache: ignoring bad %s" % key)
+                return default
+
+        return self.evict(get(self.CONF_KEY_FREE_LOW, self.FREE_LOW),
+                          get(self.CONF_KEY_FREE_HIGH, self.FREE_HIGH),
+                          get(self.CONF_KEY_MAX_IDLE, self.MAX_IDLE),
+                          other_config.get(self.CONF_KEY_POLICY,
+                                           self.POLICY_LRU),
+                          exclude)
+
     @classmethod
     def _fast_find_tapdisks(cls):
 
         # NB. we're only about to gather stats here, so take the
         # fastpath, bypassing agent based VBD[currently-attached] ->
         # VDI[allow-caching] -> Tap resolution altogether. Instead, we
-        # list all tapdisk and match by path suffix.
+        # list all tapdisk and match by path suffix. If the tapstats
+        # collector is running, reuse the stats it last sampled rather
+        # than running tap-ctl stats on each tapdisk.
 
         tapdisks = []
+        collected = tapstats.load()
 
         for tapdisk in blktap2.Tapdisk.list():
             try:
@@ -245,11 +518,16 @@ class CacheFileSR(object):
 
             if ext != cls.CACHE_NODE_EXT: continue
 
-            try:
-                stats = tapdisk.stats()
-            except blktap2.TapCtl.CommandFailure, e:
-                if e.errno != errno.ENOENT: raise
-                continue # shut down
+            stats = None
+            if collected:
+                stats = tapstats.getTapctlStats(collected, tapdisk)
+
+            if not stats:
+                try:
+                    stats = tapdisk.stats()
+                except blktap2.TapCtl.CommandFailure, e:
+                    if e.status != errno.ENOENT: raise
+                    continue # shut down
 
             caching = CachingTap.from_tapdisk(tapdisk, stats)
             tapdisks.append(caching)
@@ -326,7 +604,7 @@ if __name__ == '__main__':
                 "usage: tapdisk-cache-stats [<sr-uuid>]"
         else:
             print >>stream, \
-                "usage: %s sr.{stats|topology} [<sr-uuid>]" % prog
+                "usage: %s sr.{stats|topology|evict} [<sr-uuid>]" % prog
 
     def usage_error():
         usage(sys.stderr)
@@ -374,6 +652,12 @@ if __name__ == '__main__':
 
             print "sr.total=%s" % str(cache_sr.vdi_stats_total())
 
+        elif method == 'evict':
+            for node in cache_sr.evict():
+                print "evicted %s" % node
+
+            print "sr.free=%d%%" % cache_sr.free_percent()
+
         else:
             usage_error()
     else:
@@ -46,6 +46,14 @@ JVHD_TAG = "jvhd"
 
 LOCK_RETRY_ATTEMPTS = 10
 
+# Thin provisioning: VDIs are inflated on attach by an increment predicted 
+# from their growth over previous attachments (rather than to the full size), 
+# and grown online by thinmon as writes approach the end of the LV
+THIN_MIN_INCREMENT = 1024 * 1024 * 1024
+THIN_GROWTH_FACTOR = 2 # headroom in units of the average growth per attach
+THIN_KEY_GROWTH = "thin-growth" # sm-config: average growth per attach
+THIN_KEY_ATTACH_SIZE = "thin-attach-size" # sm-config: VHD size at attach
+
 # ref counting for VDI's: we need a ref count for LV activation/deactivation
 # on the master
 NS_PREFIX_LVM = "lvm-"
@@ -100,6 +108,17 @@ def calcSizeVHDLV(sizeVirt):
     bitmapOverhead = vhdutil.calcOverheadBitmap(sizeVirt)
     return calcSizeLV(sizeVirt + metaOverhead + bitmapOverhead)
 
+def calcThinIncrement(growth):
+    """How much to grow a thin VDI by, given its average growth per attach"""
+    return calcSizeLV(max(THIN_MIN_INCREMENT, THIN_GROWTH_FACTOR * growth))
+
+def calcSizeThinLV(sizeVirt, sizePhys, growth):
+    """The LV size to inflate a thin VDI with 'sizePhys' of VHD data to: the
+    predicted growth on top of the data, but never beyond the fully-inflated
+    size"""
+    return min(calcSizeVHDLV(sizeVirt),
+            calcSizeLV(sizePhys + calcThinIncrement(growth)))
+
 def getLVInfo(lvmCache, lvName = None):
     """Load LV info for all LVs in the VG or an individual LV. 
     This is a wrapper for lvutil.getLVInfo that filters out LV's that
@@ -124,16 +143,7 @@ def getVDIInfo(lvmCache):
     for uuid, lvInfo in lvs.iteritems():
         if lvInfo.vdiType == vhdutil.VDI_TYPE_VHD:
             haveVHDs = True
-        vdiInfo = VDIInfo(uuid)
-        vdiInfo.vdiType    = lvInfo.vdiType
-        vdiInfo.lvName     = lvInfo.name
-        vdiInfo.sizeLV     = lvInfo.size
-        vdiInfo.sizeVirt   = lvInfo.size
-        vdiInfo.lvActive   = lvInfo.active
-        vdiInfo.lvOpen     = lvInfo.open
-        vdiInfo.lvReadonly = lvInfo.readonly
-        vdiInfo.hidden     = lvInfo.hidden
-        vdis[uuid]         = vdiInfo
+        vdis[uuid] = _getVDIInfoLV(uuid, lvInfo)
 
     if haveVHDs:
         pattern = "%s*" % LV_PREFIX[vhdutil.VDI_TYPE_VHD]
@@ -159,6 +169,51 @@ def getVDIInfo(lvmCache):
                     vdis[uuid].hidden     = vhds[uuid].hidden
     return vdis
 
+def getVDIInfoPartial(lvmCache, uuids):
+    """Load VDI info for the VDIs 'uuids' only (those whose LVs no longer
+    exist are omitted). The VHD info is read directly from the LV if it is
+    active, or else with a vhd-util scan of just that LV"""
+    vdis = {}
+    lvs = getLVInfo(lvmCache)
+    for uuid in uuids:
+        lvInfo = lvs.get(uuid)
+        if not lvInfo:
+            continue
+        vdiInfo = _getVDIInfoLV(uuid, lvInfo)
+        vdis[uuid] = vdiInfo
+        if lvInfo.vdiType != vhdutil.VDI_TYPE_VHD:
+            continue
+        vhdInfo = None
+        path = os.path.join(VG_LOCATION, lvmCache.vgName, lvInfo.name)
+        if lvInfo.active and util.pathexists(path):
+            vhdInfo = vhdutil.getVHDInfoNoParentCheck(path, extractUuid)
+        if not vhdInfo:
+            try:
+                vhdInfo = vhdutil.getVHDInfoLVM(lvInfo.name, extractUuid,
+                        lvmCache.vgName)
+            except util.CommandException:
+                util.logException("getVHDInfoLVM")
+        if not vhdInfo or vhdInfo.error:
+            util.SMlog("*** VHD info missing: %s" % uuid)
+            vdiInfo.scanError = True
+        else:
+            vdiInfo.sizeVirt   = vhdInfo.sizeVirt
+            vdiInfo.parentUuid = vhdInfo.parentUuid
+            vdiInfo.hidden     = vhdInfo.hidden
+    return vdis
+
+def _getVDIInfoLV(uuid, lvInfo):
+    vdiInfo = VDIInfo(uuid)
+    vdiInfo.vdiType    = lvInfo.vdiType
+    vdiInfo.lvName     = lvInfo.name
+    vdiInfo.sizeLV     = lvInfo.size
+    vdiInfo.sizeVirt   = lvInfo.size
+    vdiInfo.lvActive   = lvInfo.active
+    vdiInfo.lvOpen     = lvInfo.open
+    vdiInfo.lvReadonly = lvInfo.readonly
+    vdiInfo.hidden     = lvInfo.hidden
+    return vdiInfo
+
 def inflate(journaler, srUuid, vdiUuid, size):
     """Expand a VDI LV (and its VHD) to 'size'. If the LV is already bigger
     than that, it's a no-op. Does not change the virtual size of the VDI"""
@@ -214,10 +269,35 @@ def _tryAcquire(lock):
         time.sleep(1)
     raise util.SRBusyException()
 
-def attachThin(journaler, srUuid, vdiUuid):
-    """Ensure that the VDI LV is expanded to the fully-allocated size"""
+def _getThinConfig(session, vdiUuid):
+    """The VDI ref and the growth history kept in its sm-config"""
+    vdiRef = session.xenapi.VDI.get_by_uuid(vdiUuid)
+    smConfig = session.xenapi.VDI.get_sm_config(vdiRef)
+    growth = None
+    attachSize = None
+    try:
+        if smConfig.has_key(THIN_KEY_GROWTH):
+            growth = long(smConfig[THIN_KEY_GROWTH])
+        if smConfig.has_key(THIN_KEY_ATTACH_SIZE):
+            attachSize = long(smConfig[THIN_KEY_ATTACH_SIZE])
+    except ValueError:
+        util.SMlog("Bad thin provisioning history for %s: %s" % \
+                (vdiUuid, smConfig))
+    return (vdiRef, growth, attachSize)
+
+def _setSMConfig(session, vdiRef, key, val):
+    session.xenapi.VDI.remove_from_sm_config(vdiRef, key)
+    if val != None:
+        session.xenapi.VDI.add_to_sm_config(vdiRef, key, str(val))
+
+def attachThin(journaler, srUuid, vdiUuid, session = None):
+    """Ensure that the VDI LV is expanded for use. Without a session, expand
+    it to the fully-allocated size. With one, expand it only by the increment 
+    predicted from the VDI growth history (see calcSizeThinLV), and record 
+    the VHD size at attach so that detachThin can update the history"""
     lvName = LV_PREFIX[vhdutil.VDI_TYPE_VHD] + vdiUuid
     vgName = VG_PREFIX + srUuid
+    path = os.path.join(VG_LOCATION, vgName, lvName)
     lock = Lock(vhdutil.LOCK_TYPE_SR, srUuid)
     lvmCache = journaler.lvmCache
     _tryAcquire(lock)
@@ -229,13 +309,81 @@ def attachThin(journaler, srUuid, vdiUuid):
         return
     lvmCache.activate(NS_PREFIX_LVM + srUuid, vdiUuid, lvName, False)
     try:
+        if session:
+            (vdiRef, growth, attachSize) = _getThinConfig(session, vdiUuid)
+            sizePhys = vhdutil.getSizePhys(path)
+            newSize = calcSizeThinLV(vhdInfo.sizeVirt, sizePhys, growth or 0)
+            util.SMlog("Thin attach of %s: VHD size %d, average growth %s, "
+                    "LV size %d -> %d" % (vdiUuid, sizePhys, growth,
+                        currSizeLV, newSize))
+            if attachSize == None:
+                # not attached elsewhere already: the growth is measured 
+                # from the first attach on
+                _setSMConfig(session, vdiRef, THIN_KEY_ATTACH_SIZE, sizePhys)
         inflate(journaler, srUuid, vdiUuid, newSize)
     finally:
         lvmCache.deactivate(NS_PREFIX_LVM + srUuid, vdiUuid, lvName, False)
     lock.release()
 
+def growThin(session, journaler, srUuid, vdiUuid, minIncrement = 0):
+    """Grow a thin VDI that is in use by one more increment, of at least 
+    minIncrement (called by thinmon through the lvhd-thin plugin when the VHD
+    data approaches the end of the LV). The tapdisk is paused while the LV and the VHD footer are moved, and 
+    the hosts using the VDI refresh the LV before it is unpaused. Returns the 
+    new LV size"""
+    import blktap2
+    from vgledger import VGLedger
+    lvName = LV_PREFIX[vhdutil.VDI_TYPE_VHD] + vdiUuid
+    vgName = VG_PREFIX + srUuid
+    path = os.path.join(VG_LOCATION, vgName, lvName)
+    lock = Lock(vhdutil.LOCK_TYPE_SR, srUuid)
+    lvmCache = journaler.lvmCache
+    _tryAcquire(lock)
+    try:
+        lvmCache.refresh()
+        currSizeLV = lvmCache.getSize(lvName)
+        (vdiRef, growth, attachSize) = _getThinConfig(session, vdiUuid)
+        lvmCache.activate(NS_PREFIX_LVM + srUuid, vdiUuid, lvName, False)
+        try:
+            sizeVirt = vhdutil.getSizeVirt(path)
+            increment = max(calcThinIncrement(growth or 0),
+                    calcSizeLV(minIncrement))
+            newSize = min(calcSizeVHDLV(sizeVirt), currSizeLV + increment)
+            if newSize <= currSizeLV:
+                return currSizeLV
+            util.SMlog("Thin grow of %s: LV size %d -> %d" % \
+                    (vdiUuid, currSizeLV, newSize))
+            # claim the space so that the SM operations and the GC running 
+            # meanwhile can't take it
+            ledger = VGLedger(vgName)
+            resId = ledger.reserve(newSize - currSizeLV, 
+                    "thin-grow-%s" % vdiUuid)
+            try:
+                if not blktap2.VDI.tap_pause(session, srUuid, vdiUuid):
+                    raise util.SMException("failed to pause VDI %s" % vdiUuid)
+                try:
+                    inflate(journaler, srUuid, vdiUuid, newSize)
+                    hostRefs = util.get_hosts_attached_on(session, [vdiUuid])
+                    masterRef = util.get_this_host_ref(session)
+                    if masterRef in hostRefs:
+                        lvmCache.activateNoRefcount(lvName, True)
+                    slaves = filter(lambda x: x != masterRef, hostRefs)
+                    lvRefreshOnSlaves(session, srUuid, vgName, lvName,
+                            vdiUuid, slaves)
+                finally:
+                    blktap2.VDI.tap_unpause(session, srUuid, vdiUuid)
+            finally:
+                ledger.release(resId)
+        finally:
+            lvmCache.deactivate(NS_PREFIX_LVM + srUuid, vdiUuid, lvName, False)
+        session.xenapi.VDI.set_physical_utilisation(vdiRef, str(newSize))
+        return newSize
+    finally:
+        lock.release()
+
 def detachThin(session, lvmCache, srUuid, vdiUuid):
-    """Shrink the VDI to the minimal size if no one is using it"""
+    """Shrink the VDI to the minimal size if no one is using it, updating its
+    growth history"""
     lvName = LV_PREFIX[vhdutil.VDI_TYPE_VHD] + vdiUuid
     path = os.path.join(VG_LOCATION, VG_PREFIX + srUuid, lvName)
     lock = Lock(vhdutil.LOCK_TYPE_SR, srUuid)
@@ -254,7 +402,20 @@ def detachThin(session, lvmCache, srUuid, vdiUuid):
                 (vdiUuid, numPlugged - 1))
     lvmCache.activate(NS_PREFIX_LVM + srUuid, vdiUuid, lvName, False)
     try:
-        newSize = calcSizeLV(vhdutil.getSizePhys(path))
+        sizePhys = vhdutil.getSizePhys(path)
+        (vdiRef, growth, attachSize) = _getThinConfig(session, vdiUuid)
+        if attachSize != None:
+            # running average over the last few attachments
+            grown = max(0, sizePhys - attachSize)
+            if growth == None:
+                growth = grown
+            else:
+                growth = (growth + grown) / 2
+            util.SMlog("Thin detach of %s: grew by %d, average growth %d" % \
+                    (vdiUuid, grown, growth))
+            _setSMConfig(session, vdiRef, THIN_KEY_GROWTH, growth)
+            _setSMConfig(session, vdiRef, THIN_KEY_ATTACH_SIZE, None)
+        newSize = calcSizeLV(sizePhys)
         deflate(lvmCache, lvName, newSize)
     finally:
         lvmCache.deactivate(NS_PREFIX_LVM + srUuid, vdiUuid, lvName, False)
@@ -292,10 +453,9 @@ def lvRefreshOnSlaves(session, srUuid, vgName, lvName, vdiUuid, slaves):
             "uuid3"  : vdiUuid,
             "ns3"    : NS_PREFIX_LVM + srUuid,
             "lvName3": lvName}
-    for slave in slaves:
-        util.SMlog("Refreshing %s on slave %s" % (lvName, slave))
-        text = session.xenapi.host.call_plugin(slave, "on-slave", "multi", args)
-        util.SMlog("call-plugin returned: '%s'" % text)
+    util.SMlog("Refreshing %s on slaves %s" % (lvName, slaves))
+    util.call_plugin_on_hosts(session, slaves, "on-slave", "multi",
+            args).check()
 
 def lvRefreshOnAllSlaves(session, srUuid, vgName, lvName, vdiUuid):
     slaves = util.get_all_slaves(session)
@@ -314,10 +474,11 @@ def setInnerNodeRefcounts(lvmCache, srUuid):
         vdi.refcount = 0
 
     ns = NS_PREFIX_LVM + srUuid
+    refcounts = RefCounter.checkAll(ns)
     for uuid, vdi in vdiInfo.iteritems():
         if vdi.hidden:
             continue # only read leaf refcounts
-        refcount = RefCounter.check(uuid, ns)
+        refcount = refcounts.get(uuid, (0, 0))
         assert(refcount == (0, 0) or refcount == (0, 1))
         if refcount[1]:
             vdi.refcount = 1
@@ -326,13 +487,15 @@ def setInnerNodeRefcounts(lvmCache, srUuid):
                 vdi.refcount += 1
     
     pathsNotInUse = []
+    innerRefcounts = dict()
     for uuid, vdi in vdiInfo.iteritems():
         if vdi.hidden:
             util.SMlog("Setting refcount for %s to %d" % (uuid, vdi.refcount))
-            RefCounter.set(uuid, vdi.refcount, 0, ns)
+            innerRefcounts[uuid] = (vdi.refcount, 0)
         if vdi.refcount == 0 and vdi.lvActive:
             path = os.path.join("/dev", lvmCache.vgName, vdi.lvName)
             pathsNotInUse.append(path)
+    RefCounter.setMany(innerRefcounts, ns)
 
     return pathsNotInUse
 
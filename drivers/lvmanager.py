@@ -58,6 +58,25 @@ class LVActivator:
         self.lvActivations[persistent][binary][uuid] = lvName
         self.lvmCache.activate(self.ns, uuid, lvName, binary)
 
+    def activateMany(self, lvs, persistent = False):
+        """Activate a list of (uuid, lvName, binary) LVs (e.g. a whole VHD
+        chain) with a single LVM command. The activations are tracked exactly
+        as if activate() had been called on each of them"""
+        refs = []
+        for uuid, lvName, binary in lvs:
+            if self.lvActivations[persistent][binary].get(uuid):
+                if persistent:
+                    raise LVManagerException( \
+                            "Double persistent activation: %s" % uuid)
+                continue
+            refs.append((uuid, lvName, binary))
+        if not refs:
+            return
+
+        self.lvmCache.activateMany(self.ns, refs)
+        for uuid, lvName, binary in refs:
+            self.lvActivations[persistent][binary][uuid] = lvName
+
     def activateEnforce(self, uuid, lvName, lvPath):
         """incrementing the refcount is not enough to keep an LV activated if
         another party is unaware of refcounting. For example, blktap does 
@@ -87,14 +106,34 @@ class LVActivator:
         # operation failed - don't throw exceptions here
         success = True
         for persistent in [self.TEMPORARY, self.PERSISTENT]:
+            refs = []
+            for binary in [self.NORMAL, self.BINARY]:
+                for uuid, lvName in \
+                        self.lvActivations[persistent][binary].items():
+                    if self.openFiles.get(uuid):
+                        self.openFiles[uuid].close()
+                        del self.openFiles[uuid]
+                        self.lvmCache.changeOpen(lvName, -1)
+                    refs.append((uuid, lvName, binary))
+            if not refs:
+                continue
+            failed = []
+            try:
+                failed = self.lvmCache.deactivateMany(self.ns, refs)
+                if failed:
+                    success = False
+                    util.SMlog("_deactivateAll: failed to deactivate %s" % \
+                            failed)
+            except:
+                # the refcounts may have been dropped already: don't retry
+                success = False
+                util.logException("_deactivateAll")
+            # keep the LVs that failed (with their refcount restored by 
+            # deactivateMany) so that a later deactivateAll retries them
             for binary in [self.NORMAL, self.BINARY]:
-                uuids = self.lvActivations[persistent][binary].keys()
-                for uuid in uuids:
-                    try:
-                        self.deactivate(uuid, binary, persistent)
-                    except:
-                        success = False
-                        util.logException("_deactivateAll")
+                for uuid in self.lvActivations[persistent][binary].keys():
+                    if uuid not in failed:
+                        del self.lvActivations[persistent][binary][uuid]
         return success
 
     def deactivate(self, uuid, binary, persistent = False):
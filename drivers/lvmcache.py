@@ -52,7 +52,18 @@ def lazyInit(op):
 
 class LVMCache:
     """Per-VG object to store LV information. Can be queried for cached LVM
-    information and refreshed"""
+    information and refreshed. 
+    
+    The "lvs" output is shared between processes through a file in 
+    SHARED_DIR, stamped with the VG metadata seqno: as long as the seqno is 
+    unchanged, a refresh reuses it and only needs "vgs" to get the seqno and 
+    "dmsetup" to get the activation state of the LVs on this host (which is 
+    not part of the VG metadata).
+
+    Before any of that, a refresh tries to read the VG metadata straight
+    from the PVs (see lvmreader), which needs no LVM command at all"""
+
+    SHARED_DIR = "/var/run/sm/lvmcache"
 
     def __init__(self, vgName):
         """Create a cache for VG vgName, but don't scan the VG yet"""
@@ -60,17 +71,37 @@ class LVMCache:
         self.vgPath = "/dev/%s" % self.vgName
         self.lvs = dict()
         self.tags = dict()
+        # bumped whenever the set of tagged LVs may have changed, so that 
+        # users can keep indexes derived from getTagged()
+        self.tagsVersion = 0
         self.initialized = False
         util.SMlog("LVMCache created for %s" % vgName)
 
     def refresh(self):
-        """Get the LV information for the VG using "lvs" """
+        """Get the LV information for the VG from its on-disk metadata, or
+        else using "lvs" or the shared table if the VG metadata has not
+        changed since it was written"""
         util.SMlog("LVMCache: refreshing")
-        cmd = [lvutil.CMD_LVS,
-                "--noheadings", "--units", "b", "-o", "+lv_tags", self.vgPath]
-        text = util.pread2(cmd)
+        if self._refreshFromMetadata():
+            return
+        seqno = self._getSeqno()
+        text = None
+        if seqno != None:
+            text = self._loadShared(seqno)
+        if text == None:
+            cmd = [lvutil.CMD_LVS, "--noheadings", "--units", "b", "-o", 
+                    "+lv_tags", self.vgPath]
+            text = lvutil.runLVM(cmd)
+            # only share the output if nothing changed while "lvs" ran
+            if seqno != None and self._getSeqno() == seqno:
+                self._saveShared(seqno, text)
+            openCounts = None
+        else:
+            util.SMlog("LVMCache: reusing the LV table at seqno %d" % seqno)
+            openCounts = lvutil.getDMOpenCounts(self.vgName)
         self.lvs.clear()
         self.tags.clear()
+        self.tagsVersion += 1
         for line in text.split('\n'):
             if not line:
                 continue
@@ -82,6 +113,9 @@ class LVMCache:
             if (fields[2][5] == 'o'):
                 lvInfo.open = 1
             lvInfo.readonly = (fields[2][1] == 'r')
+            if openCounts != None:
+                lvInfo.active = openCounts.has_key(lvName)
+                lvInfo.open = int(openCounts.get(lvName, 0) > 0)
             self.lvs[lvName] = lvInfo
             if len(fields) >= 5:
                 tags = fields[4].split(',')
@@ -94,6 +128,7 @@ class LVMCache:
     #
     @lazyInit
     def create(self, lvName, size, tag = None, activate = True):
+        self._invalidateShared()
         lvutil.create(lvName, size, self.vgName, tag, activate)
         lvInfo = LVInfo(lvName)
         lvInfo.size = size
@@ -105,14 +140,30 @@ class LVMCache:
     @lazyInit
     def remove(self, lvName):
         path = self._getPath(lvName)
+        self._invalidateShared()
         lvutil.remove(path)
         for tag in self.lvs[lvName].tags:
             self._removeTag(lvName, tag)
         del self.lvs[lvName]
 
+    @lazyInit
+    def removeMany(self, lvNames):
+        self._invalidateShared()
+        try:
+            lvutil.removeMany(map(self._getPath, lvNames))
+        except util.CommandException:
+            # some of them may have been removed
+            self.refresh()
+            raise
+        for lvName in lvNames:
+            for tag in self.lvs[lvName].tags:
+                self._removeTag(lvName, tag)
+            del self.lvs[lvName]
+
     @lazyInit
     def rename(self, lvName, newName):
         path = self._getPath(lvName)
+        self._invalidateShared()
         lvutil.rename(path, newName)
         lvInfo = self.lvs[lvName]
         del self.lvs[lvName]
@@ -123,6 +174,7 @@ class LVMCache:
     def setSize(self, lvName, newSize):
         path = self._getPath(lvName)
         size = self.getSize(lvName)
+        self._invalidateShared()
         lvutil.setSize(path, newSize, (newSize < size))
         self.lvs[lvName].size = newSize
 
@@ -184,6 +236,98 @@ class LVMCache:
         finally:
             lock.release()
 
+    @lazyInit
+    def activateMany(self, ns, refs):
+        """Batch version of activate(): 'refs' is a list of (ref, lvName,
+        binary) tuples. All refcounts are taken under the ref locks and the 
+        LVs that become referenced are activated with a single lvchange. On
+        failure all refcount changes are reverted, and the LVs that this call
+        brought up are deactivated again"""
+        locks = self._lockRefs(ns, refs)
+        try:
+            adjusted = []
+            toActivate = []
+            activated = []
+            try:
+                for binary in [False, True]:
+                    lvNames = dict(map(lambda (ref, lvName, b): (ref, lvName),
+                        filter(lambda x: x[2] == binary, refs)))
+                    counts = RefCounter.getMany(lvNames.keys(), binary, ns)
+                    adjusted.append((lvNames.keys(), binary))
+                    for ref, count in counts.iteritems():
+                        if count == 1:
+                            toActivate.append(lvNames[ref])
+                # LVs already active without a refcount (e.g. by 
+                # activateNoRefcount()) must stay active on rollback
+                activated = filter(lambda lvName: \
+                        not util.pathexists(self._getPath(lvName)), toActivate)
+                lvutil.activateMany(map(self._getPath, toActivate))
+            except:
+                for adjustedRefs, binary in adjusted:
+                    RefCounter.putMany(adjustedRefs, binary, ns)
+                # don't leave behind the part of the batch that did come up
+                try:
+                    lvutil.deactivateMany(map(self._getPath, activated))
+                except:
+                    util.logException("activateMany rollback")
+                raise
+            for lvName in toActivate:
+                self.lvs[lvName].active = True
+        finally:
+            for lock in locks:
+                lock.release()
+
+    @lazyInit
+    def deactivateMany(self, ns, refs):
+        """Batch version of deactivate(): 'refs' is a list of (ref, lvName,
+        binary) tuples. The LVs whose refcount drops to 0 are deactivated with
+        a single lvchange. The refcount is restored for any LV that could not
+        be deactivated. Returns the list of refs that failed"""
+        locks = self._lockRefs(ns, refs)
+        try:
+            unused = []
+            for binary in [False, True]:
+                lvNames = dict(map(lambda (ref, lvName, b): (ref, lvName),
+                    filter(lambda x: x[2] == binary, refs)))
+                counts = RefCounter.putMany(lvNames.keys(), binary, ns)
+                for ref, count in counts.iteritems():
+                    if count == 0:
+                        unused.append((ref, lvNames[ref], binary))
+            if not unused:
+                return []
+
+            # as in deactivate(), don't trust a cached open flag
+            busy = filter(lambda (ref, lvName, binary): \
+                    self.checkLV(lvName) and self.lvs[lvName].open, unused)
+            if busy:
+                self.refresh()
+            toDeactivate = []
+            for ref, lvName, binary in unused:
+                if not self.checkLV(lvName):
+                    util.SMlog("LV %s not found" % lvName)
+                    lvutil._lvmBugCleanup(self._getPath(lvName))
+                elif self.lvs[lvName].open:
+                    util.SMlog("WARNING: deactivate: LV %s open" % lvName)
+                else:
+                    toDeactivate.append((ref, lvName, binary))
+
+            paths = map(lambda (ref, lvName, binary): self._getPath(lvName),
+                    toDeactivate)
+            failedPaths = lvutil.deactivateMany(paths)
+            failed = []
+            for ref, lvName, binary in toDeactivate:
+                if self._getPath(lvName) in failedPaths:
+                    util.SMlog("LV %s could not be deactivated, reverting "
+                            "the refcount change" % lvName)
+                    RefCounter.get(ref, binary, ns)
+                    failed.append(ref)
+                else:
+                    self.lvs[lvName].active = False
+            return failed
+        finally:
+            for lock in locks:
+                lock.release()
+
     @lazyInit
     def activateNoRefcount(self, lvName, refresh = False):
         path = self._getPath(lvName)
@@ -203,6 +347,7 @@ class LVMCache:
     @lazyInit
     def setHidden(self, lvName, hidden=True):
         path = self._getPath(lvName)
+        self._invalidateShared()
         if hidden:
             lvutil.setHidden(path)
             self._addTag(lvName, lvutil.LV_TAG_HIDDEN)
@@ -213,6 +358,7 @@ class LVMCache:
     @lazyInit
     def setReadonly(self, lvName, readonly):
         path = self._getPath(lvName)
+        self._invalidateShared()
         lvutil.setReadonly(path, readonly)
         self.lvs[lvName].readonly = readonly
 
@@ -270,7 +416,99 @@ class LVMCache:
     def _getPath(self, lvName):
         return os.path.join(self.vgPath, lvName)
 
+    def _lockRefs(self, ns, refs):
+        """Take the locks of all refs in a fixed (sorted) order so that
+        concurrent batch operations cannot deadlock"""
+        locks = []
+        try:
+            for ref in sorted(set(map(lambda x: x[0], refs))):
+                lock = Lock(ref, ns)
+                lock.acquire()
+                locks.append(lock)
+        except:
+            for lock in locks:
+                lock.release()
+            raise
+        return locks
+
+    def _refreshFromMetadata(self):
+        """Load the LV information from the on-disk VG metadata. Return
+        False if it couldn't be read"""
+        try:
+            # NB. imported here so that anything wrong with the reader only
+            # means falling back to "lvs"
+            import lvmreader
+            vg = lvmreader.readVG(self.vgName)
+        except Exception, e:
+            util.SMlog("LVMCache: can't read the VG metadata: %s" % e)
+            return False
+        util.SMlog("LVMCache: read the VG metadata at seqno %d" % vg.seqno)
+        openCounts = lvutil.getDMOpenCounts(self.vgName)
+        self.lvs.clear()
+        self.tags.clear()
+        self.tagsVersion += 1
+        for lvName, lv in vg.lvs.iteritems():
+            lvInfo = LVInfo(lvName)
+            lvInfo.size = lv.size
+            lvInfo.readonly = lv.readonly
+            lvInfo.active = openCounts.has_key(lvName)
+            lvInfo.open = int(openCounts.get(lvName, 0) > 0)
+            self.lvs[lvName] = lvInfo
+            for tag in lv.tags:
+                self._addTag(lvName, tag)
+        self.initialized = True
+        return True
+
+    def _getSharedPath(self):
+        return os.path.join(self.SHARED_DIR, self.vgName)
+
+    def _getSeqno(self):
+        try:
+            return lvutil.getVGSeqno(self.vgName)
+        except (util.CommandException, util.SMException):
+            util.SMlog("LVMCache: failed to get the VG seqno")
+            return None
+
+    def _loadShared(self, seqno):
+        """Return the "lvs" output in the shared table if it is for seqno"""
+        try:
+            f = open(self._getSharedPath(), 'r')
+        except IOError:
+            return None
+        try:
+            header = f.readline().split()
+            if header != ["seqno", str(seqno)]:
+                return None
+            return f.read()
+        finally:
+            f.close()
+
+    def _saveShared(self, seqno, text):
+        tmpPath = "%s.%d" % (self._getSharedPath(), os.getpid())
+        try:
+            if not util.pathexists(self.SHARED_DIR):
+                os.makedirs(self.SHARED_DIR)
+            f = open(tmpPath, 'w')
+            try:
+                f.write("seqno %d\n" % seqno)
+                f.write(text)
+            finally:
+                f.close()
+            os.rename(tmpPath, self._getSharedPath())
+        except (IOError, OSError), e:
+            util.SMlog("LVMCache: failed to save the shared table: %s" % e)
+
+    def _invalidateShared(self):
+        """Drop the shared table before changing the VG metadata. (A stale 
+        table would not be used anyway because of the seqno change, but there
+        is no point in keeping it around)"""
+        try:
+            os.unlink(self._getSharedPath())
+        except OSError:
+            pass
+
     def _addTag(self, lvName, tag):
+        self.tagsVersion += 1
         self.lvs[lvName].tags.append(tag)
         if self.tags.get(tag):
             self.tags[tag].append(lvName)
@@ -278,6 +516,7 @@ class LVMCache:
             self.tags[tag] = [lvName]
 
     def _removeTag(self, lvName, tag):
+        self.tagsVersion += 1
         self.lvs[lvName].tags.remove(tag)
         self.tags[tag].remove(lvName)
 
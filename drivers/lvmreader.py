@@ -0,0 +1,633 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Read-only, in-process reader for the LVM2 metadata of a VG, taken straight
+# from the metadata area of its PVs (label, pv_header, mda_header and the
+# text in the circular buffer). It lets the read-only paths (LVMCache
+# refreshes, mostly on slaves) list the LVs without running "lvs", i.e.
+# without scanning the devices and taking the VG lock the master needs.
+# The cached pages of a PV are dropped once before it is read, and the text
+# is checked against the checksum in the mda_header, so a read racing with
+# the master's commit is retried rather than misparsed. The copies on all
+# PVs of the VG must be found and agree on the seqno, which must not be older
+# than the one read last time; the PV paths come from the last read, the
+# device-mapper devices of the VG or "pvs", each checked against the PV
+# UUIDs in the metadata. Anything unexpected raises LVMFormatError and the
+# caller is expected to fall back to the LVM tools.
+#
+
+import os
+import re
+import zlib
+import struct
+
+import util
+import lvutil
+import devmapper
+
+SECTOR_SIZE = 512
+LABEL_SCAN_SECTORS = 4
+LABEL_ID = "LABELONE"
+LABEL_TYPE = "LVM2 001"
+# id, sector, crc, offset of the pv_header, type
+LABEL_HEADER_FMT = "<8sQII8s"
+LABEL_CRC_OFFSET = 20
+PV_UUID_LEN = 32
+DISK_LOCN_FMT = "<QQ"
+DISK_LOCN_SIZE = struct.calcsize(DISK_LOCN_FMT)
+
+MDA_HEADER_SIZE = 512
+MDA_MAGIC = " LVM2 x[5A%r0N*>"
+MDA_VERSION = 1
+# checksum, magic, version, start, size
+MDA_HEADER_FMT = "<I16sIQQ"
+# offset, size, checksum, flags
+RAW_LOCN_FMT = "<QQII"
+RAW_LOCN_IGNORED = 0x1
+
+INITIAL_CRC = 0xf597a6cfL
+READ_RETRIES = 3
+
+PV_CACHE_DIR = "/var/run/sm/lvmreader"
+
+
+class LVMFormatError(util.SMException):
+    pass
+
+
+def _crc(buf, crc = INITIAL_CRC):
+    "LVM's CRC32 (no pre- or post-inversion)"
+    return (zlib.crc32(buf, crc ^ 0xffffffffL) & 0xffffffffL) ^ 0xffffffffL
+
+
+class LVMetadata:
+    "An LV as described in the VG metadata"
+    def __init__(self, name, size, readonly, tags):
+        self.name = name
+        self.size = size
+        self.readonly = readonly
+        self.tags = tags
+
+
+class VGMetadata:
+    "The parsed metadata of a VG"
+    def __init__(self, text):
+        tree = _parse(text)
+        self.name = None
+        vg = None
+        for key, val in tree.iteritems():
+            if isinstance(val, dict) and val.has_key("seqno"):
+                self.name = key
+                vg = val
+                break
+        if not self.name:
+            raise LVMFormatError("No VG in the metadata")
+        try:
+            self.seqno = int(vg["seqno"])
+            self.pvs = []
+            for pv in vg["physical_volumes"].itervalues():
+                if isinstance(pv, dict):
+                    self.pvs.append(pv["id"].replace("-", ""))
+            extentSize = int(vg["extent_size"]) * SECTOR_SIZE
+            self.lvs = dict()
+            for lvName, lv in vg.get("logical_volumes", {}).iteritems():
+                status = lv.get("status", [])
+                if not "VISIBLE" in status:
+                    continue # not listed by "lvs" either
+                extents = 0
+                for key, seg in lv.iteritems():
+                    if key.startswith("segment") and isinstance(seg, dict):
+                        extents += int(seg["extent_count"])
+                self.lvs[lvName] = LVMetadata(lvName, extents * extentSize,
+                        not "WRITE" in status, lv.get("tags", []))
+        except (KeyError, ValueError, TypeError, AttributeError), e:
+            raise LVMFormatError("Bad metadata for VG %s: %s" % \
+                    (self.name, e))
+
+
+class PVReader:
+    """Reads the metadata areas of one PV. The cached pages of the device are
+    dropped before each attempt, so that a slave doesn't get the metadata it
+    had cached some time ago"""
+
+    def __init__(self, path):
+        self.path = path
+        self.uuid = None
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def readVG(self):
+        """Return the VGMetadata in the first usable metadata area. Raise
+        LVMFormatError if there is none"""
+        self._flush()
+        for mdaStart, mdaSize in self._readMDAList():
+            for i in range(READ_RETRIES):
+                if i:
+                    self._flush()
+                try:
+                    text = self._readText(mdaStart)
+                    break
+                except LVMFormatError, e:
+                    util.SMlog("%s: retrying metadata read: %s" % \
+                            (self.path, e))
+            else:
+                raise e
+            if text:
+                return VGMetadata(text)
+        raise LVMFormatError("%s: no metadata" % self.path)
+
+    def _flush(self):
+        try:
+            util.flush_blockdev_buffers(self.fd)
+        except IOError, e:
+            raise LVMFormatError("%s: can't drop the cached pages: %s" % \
+                    (self.path, e))
+
+    def _pread(self, offset, size):
+        os.lseek(self.fd, offset, 0)
+        buf = ""
+        while len(buf) < size:
+            data = os.read(self.fd, size - len(buf))
+            if not data:
+                raise LVMFormatError("%s: short read at %d" % \
+                        (self.path, offset))
+            buf += data
+        return buf
+
+    def _readMDAList(self):
+        "Find the label and return the (offset, size) of the metadata areas"
+        buf = self._pread(0, LABEL_SCAN_SECTORS * SECTOR_SIZE)
+        for sector in range(LABEL_SCAN_SECTORS):
+            lbl = buf[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+            (lblId, lblSector, crc, offset, lblType) = \
+                    struct.unpack(LABEL_HEADER_FMT,
+                            lbl[:struct.calcsize(LABEL_HEADER_FMT)])
+            if lblId != LABEL_ID:
+                continue
+            if lblSector != sector or lblType != LABEL_TYPE or \
+                    crc != _crc(lbl[LABEL_CRC_OFFSET:]):
+                raise LVMFormatError("%s: bad label" % self.path)
+            break
+        else:
+            raise LVMFormatError("%s: not a PV" % self.path)
+
+        # the pv_header: PV UUID, device size, then the data areas and the
+        # metadata areas, each list terminated by a null entry
+        self.uuid = lbl[offset:offset + PV_UUID_LEN]
+        pos = offset + PV_UUID_LEN + 8
+        mdas = []
+        for areas in [[], mdas]:
+            while True:
+                if pos + DISK_LOCN_SIZE > SECTOR_SIZE:
+                    raise LVMFormatError("%s: bad pv_header" % self.path)
+                (areaOffset, areaSize) = struct.unpack(DISK_LOCN_FMT,
+                        lbl[pos:pos + DISK_LOCN_SIZE])
+                pos += DISK_LOCN_SIZE
+                if not areaOffset:
+                    break
+                areas.append((areaOffset, areaSize))
+        return mdas
+
+    def _readText(self, mdaStart):
+        """Read the committed metadata text of the area at mdaStart, or None
+        if the area is not in use"""
+        hdr = self._pread(mdaStart, MDA_HEADER_SIZE)
+        hdrLen = struct.calcsize(MDA_HEADER_FMT)
+        (checksum, magic, version, start, size) = \
+                struct.unpack(MDA_HEADER_FMT, hdr[:hdrLen])
+        if magic != MDA_MAGIC or version != MDA_VERSION or \
+                start != mdaStart or checksum != _crc(hdr[4:]):
+            raise LVMFormatError("%s: bad mda_header at %d" % \
+                    (self.path, mdaStart))
+        (offset, textSize, textChecksum, flags) = struct.unpack(RAW_LOCN_FMT,
+                hdr[hdrLen:hdrLen + struct.calcsize(RAW_LOCN_FMT)])
+        if not offset or (flags & RAW_LOCN_IGNORED):
+            return None
+        if offset + textSize > size:
+            # wraps around to the start of the circular buffer
+            firstSize = size - offset
+            text = self._pread(mdaStart + offset, firstSize) + \
+                    self._pread(mdaStart + MDA_HEADER_SIZE,
+                            textSize - firstSize)
+        else:
+            text = self._pread(mdaStart + offset, textSize)
+        if _crc(text) != textChecksum:
+            raise LVMFormatError("%s: metadata checksum mismatch" % \
+                    self.path)
+        return text.rstrip("\0")
+
+
+def readVG(vgName):
+    """Read the metadata of VG vgName from its PVs. Raise LVMFormatError if
+    it can't be read, or if the copies on the PVs or the one read last time
+    disagree"""
+    (lastSeqno, lastPaths) = _loadState(vgName)
+    for source in [_getCachedPVs, _getDMPVs, _getToolPVs]:
+        paths = source(vgName)
+        vg = _readCopies(vgName, paths)
+        if not vg:
+            continue
+        if lastSeqno != None and vg.seqno < lastSeqno:
+            raise LVMFormatError("%s: read seqno %d, but %d was read before" \
+                    % (vgName, vg.seqno, lastSeqno))
+        if vg.seqno != lastSeqno or paths != lastPaths:
+            _saveState(vgName, vg.seqno, paths)
+        return vg
+    raise LVMFormatError("Failed to read the metadata of %s" % vgName)
+
+def _readCopies(vgName, paths):
+    """Read the metadata of vgName on each of 'paths'. Return it if these
+    are exactly the PVs of the VG and all agree on the seqno, else None"""
+    vg = None
+    found = []
+    for path in paths:
+        try:
+            reader = PVReader(path)
+            try:
+                copy = reader.readVG()
+                uuid = reader.uuid
+            finally:
+                reader.close()
+        except (LVMFormatError, OSError, IOError), e:
+            util.SMlog("lvmreader: can't use %s: %s" % (path, e))
+            return None
+        if copy.name != vgName or not uuid in copy.pvs:
+            util.SMlog("lvmreader: %s is not a PV of %s" % (path, vgName))
+            return None
+        if vg and copy.seqno != vg.seqno:
+            raise LVMFormatError("%s: seqno %d on %s, %d on %s" % \
+                    (vgName, vg.seqno, paths[0], copy.seqno, path))
+        vg = copy
+        found.append(uuid)
+    if not vg:
+        return None
+    found.sort()
+    expected = vg.pvs[:]
+    expected.sort()
+    if found != expected:
+        util.SMlog("lvmreader: %s are not all the PVs of %s" % \
+                (paths, vgName))
+        return None
+    return vg
+
+def _getCachedPVs(vgName):
+    "The PVs of vgName that were used last time (see _loadState)"
+    return _loadState(vgName)[1]
+
+def _getDMPVs(vgName):
+    "The PVs underneath the device-mapper devices of vgName"
+    inventory = devmapper.getInventory()
+    paths = []
+    for name in inventory.getNames(devmapper.getDMName("/dev/%s/" % vgName)):
+        for path in inventory.getSlaves(name) or []:
+            if not path in paths:
+                paths.append(path)
+    return paths
+
+def _getToolPVs(vgName):
+    "The PVs of vgName according to \"pvs\""
+    cmd = [lvutil.CMD_PVS, "--noheadings", "-o", "pv_name,vg_name"]
+    try:
+        text = lvutil.runLVM(cmd)
+    except util.CommandException:
+        return []
+    paths = []
+    for line in text.split('\n'):
+        fields = line.split()
+        if len(fields) == 2 and fields[1] == vgName:
+            paths.append(fields[0])
+    return paths
+
+def _loadState(vgName):
+    """The (seqno, PV paths) of the last read of vgName, or (None, []). The
+    state file holds the seqno on the first line, then one path per line"""
+    try:
+        f = open(os.path.join(PV_CACHE_DIR, vgName), 'r')
+        try:
+            lines = f.read().split()
+        finally:
+            f.close()
+    except IOError:
+        return (None, [])
+    try:
+        return (int(lines[0]), lines[1:])
+    except (IndexError, ValueError):
+        return (None, [])
+
+def _saveState(vgName, seqno, paths):
+    path = os.path.join(PV_CACHE_DIR, vgName)
+    tmpPath = "%s.%d" % (path, os.getpid())
+    try:
+        if not util.pathexists(PV_CACHE_DIR):
+            os.makedirs(PV_CACHE_DIR)
+        f = open(tmpPath, 'w')
+        try:
+            f.write("%d\n" % seqno)
+            f.write("".join(map(lambda x: x + "\n", paths)))
+        finally:
+            f.close()
+        os.rename(tmpPath, path)
+    except (IOError, OSError), e:
+        util.SMlog("lvmreader: failed to save the state of %s: %s" % \
+                (vgName, e))
+
+
+#
+# The metadata text is in the LVM configuration file format: sections
+# ("name { ... }") and assignments ("key = value"), a value being a string, a
+# number, or a list of those in brackets
+#
+_TOKEN_RE = re.compile(r'\s*(?:#[^\n]*|("(?:[^"\\]|\\.)*")|([{}\[\]=,])|' \
+        r'([^\s{}\[\]=,"#]+))', re.S)
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    end = len(text)
+    while pos < end:
+        m = _TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            if text[pos:].strip():
+                raise LVMFormatError("Bad metadata at offset %d" % pos)
+            break
+        pos = m.end()
+        (string, punct, word) = m.groups()
+        if string is not None:
+            tokens.append(("s", re.sub(r'\\(.)', r'\1', string[1:-1])))
+        elif punct is not None:
+            tokens.append((punct, punct))
+        elif word is not None:
+            tokens.append(("w", word))
+    return tokens
+
+def _parse(text):
+    tokens = _tokenize(text)
+    (tree, pos) = _parseSection(tokens, 0, True)
+    return tree
+
+def _parseSection(tokens, pos, topLevel):
+    section = dict()
+    while pos < len(tokens):
+        (kind, val) = tokens[pos]
+        if kind == "}" and not topLevel:
+            return (section, pos + 1)
+        if kind != "w" or pos + 1 >= len(tokens):
+            raise LVMFormatError("Unexpected '%s' in the metadata" % val)
+        nextKind = tokens[pos + 1][0]
+        if nextKind == "{":
+            (section[val], pos) = _parseSection(tokens, pos + 2, False)
+        elif nextKind == "=":
+            (section[val], pos) = _parseValue(tokens, pos + 2)
+        else:
+            raise LVMFormatError("Unexpected '%s' after %s" % \
+                    (tokens[pos + 1][1], val))
+    if not topLevel:
+        raise LVMFormatError("Unterminated section in the metadata")
+    return (section, pos)
+
+def _parseValue(tokens, pos):
+    if pos >= len(tokens):
+        raise LVMFormatError("Missing value in the metadata")
+    (kind, val) = tokens[pos]
+    if kind == "s":
+        return (val, pos + 1)
+    if kind == "w":
+        for conv in [int, float]:
+            try:
+                return (conv(val), pos + 1)
+            except ValueError:
+                pass
+        return (val, pos + 1)
+    if kind == "[":
+        values = []
+        pos += 1
+        while pos < len(tokens) and tokens[pos][0] != "]":
+            (value, pos) = _parseValue(tokens, pos)
+            values.append(value)
+            if pos < len(tokens) and tokens[pos][0] == ",":
+                pos += 1
+        if pos >= len(tokens):
+            raise LVMFormatError("Unterminated list in the metadata")
+        return (values, pos + 1)
+    raise LVMFormatError("Unexpected '%s' in the metadata" % val)
+
+
+###########################################################################
+#
+#  Unit tests
+#
+_TEST_METADATA = '''VG_XenStorage-test {
+id = "vg-id"
+seqno = 42
+status = ["RESIZEABLE", "READ", "WRITE"] # a comment
+extent_size = 8192
+
+physical_volumes {
+
+pv0 {
+id = "UUUUUU-UUUU-UUUU-UUUU-UUUU-UUUU-UUUUUU"
+device = "/dev/sdb"
+pe_count = 100
+}
+}
+
+logical_volumes {
+
+MGT {
+status = ["READ", "WRITE", "VISIBLE"]
+segment_count = 1
+
+segment1 {
+start_extent = 0
+extent_count = 1
+stripes = [
+"pv0", 0
+]
+}
+}
+
+VHD-1 {
+status = ["READ", "VISIBLE"]
+tags = ["journaler", "a\\"b"]
+segment_count = 2
+
+segment1 {
+extent_count = 2
+}
+segment2 {
+extent_count = 3
+}
+}
+
+pvmove0 {
+status = ["READ", "WRITE"]
+segment1 {
+extent_count = 1
+}
+}
+}
+}
+# Generated by LVM2
+contents = "Text Format Volume Group"
+version = 1
+'''
+
+def _makeTestPV(path, text, mdaSize, textOffset):
+    """Write a PV with one metadata area of mdaSize bytes at 4k, holding
+    'text' at textOffset in its circular buffer"""
+    import array
+    mdaStart = 4096
+    buf = array.array('c', "\0" * (mdaStart + mdaSize))
+    def put(offset, data):
+        buf[offset:offset + len(data)] = array.array('c', data)
+
+    pvHeader = "U" * PV_UUID_LEN + struct.pack("<Q", len(buf)) + \
+            struct.pack(DISK_LOCN_FMT, mdaStart + mdaSize, 0) + \
+            struct.pack(DISK_LOCN_FMT, 0, 0) + \
+            struct.pack(DISK_LOCN_FMT, mdaStart, mdaSize) + \
+            struct.pack(DISK_LOCN_FMT, 0, 0)
+    hdrLen = struct.calcsize(LABEL_HEADER_FMT)
+    lbl = "\0" * hdrLen + pvHeader
+    lbl += "\0" * (SECTOR_SIZE - len(lbl))
+    crc = _crc(struct.pack("<I8s", hdrLen, LABEL_TYPE) + lbl[hdrLen:])
+    put(SECTOR_SIZE, struct.pack(LABEL_HEADER_FMT, LABEL_ID, 1, crc, hdrLen,
+            LABEL_TYPE) + lbl[hdrLen:])
+
+    first = min(len(text), mdaSize - textOffset)
+    put(mdaStart + textOffset, text[:first])
+    put(mdaStart + MDA_HEADER_SIZE, text[first:])
+    hdr = struct.pack(MDA_HEADER_FMT, 0, MDA_MAGIC, MDA_VERSION, mdaStart,
+            mdaSize)[4:] + struct.pack(RAW_LOCN_FMT, textOffset, len(text),
+                    _crc(text), 0)
+    hdr += "\0" * (MDA_HEADER_SIZE - 4 - len(hdr))
+    put(mdaStart, struct.pack("<I", _crc(hdr)) + hdr)
+
+    f = open(path, 'w')
+    try:
+        f.write(buf.tostring())
+    finally:
+        f.close()
+
+def _runTests():
+    """Unit testing"""
+    import tempfile
+    import shutil
+    print "Running unit tests..."
+
+    # the reference CRC of LVM (lib/misc/crc.c), one nibble at a time
+    table = [0x00000000, 0x1db71064, 0x3b6e20c8, 0x26d930ac, 0x76dc4190,
+            0x6b6b51f4, 0x4db26158, 0x5005713c, 0xedb88320, 0xf00f9344,
+            0xd6d6a3e8, 0xcb61b38c, 0x9b64c2b0, 0x86d3d2d4, 0xa00ae278,
+            0xbdbdf21c]
+    for buf in ["", "abc", _TEST_METADATA]:
+        crc = INITIAL_CRC
+        for c in buf:
+            crc ^= ord(c)
+            crc = (crc >> 4) ^ table[crc & 0xf]
+            crc = (crc >> 4) ^ table[crc & 0xf]
+        if _crc(buf) != crc:
+            print "CRC failed for %r" % buf
+            return 1
+
+    vg = VGMetadata(_TEST_METADATA)
+    if vg.name != "VG_XenStorage-test" or vg.seqno != 42 or \
+            vg.pvs != ["U" * PV_UUID_LEN]:
+        print "VG parsing failed: %s %s %s" % (vg.name, vg.seqno, vg.pvs)
+        return 1
+    lvs = vg.lvs.keys()
+    lvs.sort()
+    if lvs != ["MGT", "VHD-1"]:
+        print "hidden LVs not skipped: %s" % lvs
+        return 1
+    mgt = vg.lvs["MGT"]
+    vhd = vg.lvs["VHD-1"]
+    if mgt.size != 4 * 1024 * 1024 or mgt.readonly or mgt.tags:
+        print "MGT parsing failed"
+        return 1
+    if vhd.size != 5 * 4 * 1024 * 1024 or not vhd.readonly or \
+            vhd.tags != ["journaler", 'a"b']:
+        print "VHD-1 parsing failed: %d %s" % (vhd.size, vhd.tags)
+        return 1
+    for bad in ["VG {", "VG { seqno = 1 } }", "VG { seqno = [1, }",
+            "x = 1"]:
+        try:
+            VGMetadata(bad)
+            print "bad metadata not detected: %r" % bad
+            return 1
+        except LVMFormatError:
+            pass
+
+    global PV_CACHE_DIR
+    savedCacheDir = PV_CACHE_DIR
+    dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(dir, "pv")
+        mdaSize = 64 * 1024
+        text = _TEST_METADATA + "\0"
+        # in one piece, then wrapping around the end of the buffer
+        for textOffset in [MDA_HEADER_SIZE, mdaSize - 300]:
+            _makeTestPV(path, text, mdaSize, textOffset)
+            reader = PVReader(path)
+            try:
+                vg = reader.readVG()
+                uuid = reader.uuid
+            finally:
+                reader.close()
+            if vg.seqno != 42 or len(vg.lvs) != 2 or uuid != "U" * 32:
+                print "PV read failed at offset %d" % textOffset
+                return 1
+
+        _makeTestPV(path, text.replace("seqno = 42", "seqno = 43"),
+                mdaSize, MDA_HEADER_SIZE)
+        f = open(path, 'r+')
+        f.seek(4096 + MDA_HEADER_SIZE + 100)
+        f.write("X")
+        f.close()
+        reader = PVReader(path)
+        try:
+            try:
+                reader.readVG()
+                print "checksum mismatch not detected"
+                return 1
+            except LVMFormatError:
+                pass
+        finally:
+            reader.close()
+
+        PV_CACHE_DIR = dir
+        _makeTestPV(path, text, mdaSize, MDA_HEADER_SIZE)
+        _saveState("VG_XenStorage-test", 41, [path])
+        if readVG("VG_XenStorage-test").seqno != 42 or \
+                _loadState("VG_XenStorage-test") != (42, [path]):
+            print "readVG failed"
+            return 1
+        _saveState("VG_XenStorage-test", 43, [path])
+        try:
+            readVG("VG_XenStorage-test")
+            print "seqno going back not detected"
+            return 1
+        except LVMFormatError:
+            pass
+    finally:
+        PV_CACHE_DIR = savedCacheDir
+        shutil.rmtree(dir)
+    print "All tests passed"
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(_runTests())
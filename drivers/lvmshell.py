@@ -0,0 +1,364 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Run LVM commands in a long-lived "lvm" shell.
+#
+# Every LVM tool invocation (lvs, lvcreate, lvchange...) re-reads the LVM
+# configuration, rescans the devices and re-reads the VG metadata, which for
+# the short commands SM issues takes most of the time. Between start() and
+# stop() (an SM operation or a GC run), lvutil sends its commands to one
+# "lvm" shell process instead. Reports and the command log (which carries
+# the status of each command) are requested in JSON on a separate
+# descriptor (LVM_REPORT_FD), and reports are turned back into the
+# "--noheadings" text output the callers parse. An LVM whose shell doesn't
+# produce the command log is detected when the shell is started, and the
+# commands are then forked as before. That finding is kept in
+# UNSUPPORTED_FILE for the installed lvm binary, so that other processes
+# don't probe it again. Any other failure to start the shell (e.g. a VG 
+# that can't be read just then) only makes this process fork the commands
+# until the last stop().
+#
+
+import os
+import errno
+import fcntl
+import select
+import subprocess
+import threading
+import simplejson
+
+import util
+
+LVM_CMD = "/usr/sbin/lvm"
+PROMPT = "lvm> "
+REPORT_FD = 3
+STARTUP_TIMEOUT = 30 # seconds to wait for the first prompt
+REPORT_TIMEOUT = 10 # seconds to wait for the report after the prompt
+ECMD_PROCESSED = 1
+SHELL_CONFIG = "report{output_format=json} " \
+        "log{report_command_log=1 command_log_selection=all}"
+UNSUPPORTED_FILE = "/var/run/sm/lvmshell-unsupported"
+
+class LVMShellException(util.SMException):
+    pass
+
+class LVMShellUnsupported(LVMShellException):
+    "The lvm binary can't run commands in a shell the way we need"
+    pass
+
+class LVMShellExited(LVMShellException):
+    pass
+
+class LVMShell:
+    """An "lvm" shell process"""
+
+    def __init__(self):
+        self.proc = None
+        self.reportFd = -1
+
+    def spawn(self):
+        (rfd, wfd) = os.pipe()
+        env = os.environ.copy()
+        env["LVM_REPORT_FD"] = str(REPORT_FD)
+        env["LC_ALL"] = "C"
+        maxFd = os.sysconf("SC_OPEN_MAX")
+        def setupChild():
+            os.dup2(wfd, REPORT_FD)
+            for fd in range(REPORT_FD + 1, maxFd):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        _setCloexec(rfd)
+        try:
+            self.proc = subprocess.Popen([LVM_CMD], stdin = subprocess.PIPE,
+                    stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                    env = env, preexec_fn = setupChild)
+        finally:
+            os.close(wfd)
+        self.reportFd = rfd
+        # the processes we spawn without close_fds (e.g. tap-ctl) must not
+        # hold on to the shell's stdin, or close() would wait for them
+        for f in [self.proc.stdin, self.proc.stdout, self.proc.stderr]:
+            _setCloexec(f.fileno())
+        try:
+            self._read(False, STARTUP_TIMEOUT)
+        except LVMShellExited:
+            self.proc.wait()
+            raise LVMShellUnsupported("lvm exited without a prompt")
+
+    def close(self):
+        if not self.proc:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            pass
+        os.close(self.reportFd)
+        self.proc = None
+
+    def abandon(self):
+        """Drop our side of the pipes to the shell without waiting for it,
+        which is for the process that spawned it to do"""
+        if not self.proc:
+            return
+        for f in [self.proc.stdin, self.proc.stdout, self.proc.stderr]:
+            try:
+                f.close()
+            except (IOError, OSError):
+                pass
+        try:
+            os.close(self.reportFd)
+        except OSError:
+            pass
+        self.proc = None
+
+    def execute(self, args):
+        """Run the LVM command 'args' (the tool name followed by its
+        arguments). Return (report, text, stdout, stderr): the decoded JSON
+        report, and its text (which has the order of the fields)"""
+        line = " ".join(map(_quote, args + ["--config", SHELL_CONFIG]))
+        try:
+            self.proc.stdin.write(line + "\n")
+            self.proc.stdin.flush()
+        except IOError, e:
+            raise LVMShellException("Failed to write to the lvm shell: %s" % e)
+        return self._read(True)
+
+    def _read(self, wantReport, timeout = None):
+        """Read the output of the last command up to the next prompt, and its
+        report"""
+        bufs = {self.proc.stdout.fileno(): [],
+                self.proc.stderr.fileno(): [],
+                self.reportFd: []}
+        out = bufs[self.proc.stdout.fileno()]
+        while not "".join(out).endswith(PROMPT):
+            if not self._readSome(bufs, timeout):
+                raise LVMShellException("No prompt from the lvm shell")
+        report = "".join(bufs[self.reportFd])
+        doc = None
+        while wantReport:
+            try:
+                doc = simplejson.loads(report)
+                break
+            except ValueError:
+                if not self._readSome(bufs, REPORT_TIMEOUT):
+                    raise LVMShellUnsupported("No report from the lvm shell")
+                report = "".join(bufs[self.reportFd])
+        while self._readSome(bufs, 0):
+            pass
+        stdout = "".join(out)[:-len(PROMPT)]
+        stderr = "".join(bufs[self.proc.stderr.fileno()])
+        return (doc, report, stdout, stderr)
+
+    def _readSome(self, bufs, timeout):
+        (readable, w, x) = select.select(bufs.keys(), [], [], timeout)
+        for fd in readable:
+            data = os.read(fd, 65536)
+            if not data:
+                raise LVMShellExited("The lvm shell exited")
+            bufs[fd].append(data)
+        return len(readable) > 0
+
+
+def _setCloexec(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _quote(arg):
+    if arg.find('"') != -1:
+        raise LVMShellException("Can't pass %s to the lvm shell" % arg)
+    if len(arg.split()) != 1:
+        return '"%s"' % arg
+    return arg
+
+def _parseReport(doc, text):
+    """Turn the JSON report 'doc' into "--noheadings" text lines, and find
+    the command status in it. 'text' is the report as printed by LVM"""
+    lines = []
+    status = None
+    for report in doc.get("report", []):
+        for name, rows in report.iteritems():
+            if not rows:
+                continue
+            fields = _getFieldOrder(rows[0], text, text.find('"%s"' % name))
+            for row in rows:
+                lines.append("  %s" % \
+                        " ".join(map(lambda x: str(row[x]), fields)))
+    for rec in doc.get("log", []):
+        if rec.get("log_type") == "status" and (not status or \
+                rec.get("log_context") == "shell"):
+            status = rec
+    return (lines, status)
+
+def _getFieldOrder(row, text, start):
+    """The keys of report row 'row', in the order of the columns (as the
+    decoded JSON objects don't keep it): the order they first appear in the
+    report text after position 'start', i.e. in the first row"""
+    pos = {}
+    for key in row.keys():
+        pos[key] = text.find('"%s"' % key, start)
+    fields = row.keys()
+    fields.sort(lambda x, y: cmp(pos[x], pos[y]))
+    return fields
+
+
+_mutex = threading.Lock()
+_users = 0
+_shell = None
+_unsupported = False
+_failed = False # the shell failed to start: fork until the last stop()
+
+def start():
+    """Run the LVM commands of this process in a shell until the matching
+    stop(). The shell itself is only spawned for the first command"""
+    global _users
+    _mutex.acquire()
+    try:
+        _users += 1
+    finally:
+        _mutex.release()
+
+def stop():
+    global _users, _shell, _failed
+    _mutex.acquire()
+    try:
+        if _users == 0:
+            return
+        _users -= 1
+        if _users == 0:
+            _failed = False
+            if _shell:
+                _shell.close()
+                _shell = None
+    finally:
+        _mutex.release()
+
+def afterFork():
+    """To be called in a child process forked between start() and stop():
+    the shell belongs to the parent, and sharing it would interleave the
+    commands of both processes (and the parent's stop() could not see the
+    shell exit while we hold its stdin)"""
+    global _mutex, _users, _shell, _failed
+    # NB. the parent may have held the mutex in another thread
+    _mutex = threading.Lock()
+    _users = 0
+    _failed = False
+    if _shell:
+        _shell.abandon()
+        _shell = None
+
+def run(cmd):
+    """Run LVM command 'cmd' (a list: the tool path, as in lvutil.CMD_*,
+    followed by its arguments) in the shell, and return its output or raise
+    util.CommandException as util.pread2() would. Return None without
+    running it if the shell isn't in use or can't be used"""
+    global _shell, _unsupported
+    _mutex.acquire()
+    try:
+        if not _users or _unsupported or _failed:
+            return None
+        if not _shell and not _spawn():
+            return None
+        args = [os.path.basename(cmd[0])] + cmd[1:]
+        util.SMlog(cmd)
+        try:
+            (doc, text, stdout, stderr) = _shell.execute(args)
+            (lines, status) = _parseReport(doc, text)
+        except (LVMShellException, ValueError, AttributeError), e:
+            util.SMlog("lvm shell failed: %s" % e)
+            _shell.close()
+            _shell = None
+            raise util.CommandException(errno.EIO, str(cmd), str(e))
+    finally:
+        _mutex.release()
+    if not status:
+        raise util.CommandException(errno.EIO, str(cmd),
+                "No status from the lvm shell")
+    rc = int(status["log_ret_code"])
+    if rc != ECMD_PROCESSED:
+        util.SMlog("FAILED: (rc %d) stdout: '%s', stderr: '%s'" % \
+                (rc, stdout, stderr))
+        raise util.CommandException(rc, str(cmd), stderr.strip())
+    if lines:
+        stdout = "".join(map(lambda x: x + "\n", lines)) + stdout
+    util.SMlog("SUCCESS")
+    return stdout
+
+def _spawn():
+    """Start the shell, and check that it reports the command status (the
+    status itself doesn't matter: the VG may just be unavailable). Called 
+    with _mutex held"""
+    global _shell, _unsupported, _failed
+    version = _getVersion()
+    if version and _readUnsupported() == version:
+        _unsupported = True
+        return False
+    shell = LVMShell()
+    try:
+        shell.spawn()
+        (doc, text, stdout, stderr) = shell.execute(["vgs", "--noheadings",
+            "-o", "vg_name"])
+        (lines, status) = _parseReport(doc, text)
+        if not status:
+            raise LVMShellUnsupported("no command status")
+    except Exception, e:
+        try:
+            shell.close()
+        except Exception:
+            pass
+        if isinstance(e, LVMShellUnsupported):
+            util.SMlog("lvm shell not supported, forking LVM commands: %s" % e)
+            _unsupported = True
+            if version:
+                _writeUnsupported(version)
+        else:
+            util.SMlog("lvm shell failed to start, forking LVM commands: %s" \
+                    % e)
+            _failed = True
+        return False
+    _shell = shell
+    return True
+
+def _getVersion():
+    """Identify the installed lvm binary, or return None"""
+    try:
+        st = os.stat(LVM_CMD)
+    except OSError:
+        return None
+    return "%d %d %d" % (st.st_ino, st.st_size, st.st_mtime)
+
+def _readUnsupported():
+    """The version of the lvm binary found not to support the shell, if
+    any"""
+    try:
+        f = open(UNSUPPORTED_FILE, 'r')
+        try:
+            return f.read().strip()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+def _writeUnsupported(version):
+    tmpPath = "%s.%d" % (UNSUPPORTED_FILE, os.getpid())
+    try:
+        f = open(tmpPath, 'w')
+        try:
+            f.write(version + "\n")
+        finally:
+            f.close()
+        os.rename(tmpPath, UNSUPPORTED_FILE)
+    except (IOError, OSError), e:
+        util.SMlog("Failed to record %s: %s" % (UNSUPPORTED_FILE, e))
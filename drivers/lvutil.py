@@ -28,6 +28,9 @@ from lvhdutil import VG_LOCATION,VG_PREFIX
 import lvmcache
 import srmetadata
 import vhdutil
+import vgledger
+import lvmshell
+import devmapper
 
 MDVOLUME_NAME = 'MGT'
 VDI_UUID_TAG_PREFIX = 'vdi_'
@@ -70,6 +73,14 @@ class LVInfo:
                 (self.name, self.size, self.active, self.open, self.hidden, \
                 self.readonly)
 
+def runLVM(cmd):
+    """Run LVM command 'cmd' in this process's LVM shell if it has one
+    (see lvmshell), or fork it otherwise. Return its output; raise
+    util.CommandException on failure"""
+    text = lvmshell.run(cmd)
+    if text is None:
+        text = util.pread2(cmd)
+    return text
 
 def _checkVG(vgname):
     try:
@@ -90,7 +101,7 @@ def _checkPV(pvname):
 def _checkLV(path):
     try:
         cmd = [CMD_LVDISPLAY, path]
-        util.pread2(cmd)
+        runLVM(cmd)
         return True
     except:
         return False
@@ -98,7 +109,7 @@ def _checkLV(path):
 def _getLVsize(path):
     try:
         cmd = [CMD_LVDISPLAY, "-c", path]
-        lines = util.pread2(cmd).split(':')
+        lines = runLVM(cmd).split(':')
         return long(lines[6]) * 512
     except:
         raise xs_errors.XenError('VDIUnavailable', \
@@ -107,7 +118,7 @@ def _getLVsize(path):
 def _getVGstats(vgname):
     try:
         cmd = [CMD_VGS, "--noheadings", "--nosuffix", "--units", "b", vgname]
-        text = util.pread(cmd).split()
+        text = runLVM(cmd).split()
         size = long(text[5])
         freespace = long(text[6])
         utilisation = size - freespace
@@ -122,6 +133,62 @@ def _getVGstats(vgname):
     except ValueError:
         raise xs_errors.XenError('VDILoad', opterr='rvgstats failed')
 
+def getVGSeqno(vgname):
+    """Get the VG metadata sequence number, which changes whenever the VG
+    metadata changes (LVs created, removed, renamed, resized, re-tagged...)"""
+    try:
+        cmd = [CMD_VGS, "--noheadings", "-o", "vg_seqno", vgname]
+        return int(runLVM(cmd).strip())
+    except ValueError:
+        raise util.SMException("Failed to get the seqno of VG %s" % vgname)
+
+def getVGInfo(vgname):
+    """Get (seqno, stats) of VG vgname with a single vgs call, stats being
+    as returned by _getVGstats()"""
+    try:
+        cmd = [CMD_VGS, "--noheadings", "--nosuffix", "--units", "b", "-o",
+                "vg_seqno,vg_size,vg_free", vgname]
+        text = runLVM(cmd).split()
+        seqno = int(text[0])
+        size = long(text[1])
+        freespace = long(text[2])
+        stats = {}
+        stats['physical_size'] = size
+        stats['physical_utilisation'] = size - freespace
+        stats['freespace'] = freespace
+        return (seqno, stats)
+    except (ValueError, IndexError):
+        raise util.SMException("Failed to get the stats of VG %s" % vgname)
+
+def _invalidateVGStats(path):
+    """The free space of the VG of LV 'path' has changed: forget the stats
+    cached in the VG ledger"""
+    vgname = path.split('/')[2]
+    try:
+        vgledger.VGLedger.invalidate(vgname)
+    except util.SMException, e:
+        util.SMlog("Failed to invalidate the ledger of %s: %s" % (vgname, e))
+
+def getDMOpenCounts(vgname):
+    """Get {LV name: open count} for all the LVs of VG vgname that are active
+    (i.e. have a device-mapper device) on this host. Unlike "lvs", this does 
+    not read the VG metadata"""
+    cmd = [CMD_DMSETUP, "info", "-c", "--noheadings", "-o", "name,open",
+            "--separator", " "]
+    # device-mapper names are "<VG>-<LV>" with any "-" in the names doubled
+    prefix = vgname.replace("-", "--") + "-"
+    counts = {}
+    for line in util.pread2(cmd).split('\n'):
+        fields = line.split()
+        if len(fields) != 2 or not fields[0].startswith(prefix):
+            continue
+        try:
+            counts[fields[0][len(prefix):].replace("--", "-")] = \
+                    int(fields[1])
+        except ValueError:
+            continue
+    return counts
+
 def _getPVstats(dev):
     try:
         cmd = [CMD_PVS, "--noheadings", "--nosuffix", "--units", "b", dev]
@@ -351,7 +418,10 @@ def create(name, size, vgname, tag = None, activate = True):
         cmd.extend(["--addtag", tag])
     if not activate:
         cmd.extend(["--inactive", "--zero=n"])
-    util.pread2(cmd)
+    try:
+        runLVM(cmd)
+    finally:
+        _invalidateVGStats(os.path.join(VG_LOCATION, vgname, name))
 
 def remove(path):
     # see deactivateNoRefcount()
@@ -363,22 +433,42 @@ def remove(path):
             if i >= LVM_FAIL_RETRIES - 1:
                 raise
             util.SMlog("*** lvremove failed on attempt #%d" % i)
+    _invalidateVGStats(path)
     _lvmBugCleanup(path)
 
 def _remove(path):
     cmd = [CMD_LVREMOVE, "-f", path]
-    ret = util.pread2(cmd)
+    ret = runLVM(cmd)
+
+def removeMany(paths):
+    """Remove several LVs of the same VG with a single lvremove (one LVM 
+    process and VG lock instead of one per LV). If that fails, fall back to 
+    removing the LVs that remain one by one"""
+    if not paths:
+        return
+    cmd = [CMD_LVREMOVE, "-f"] + paths
+    try:
+        runLVM(cmd)
+    except util.CommandException, e:
+        util.SMlog("*** batch lvremove failed (%d), removing one by one" % \
+                e.code)
+        for path in paths:
+            if _checkLV(path):
+                remove(path)
+    _invalidateVGStats(paths[0])
+    for path in paths:
+        _lvmBugCleanup(path)
 
 def rename(path, newName):
     cmd = [CMD_LVRENAME, path, newName]
-    util.pread(cmd)
+    runLVM(cmd)
 
 def setReadonly(path, readonly):
     val = "r"
     if not readonly:
         val += "w"
     cmd = [CMD_LVCHANGE, path, "-p", val]
-    ret = util.pread(cmd)
+    ret = runLVM(cmd)
 
 #def getSize(path):
 #    return _getLVsize(path)
@@ -390,10 +480,13 @@ def setReadonly(path, readonly):
 def setSize(path, size, confirm):
     sizeMB = size / (1024 * 1024)
     cmd = [CMD_LVRESIZE, "-L", str(sizeMB), path]
-    if confirm:
-        util.pread3(cmd, "y\n")
-    else:
-        util.pread(cmd)
+    try:
+        if confirm:
+            util.pread3(cmd, "y\n")
+        else:
+            runLVM(cmd)
+    finally:
+        _invalidateVGStats(path)
 
 #def getTagged(path, tag):
 #    """Return LV names of all LVs that have tag 'tag'; 'path' is either a VG
@@ -420,17 +513,17 @@ def setHidden(path, hidden = True):
     if not hidden:
         opt = "--deltag"
     cmd = [CMD_LVCHANGE, opt, LV_TAG_HIDDEN, path]
-    util.pread2(cmd)
+    runLVM(cmd)
 
 def activateNoRefcount(path, refresh):
     cmd = [CMD_LVCHANGE, "-ay", path]
     if refresh:
         cmd.append("--refresh")
-    text = util.pread2(cmd)
+    text = runLVM(cmd)
     if not _checkActive(path):
         raise util.CommandException(-1, str(cmd), "LV not activated")
     if refresh:
-        mapperDevice = path[5:].replace("-", "--").replace("/", "-")
+        mapperDevice = devmapper.getDMName(path)
         cmd = [CMD_DMSETUP, "table", mapperDevice]
         ret = util.pread(cmd)
         util.SMlog("DM table for %s: %s" % (path, ret.strip()))
@@ -455,7 +548,47 @@ def deactivateNoRefcount(path):
 
 def _deactivate(path):
     cmd = [CMD_LVCHANGE, "-an", path]
-    text = util.pread2(cmd)
+    text = runLVM(cmd)
+
+def activateMany(paths):
+    """Activate several LVs of the same VG with a single lvchange. Any LV that
+    the batch command did not bring up is retried on its own, so that the
+    error reported is the one for the offending LV"""
+    if not paths:
+        return
+    cmd = [CMD_LVCHANGE, "-ay"] + paths
+    try:
+        runLVM(cmd)
+    except util.CommandException, e:
+        util.SMlog("*** batch lvchange -ay failed (%d), retrying one by one" % \
+                e.code)
+    for path in paths:
+        if not _checkActive(path):
+            activateNoRefcount(path, False)
+
+def deactivateMany(paths):
+    """Deactivate several LVs of the same VG with a single lvchange. If the
+    batch command fails, fall back to deactivateNoRefcount() (with its
+    retries) for each LV. Returns the list of paths that could not be
+    deactivated"""
+    failed = []
+    if not paths:
+        return failed
+    cmd = [CMD_LVCHANGE, "-an"] + paths
+    try:
+        runLVM(cmd)
+        for path in paths:
+            _lvmBugCleanup(path)
+    except util.CommandException, e:
+        util.SMlog("*** batch lvchange -an failed (%d), retrying one by one" % \
+                e.code)
+        for path in paths:
+            try:
+                deactivateNoRefcount(path)
+            except util.CommandException:
+                util.logException("deactivateMany")
+                failed.append(path)
+    return failed
 
 #def getLVInfo(path):
 #    cmd = [CMD_LVS, "--noheadings", "--units", "b", "-o", "+lv_tags", path]
@@ -484,15 +617,10 @@ def _checkActive(path):
     symlinkExists = os.path.lexists(path)
     util.SMlog("_checkActive: symlink exists: %s" % symlinkExists)
 
-    mapperDeviceExists = False
-    mapperDevice = path[5:].replace("-", "--").replace("/", "-")
-    cmd = [CMD_DMSETUP, "status", mapperDevice]
-    try:
-        ret = util.pread2(cmd)
-        mapperDeviceExists = True
-        util.SMlog("_checkActive: %s: %s" % (mapperDevice, ret))
-    except util.CommandException:
-        util.SMlog("_checkActive: device %s does not exist" % mapperDevice)
+    mapperDevice = devmapper.getDMName(path)
+    mapperDeviceExists = devmapper.getInventory().exists(mapperDevice)
+    util.SMlog("_checkActive: device %s exists: %s" % \
+            (mapperDevice, mapperDeviceExists))
 
     mapperPath = "/dev/mapper/" + mapperDevice
     mapperPathExists = util.pathexists(mapperPath)
@@ -513,16 +641,11 @@ def _checkActive(path):
 def _lvmBugCleanup(path):
     # the device should not exist at this point. If it does, this was an LVM 
     # bug, and we manually clean up after LVM here
-    mapperDevice = path[5:].replace("-", "--").replace("/", "-")
-    mapperPath = "/dev/mapper/" + mapperDevice
-            
-    nodeExists = False
-    cmd = [CMD_DMSETUP, "status", mapperDevice]
-    try:
-        util.pread(cmd, expect_rc=1)
-    except util.CommandException, e:
-        if e.code == 0:
-            nodeExists = True
+    mapperDevice = devmapper.getDMName(path)
+    mapperPath = os.path.join(devmapper.DEV_MAPPER, mapperDevice)
+
+    inventory = devmapper.getInventory()
+    nodeExists = inventory.exists(mapperDevice)
 
     if not util.pathexists(mapperPath) and not nodeExists:
         return
@@ -531,7 +654,8 @@ def _lvmBugCleanup(path):
 
     # destroy the dm device
     if nodeExists:
-        util.SMlog("_lvmBugCleanup: removing dm device %s" % mapperDevice)
+        util.SMlog("_lvmBugCleanup: removing dm device %s (holders: %s)" % \
+                (mapperDevice, inventory.getHolders(mapperDevice)))
         cmd = [CMD_DMSETUP, "remove", mapperDevice]
         for i in range(LVM_FAIL_RETRIES):
             try:
@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Background pre-warming of IntelliCache read caches.
+#
+# The local read cache of a shared parent VHD (<parent uuid>.vhdcache on the
+# local cache SR) starts empty and is filled by its tapdisk as guests miss.
+# The pre-warmer reads, in order and at a limited rate, every block that is
+# allocated in the shared chain but not yet in the cache, through the tapdev
+# of the parent caching tapdisk. Tapdisk handles these reads like any guest
+# miss: it fetches the data from the shared SR and stores it in the cache.
+# Going through tapdisk keeps a single writer of the cache VHD.
+#
+# start() runs the pre-warmer as a detached process; at most one runs per
+# cache file. It stops once all blocks are cached, when the caching tapdisk
+# goes away, or when the cache SR runs short of space. Whatever tears down
+# the cache file or its tapdisk calls stop() first.
+#
+
+import os
+import sys
+import time
+import array
+import errno
+import signal
+import subprocess
+
+import util
+import blktap2
+import vhdreader
+from lock import Lock
+
+PREWARM_CMD = "/opt/xensource/sm/prewarm.py"
+LOCK_NS = "prewarm"
+PID_DIR = "/var/run/sm/prewarm"
+RATE_DEFAULT = 16 * 1024 * 1024 # bytes per second
+MIN_FREE = 0.1                  # stop below this share of free cache SR space
+PROGRESS_INTERVAL = 60          # seconds between progress messages
+READ_SIZE = 256 * 1024
+
+class PrewarmException(util.SMException):
+    pass
+
+def _readChain(cachePath):
+    """Return (block size, virtual size, bitmap of the blocks allocated in
+    the shared chain of cachePath, bitmap of the blocks allocated in
+    cachePath), the bitmaps as byte arrays, most significant bit first"""
+    vhd = vhdreader.VHDFile(cachePath)
+    try:
+        if not vhd.isDiff():
+            raise PrewarmException("%s: no parent" % cachePath)
+        blockSize = vhd.header.blockSize
+        sizeVirt = vhd.footer.currSize
+        cached = array.array('B', vhd.getBlockBitmap())
+        shared = array.array('B', "\0" * len(cached))
+        visited = [os.path.realpath(cachePath)]
+        while vhd.isDiff():
+            if vhd.isParentRaw():
+                # everything is allocated in a raw parent
+                shared = array.array('B', "\xff" * len(cached))
+                break
+            parentPath = vhd.getParentPath()
+            if os.path.realpath(parentPath) in visited:
+                raise PrewarmException("%s: loop in VHD chain" % cachePath)
+            visited.append(os.path.realpath(parentPath))
+            vhd.close()
+            vhd = vhdreader.VHDFile(parentPath)
+            if vhd.header.blockSize != blockSize:
+                raise PrewarmException("%s: block size %d != %d" % \
+                        (parentPath, vhd.header.blockSize, blockSize))
+            bitmap = vhd.getBlockBitmap()
+            for i in xrange(min(len(bitmap), len(shared))):
+                shared[i] |= ord(bitmap[i])
+    finally:
+        vhd.close()
+    return (blockSize, sizeVirt, shared, cached)
+
+def getPendingBlocks(cachePath):
+    """Return the block size and virtual size of cache cachePath, and the
+    blocks allocated in its shared chain but not yet in the cache"""
+    (blockSize, sizeVirt, shared, cached) = _readChain(cachePath)
+    numBlocks = (sizeVirt + blockSize - 1) / blockSize
+    pending = []
+    for i in xrange(len(shared)):
+        bits = shared[i] & ~cached[i]
+        if not bits:
+            continue
+        for bit in range(8):
+            block = i * 8 + bit
+            if bits & (0x80 >> bit) and block < numBlocks:
+                pending.append(block)
+    return (blockSize, sizeVirt, pending)
+
+
+class Prewarmer:
+    """Reads the uncached blocks of one cache file through its tapdisk"""
+
+    def __init__(self, cachePath, rate = None):
+        self.cachePath = cachePath
+        self.rate = rate or RATE_DEFAULT
+        self.srPath = os.path.dirname(cachePath)
+
+    def _spaceLeft(self):
+        st = os.statvfs(self.srPath)
+        return st.f_bavail >= st.f_blocks * MIN_FREE
+
+    def run(self):
+        tapdisk = blktap2.Tapdisk.find_by_path(self.cachePath)
+        if not tapdisk:
+            util.SMlog("prewarm: no tapdisk for %s, nothing to do" % \
+                    self.cachePath)
+            return
+        devPath = tapdisk.get_devpath()
+        (blockSize, sizeVirt, pending) = getPendingBlocks(self.cachePath)
+        util.SMlog("prewarm: %s: %d blocks of %d bytes to read through %s " \
+                "at %d B/s" % (self.cachePath, len(pending), blockSize,
+                    devPath, self.rate))
+        if not pending:
+            return
+
+        fd = os.open(devPath, os.O_RDONLY)
+        try:
+            start = time.time()
+            lastProgress = start
+            done = 0
+            for block in pending:
+                if not self._spaceLeft():
+                    util.SMlog("prewarm: %s: cache SR short of space, " \
+                            "stopping" % self.cachePath)
+                    break
+                try:
+                    self._readBlock(fd, block * blockSize, blockSize)
+                except (IOError, OSError), e:
+                    if e.errno in (errno.ENXIO, errno.ENODEV, errno.EIO):
+                        util.SMlog("prewarm: %s: %s gone (%s), stopping" % \
+                                (self.cachePath, devPath, e))
+                        break
+                    raise
+                done += 1
+
+                now = time.time()
+                if now - lastProgress >= PROGRESS_INTERVAL:
+                    util.SMlog("prewarm: %s: %d/%d blocks read" % \
+                            (self.cachePath, done, len(pending)))
+                    lastProgress = now
+                delay = float(done) * blockSize / self.rate - (now - start)
+                if delay > 0:
+                    time.sleep(delay)
+            util.SMlog("prewarm: %s: done, %d/%d blocks read in %ds" % \
+                    (self.cachePath, done, len(pending), time.time() - start))
+        finally:
+            # the data is in the cache file now: don't keep it in dom0
+            # memory too
+            try:
+                util.flush_blockdev_buffers(fd)
+            except (IOError, OSError), e:
+                util.SMlog("prewarm: %s: failed to drop the cached pages: " \
+                        "%s" % (devPath, e))
+            os.close(fd)
+
+    def _readBlock(self, fd, offset, size):
+        os.lseek(fd, offset, 0)
+        done = 0
+        while done < size:
+            # NB. the last block may be short of the end of the tapdev
+            data = os.read(fd, min(size - done, READ_SIZE))
+            if not data:
+                break
+            done += len(data)
+
+
+def start(cachePath, rate = None):
+    """Pre-warm cache file cachePath in the background"""
+    args = [PREWARM_CMD, cachePath]
+    if rate:
+        args.append(str(rate))
+    util.SMlog("prewarm: starting %s" % args)
+    devNull = open("/dev/null", 'r+')
+    try:
+        # NB. it daemonizes, so this returns right away
+        subprocess.Popen(args, stdin = devNull, stdout = devNull,
+                stderr = devNull, close_fds = True).wait()
+    finally:
+        devNull.close()
+
+def stop(cachePath):
+    """Stop the pre-warmer of cachePath, if one is running, and return its
+    lock, held: no pre-warmer starts on cachePath until it is released"""
+    lock = Lock(os.path.basename(cachePath), LOCK_NS)
+    while not lock.acquireNoblock():
+        # NB. the pid is written once the lock is taken: until then, retry
+        pid = _getPid(cachePath)
+        if pid:
+            util.SMlog("prewarm: stopping %d (%s)" % (pid, cachePath))
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+        time.sleep(1)
+    return lock
+
+def _getPidPath(cachePath):
+    return os.path.join(PID_DIR, os.path.basename(cachePath))
+
+def _getPid(cachePath):
+    """The pid in the pid file of cachePath if it is a pre-warmer of
+    cachePath (the pid file of a killed one stays behind), else None"""
+    try:
+        f = open(_getPidPath(cachePath), 'r')
+        try:
+            pid = int(f.read())
+        finally:
+            f.close()
+        f = open("/proc/%d/cmdline" % pid, 'r')
+        try:
+            cmdline = f.read().split("\0")
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    if not cachePath in cmdline:
+        return None
+    return pid
+
+def _run(cachePath, rate):
+    lock = Lock(os.path.basename(cachePath), LOCK_NS)
+    if not lock.acquireNoblock():
+        util.SMlog("prewarm: %s already being pre-warmed" % cachePath)
+        return
+    try:
+        pidPath = _getPidPath(cachePath)
+        if not util.pathexists(PID_DIR):
+            os.makedirs(PID_DIR)
+        f = open(pidPath, 'w')
+        try:
+            f.write("%d\n" % os.getpid())
+        finally:
+            f.close()
+        try:
+            Prewarmer(cachePath, rate).run()
+        finally:
+            os.unlink(pidPath)
+    finally:
+        lock.release()
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print >>sys.stderr, "usage: %s <cache file> [<bytes per second>]" % \
+                sys.argv[0]
+        sys.exit(1)
+    cachePath = sys.argv[1]
+    rate = None
+    if len(sys.argv) == 3:
+        rate = int(sys.argv[2])
+    util.daemon()
+    # let stop() end a run cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        _run(cachePath, rate)
+    except SystemExit:
+        raise
+    except:
+        util.logException("prewarm %s" % cachePath)
+        sys.exit(1)
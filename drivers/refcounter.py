@@ -16,11 +16,26 @@
 # parameter "binary" specifies which of the two counters to update, while the 
 # return value is zero IFF both counters are zero
 #
-# Synchronization must be done at a higher level, by the users of this module
+# Each count is kept in its own file, BASE_DIR/<ns>/<obj>, replaced atomically
+# on every update. Beside the namespace directory, the index 
+# BASE_DIR/.<ns>.index is an append-only log of the updates: the lines of an
+# update ("<obj> <count> <binaryCount>") are appended before the object files 
+# are written, followed by a COMMIT_MARK line once they are. The index lets 
+# lookups and checkAll() read only what was appended since the last call 
+# (kept in a per-process cache) instead of every object file. An update left
+# without its COMMIT_MARK by a crash causes the index to be rebuilt from the 
+# object files, which remain the authority. The index is compacted once it 
+# has INDEX_SLACK more lines than there are objects.
+#
+# Updates of a namespace are serialized with a flock on BASE_DIR/.<ns>.lock. 
+# Synchronization of the individual counts must still be done at a higher 
+# level, by the users of this module
 #
 
 
 import os
+import fcntl
+import shutil
 import util
 from lock import Lock
 
@@ -34,6 +49,13 @@ class RefCounter:
 
     BASE_DIR = "/var/run/sm/refcount"
 
+    COMMIT_MARK = "."
+    INDEX_SLACK = 256
+
+    # per-process cache: ns -> (index inode, index size, index lines, 
+    # {obj: (count, binaryCount)})
+    _indexes = dict()
+
     def get(obj, binary, ns = None):
         """Get (inc ref count) 'obj' in namespace 'ns' (optional). 
         Returns new ref count"""
@@ -53,22 +75,62 @@ class RefCounter:
             return RefCounter._adjust(ns, obj, -1, 0)
     put = staticmethod(put)
 
+    def getMany(objs, binary, ns):
+        """get() each of 'objs' in namespace 'ns', committing all the changes
+        at once. Returns a dict obj -> new ref count"""
+        return RefCounter._adjustMany(ns, objs, binary, 1)
+    getMany = staticmethod(getMany)
+
+    def putMany(objs, binary, ns):
+        """put() each of 'objs' in namespace 'ns', committing all the changes
+        at once. Returns a dict obj -> new ref count"""
+        return RefCounter._adjustMany(ns, objs, binary, -1)
+    putMany = staticmethod(putMany)
+
     def set(obj, count, binaryCount, ns = None):
         """Set normal & binary counts explicitly to the specified values.
         Returns new ref count"""
         (obj, ns) = RefCounter._getSafeNames(obj, ns)
-        assert(count >= 0 and binaryCount >= 0)
-        if binaryCount > 1:
-            raise RefCounterException("Binary count = %d > 1" % binaryCount)
+        RefCounter._checkCounts(obj, count, binaryCount)
         RefCounter._set(ns, obj, count, binaryCount)
     set = staticmethod(set)
 
+    def setMany(counts, ns):
+        """Set the (count, binaryCount) values of several objects in namespace
+        'ns' in one update. 'counts' is a dict obj -> (count, binaryCount)"""
+        changes = dict()
+        for obj, (count, binaryCount) in counts.iteritems():
+            (safeObj, ns) = RefCounter._getSafeNames(obj, ns)
+            RefCounter._checkCounts(obj, count, binaryCount)
+            changes[safeObj] = (count, binaryCount)
+        f = RefCounter._lock(ns)
+        try:
+            table = RefCounter._load(ns)
+            for obj, counts in changes.items():
+                if table.get(obj, (0, 0)) == counts:
+                    del changes[obj]
+            RefCounter._commit(ns, table, changes)
+        finally:
+            RefCounter._unlock(f)
+        util.SMlog("Refcounts in %s set for %d objects" % (ns, len(counts)))
+    setMany = staticmethod(setMany)
+
     def check(obj, ns = None):
         """Get the ref count values for 'obj' in namespace 'ns' (optional)"""
         (obj, ns) = RefCounter._getSafeNames(obj, ns)
         return RefCounter._get(ns, obj)
     check = staticmethod(check)
 
+    def checkAll(ns):
+        """Get the ref count values of all objects in namespace 'ns' that have
+        a non-zero count, as a dict obj -> (count, binaryCount)"""
+        f = RefCounter._lock(ns)
+        try:
+            return RefCounter._load(ns).copy()
+        finally:
+            RefCounter._unlock(f)
+    checkAll = staticmethod(checkAll)
+
     def checkLocked(obj, ns):
         """Lock-protected access"""
         lock = Lock(obj, ns)
@@ -96,7 +158,8 @@ class RefCounter:
             if not util.pathexists(RefCounter.BASE_DIR):
                 return
             try:
-                nsList = os.listdir(RefCounter.BASE_DIR)
+                nsList = filter(lambda x: not x.startswith("."),
+                        os.listdir(RefCounter.BASE_DIR))
             except OSError:
                 raise RefCounterException("failed to get namespace list")
         for ns in nsList:
@@ -111,8 +174,43 @@ class RefCounter:
             raise RefCounterException("Binary delta = %d outside [-1;1]" % \
                     binaryDelta)
         (obj, ns) = RefCounter._getSafeNames(obj, ns)
-        (count, binaryCount) = RefCounter._get(ns, obj)
+        f = RefCounter._lock(ns)
+        try:
+            table = RefCounter._load(ns)
+            changes = dict()
+            ret = RefCounter._adjustEntry(ns, table, changes, obj, delta,
+                    binaryDelta)
+            RefCounter._commit(ns, table, changes)
+        finally:
+            RefCounter._unlock(f)
+        return ret
+    _adjust = staticmethod(_adjust)
 
+    def _adjustMany(ns, objs, binary, delta):
+        (delta, binaryDelta) = (delta, 0)
+        if binary:
+            (delta, binaryDelta) = (0, delta)
+        ret = dict()
+        if not objs:
+            return ret
+        safeNames = map(lambda obj: RefCounter._getSafeNames(obj, ns)[0], objs)
+        f = RefCounter._lock(ns)
+        try:
+            table = RefCounter._load(ns)
+            changes = dict()
+            for obj, safeObj in zip(objs, safeNames):
+                ret[obj] = RefCounter._adjustEntry(ns, table, changes, safeObj,
+                        delta, binaryDelta)
+            RefCounter._commit(ns, table, changes)
+        finally:
+            RefCounter._unlock(f)
+        return ret
+    _adjustMany = staticmethod(_adjustMany)
+
+    def _adjustEntry(ns, table, changes, obj, delta, binaryDelta):
+        """Apply the deltas to 'obj', recording the new counts in 'changes'
+        (which take precedence over 'table')"""
+        (count, binaryCount) = changes.get(obj, table.get(obj, (0, 0)))
         newCount = count + delta
         newBinaryCount = binaryCount + binaryDelta
         if newCount < 0:
@@ -126,29 +224,36 @@ class RefCounter:
         util.SMlog("Refcount for %s:%s (%d, %d) + (%d, %d) => (%d, %d)" % \
                 (ns, obj, count, binaryCount, delta, binaryDelta,
                     newCount, newBinaryCount))
-        RefCounter._set(ns, obj, newCount, newBinaryCount)
+        changes[obj] = (newCount, newBinaryCount)
         return newCount + newBinaryCount
-    _adjust = staticmethod(_adjust)
+    _adjustEntry = staticmethod(_adjustEntry)
+
+    def _checkCounts(obj, count, binaryCount):
+        assert(count >= 0 and binaryCount >= 0)
+        if binaryCount > 1:
+            raise RefCounterException("Binary count = %d > 1 for %s" % \
+                    (binaryCount, obj))
+    _checkCounts = staticmethod(_checkCounts)
 
     def _get(ns, obj):
         """Get the ref count values for 'obj' in namespace 'ns'"""
-        objFile = os.path.join(RefCounter.BASE_DIR, ns, obj)
-        (count, binaryCount) = (0, 0)
-        if util.pathexists(objFile):
-            (count, binaryCount) = RefCounter._readCount(objFile)
-        return (count, binaryCount)
+        f = RefCounter._lock(ns)
+        try:
+            return RefCounter._load(ns).get(obj, (0, 0))
+        finally:
+            RefCounter._unlock(f)
     _get = staticmethod(_get)
 
     def _set(ns, obj, count, binaryCount):
         """Set the ref count values for 'obj' in namespace 'ns'"""
         util.SMlog("Refcount for %s:%s set => (%d, %db)" % \
                 (ns, obj, count, binaryCount))
-        if count == 0 and binaryCount == 0:
-            RefCounter._removeObject(ns, obj)
-        else:
-            RefCounter._createNamespace(ns)
-            objFile = os.path.join(RefCounter.BASE_DIR, ns, obj)
-            RefCounter._writeCount(objFile, count, binaryCount)
+        f = RefCounter._lock(ns)
+        try:
+            table = RefCounter._load(ns)
+            RefCounter._commit(ns, table, {obj: (count, binaryCount)})
+        finally:
+            RefCounter._unlock(f)
     _set = staticmethod(_set)
 
     def _getSafeNames(obj, ns):
@@ -157,52 +262,228 @@ class RefCounter:
             ns = obj.split('/')[0]
             if not ns:
                 ns = "default"
-        for char in ['/', '*', '?', '\\']:
+        for char in ['/', '*', '?', '\\', ' ', '\n']:
             obj = obj.replace(char, "_")
         return (obj, ns)
     _getSafeNames = staticmethod(_getSafeNames)
 
-    def _createNamespace(ns):
-        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
-        if not util.pathexists(nsDir):
+    def _lock(ns):
+        """Take the update lock of namespace 'ns'. Returns the lock file, to
+        be passed to _unlock()"""
+        if not util.pathexists(RefCounter.BASE_DIR):
             try:
-                os.makedirs(nsDir)
+                os.makedirs(RefCounter.BASE_DIR)
             except OSError, e:
-                raise RefCounterException("failed to makedirs '%s' (%s)" % \
-                        (nsDir, e))
-    _createNamespace = staticmethod(_createNamespace)
-
-    def _removeObject(ns, obj):
-        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
-        objFile = os.path.join(nsDir, obj)
-        if not util.pathexists(objFile):
-            return
+                if not util.pathexists(RefCounter.BASE_DIR):
+                    raise RefCounterException("failed to makedirs '%s' (%s)" % \
+                            (RefCounter.BASE_DIR, e))
+        lockFile = os.path.join(RefCounter.BASE_DIR, ".%s.lock" % ns)
+        try:
+            f = open(lockFile, 'a')
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        except IOError, e:
+            raise RefCounterException("failed to lock '%s' (%s)" % \
+                    (lockFile, e))
+        return f
+    _lock = staticmethod(_lock)
+
+    def _unlock(f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+    _unlock = staticmethod(_unlock)
+
+    def _getIndexFile(ns):
+        return os.path.join(RefCounter.BASE_DIR, ".%s.index" % ns)
+    _getIndexFile = staticmethod(_getIndexFile)
+
+    def _load(ns):
+        """Return the counts of namespace 'ns' (to be treated as read-only), 
+        reading only the part of the index appended since the last call. Must
+        be called with the namespace lock held"""
+        indexFile = RefCounter._getIndexFile(ns)
         try:
-            os.unlink(objFile)
+            stat = os.stat(indexFile)
         except OSError:
-            raise RefCounterException("failed to remove '%s'" % objFile)
-        if not os.listdir(nsDir):
+            RefCounter._indexes.pop(ns, None)
+            if os.path.isdir(os.path.join(RefCounter.BASE_DIR, ns)):
+                # no index (yet): the namespace predates it
+                return RefCounter._rebuild(ns)
+            return dict()
+        cached = RefCounter._indexes.get(ns)
+        if cached and cached[0] == stat.st_ino and cached[1] <= stat.st_size:
+            (ino, offset, numLines, table) = cached
+            if offset == stat.st_size:
+                return table
+            table = table.copy()
+        else:
+            (offset, numLines, table) = (0, 0, dict())
+        try:
+            f = open(indexFile, 'r')
             try:
-                os.rmdir(nsDir)
-            except OSError:
-                raise RefCounterException("failed to remove '%s'" % nsDir)
-    _removeObject = staticmethod(_removeObject)
-
-    def _reset(ns, obj = None):
+                f.seek(offset)
+                data = f.read()
+            finally:
+                f.close()
+        except IOError:
+            raise RefCounterException("failed to read '%s'" % indexFile)
+        lines = data.split("\n")
+        if lines.pop() or not lines or lines[-1] != RefCounter.COMMIT_MARK:
+            util.SMlog("Refcount index of %s incomplete, rebuilding" % ns)
+            return RefCounter._rebuild(ns)
+        pending = []
+        for line in lines:
+            if line == RefCounter.COMMIT_MARK:
+                for obj, counts in pending:
+                    if counts == (0, 0):
+                        table.pop(obj, None)
+                    else:
+                        table[obj] = counts
+                pending = []
+                continue
+            try:
+                (obj, count, binaryCount) = line.split()
+                pending.append((obj, (int(count), int(binaryCount))))
+            except ValueError:
+                util.SMlog("Refcount index of %s corrupt, rebuilding" % ns)
+                return RefCounter._rebuild(ns)
+        RefCounter._indexes[ns] = (stat.st_ino, offset + len(data),
+                numLines + len(lines), table)
+        return table
+    _load = staticmethod(_load)
+
+    def _rebuild(ns):
+        """Recreate the index of namespace 'ns' from the object files. Must be
+        called with the namespace lock held"""
         nsDir = os.path.join(RefCounter.BASE_DIR, ns)
-        if not util.pathexists(nsDir):
-            return
-        if obj:
-            if not util.pathexists(os.path.join(nsDir, obj)):
-                return
-            objList = [obj]
-        else:
+        table = dict()
+        if os.path.isdir(nsDir):
             try:
                 objList = os.listdir(nsDir)
             except OSError:
-                raise RefCounterException("failed to list '%s'" % ns)
-        for obj in objList:
-            RefCounter._removeObject(ns, obj)
+                raise RefCounterException("failed to list '%s'" % nsDir)
+            for obj in objList:
+                if obj.startswith("."):
+                    continue # an interrupted _writeCount()
+                counts = RefCounter._readCount(os.path.join(nsDir, obj))
+                if counts != (0, 0):
+                    table[obj] = counts
+        RefCounter._writeIndex(ns, table)
+        return table
+    _rebuild = staticmethod(_rebuild)
+
+    def _writeIndex(ns, table):
+        """Atomically replace the index of namespace 'ns' with one listing 
+        'table'"""
+        indexFile = RefCounter._getIndexFile(ns)
+        lines = []
+        for obj, (count, binaryCount) in table.iteritems():
+            lines.append("%s %d %d\n" % (obj, count, binaryCount))
+        lines.append(RefCounter.COMMIT_MARK + "\n")
+        tmpFile = indexFile + ".tmp"
+        try:
+            f = open(tmpFile, 'w')
+            try:
+                f.writelines(lines)
+            finally:
+                f.close()
+            os.rename(tmpFile, indexFile)
+            stat = os.stat(indexFile)
+        except (IOError, OSError), e:
+            raise RefCounterException("failed to write '%s' (%s)" % \
+                    (indexFile, e))
+        RefCounter._indexes[ns] = (stat.st_ino, stat.st_size, len(lines),
+                table)
+    _writeIndex = staticmethod(_writeIndex)
+
+    def _commit(ns, table, changes):
+        """Write out 'changes' (obj -> (count, binaryCount)) to the counts
+        'table' of namespace 'ns', as returned by _load(). Must be called with
+        the namespace lock held"""
+        if not changes:
+            return
+        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
+        indexFile = RefCounter._getIndexFile(ns)
+        lines = []
+        for obj, (count, binaryCount) in changes.iteritems():
+            lines.append("%s %d %d\n" % (obj, count, binaryCount))
+        try:
+            if not util.pathexists(nsDir):
+                os.makedirs(nsDir)
+            RefCounter._append(indexFile, lines)
+            for obj, (count, binaryCount) in changes.iteritems():
+                fn = os.path.join(nsDir, obj)
+                if count == 0 and binaryCount == 0:
+                    if util.pathexists(fn):
+                        os.unlink(fn)
+                else:
+                    RefCounter._writeCount(fn, count, binaryCount)
+            size = RefCounter._append(indexFile,
+                    [RefCounter.COMMIT_MARK + "\n"])
+            stat = os.stat(indexFile)
+        except (IOError, OSError), e:
+            raise RefCounterException("failed to update '%s' (%s)" % \
+                    (nsDir, e))
+
+        table = table.copy()
+        for obj, counts in changes.iteritems():
+            if counts == (0, 0):
+                table.pop(obj, None)
+            else:
+                table[obj] = counts
+        if not table:
+            RefCounter._remove(ns)
+            return
+        cached = RefCounter._indexes.get(ns)
+        numLines = len(lines) + 1
+        if cached and cached[0] == stat.st_ino and \
+                cached[1] + len("".join(lines)) + 2 == size:
+            numLines += cached[2]
+        else:
+            numLines += RefCounter.INDEX_SLACK # unknown: compact it
+        if numLines > len(table) + RefCounter.INDEX_SLACK:
+            RefCounter._writeIndex(ns, table)
+        else:
+            RefCounter._indexes[ns] = (stat.st_ino, size, numLines, table)
+    _commit = staticmethod(_commit)
+
+    def _append(fn, lines):
+        "Append to file fn. Returns the new file size"
+        f = open(fn, 'a')
+        try:
+            f.writelines(lines)
+            f.flush()
+            return os.fstat(f.fileno()).st_size
+        finally:
+            f.close()
+    _append = staticmethod(_append)
+
+    def _remove(ns):
+        """Remove namespace 'ns' (all its object files and the index). Must be
+        called with the namespace lock held"""
+        RefCounter._indexes.pop(ns, None)
+        nsDir = os.path.join(RefCounter.BASE_DIR, ns)
+        indexFile = RefCounter._getIndexFile(ns)
+        try:
+            if util.pathexists(indexFile):
+                os.unlink(indexFile)
+            if util.pathexists(nsDir):
+                shutil.rmtree(nsDir)
+        except OSError, e:
+            raise RefCounterException("failed to remove '%s' (%s)" % \
+                    (nsDir, e))
+    _remove = staticmethod(_remove)
+
+    def _reset(ns, obj = None):
+        f = RefCounter._lock(ns)
+        try:
+            if obj:
+                table = RefCounter._load(ns)
+                if table.has_key(obj):
+                    RefCounter._commit(ns, table, {obj: (0, 0)})
+            else:
+                RefCounter._remove(ns)
+        finally:
+            RefCounter._unlock(f)
     _reset = staticmethod(_reset)
 
     def _readCount(fn):
@@ -219,16 +500,17 @@ class RefCounter:
     _readCount = staticmethod(_readCount)
 
     def _writeCount(fn, count, binaryCount):
+        "Atomically replace the object file fn"
+        tmpFile = os.path.join(os.path.dirname(fn),
+                ".%s.tmp" % os.path.basename(fn))
+        f = open(tmpFile, 'w')
         try:
-            f = open(fn, 'w')
             f.write("%d %d\n" % (count, binaryCount))
+        finally:
             f.close()
-        except IOError:
-            raise RefCounterException("failed to write '(%d %d)' to '%s'" % \
-                    (count, binaryCount, fn))
+        os.rename(tmpFile, fn)
     _writeCount = staticmethod(_writeCount)
 
-
     def _runTests():
         "Unit tests"
 
@@ -516,6 +798,67 @@ class RefCounter:
             print "Error: count = %d != 0 after C.resetAll-put" % cnt
             return -1
 
+        # the index of a namespace
+        RefCounter.getMany(["X", "Y", "Z"], False, "T")
+        RefCounter.putMany(["Y"], False, "T")
+        RefCounter.get("Z", True, "T")
+        expected = {"X": (1, 0), "Z": (1, 1)}
+        if RefCounter.checkAll("T") != expected:
+            print "Error: checkAll = %s after getMany-putMany" % \
+                    RefCounter.checkAll("T")
+            return -1
+
+        # as seen by another process, with nothing cached and with an old
+        # cache
+        RefCounter._indexes.clear()
+        if RefCounter.checkAll("T") != expected:
+            print "Error: checkAll = %s without the cache" % \
+                    RefCounter.checkAll("T")
+            return -1
+        oldIndex = RefCounter._indexes["T"]
+        RefCounter.put("X", False, "T")
+        RefCounter._indexes["T"] = oldIndex
+        if RefCounter.checkAll("T") != {"Z": (1, 1)}:
+            print "Error: checkAll = %s with an old cache" % \
+                    RefCounter.checkAll("T")
+            return -1
+
+        # an update interrupted before its commit mark, and a corrupt line:
+        # the object files are the authority
+        for line in ["X 5 0\n", "garbage\n.\n"]:
+            RefCounter._append(RefCounter._getIndexFile("T"), [line])
+            RefCounter._indexes.clear()
+            if RefCounter.checkAll("T") != {"Z": (1, 1)}:
+                print "Error: checkAll = %s after %r in the index" % \
+                        (RefCounter.checkAll("T"), line)
+                return -1
+
+        # a namespace that predates the index
+        os.unlink(RefCounter._getIndexFile("T"))
+        RefCounter._indexes.clear()
+        if RefCounter.check("Z", "T") != (1, 1):
+            print "Error: check = %s without the index" % \
+                    (RefCounter.check("Z", "T"),)
+            return -1
+
+        # compaction
+        for i in range(RefCounter.INDEX_SLACK * 2):
+            RefCounter.get("Z", False, "T")
+        f = open(RefCounter._getIndexFile("T"), 'r')
+        try:
+            numLines = len(f.readlines())
+        finally:
+            f.close()
+        if numLines > 1 + RefCounter.INDEX_SLACK + 2:
+            print "Error: %d lines in the index after %d updates" % \
+                    (numLines, RefCounter.INDEX_SLACK * 2)
+            return -1
+        RefCounter._indexes.clear()
+        (cnt, bcnt) = RefCounter.check("Z", "T")
+        if cnt != 1 + RefCounter.INDEX_SLACK * 2 or bcnt != 1:
+            print "Error: check = %d after compaction" % cnt
+            return -1
+
         RefCounter.resetAll()
 
         return 0
@@ -0,0 +1,390 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Tapdisk I/O statistics collector.
+#
+# The collector samples every tapdisk on the host each INTERVAL seconds and
+# keeps the last HISTORY samples of each VDI in a ring buffer. The I/O
+# counters (requests, sectors and ms spent, read and write) come from the
+# block-layer stat file of the tapdev in sysfs, so sampling takes a single
+# tap-ctl list and no further forks. Cache hits and misses are only known to
+# tapdisk itself, so "tap-ctl stats" is run for the IntelliCache tapdisks
+# only, and only every CACHE_SAMPLES samples.
+#
+# After each sample, the rates and latency percentiles over the buffered
+# window are written to STATS_FILE, along with the latest "tap-ctl stats" of
+# the caching tapdisks. Readers (lcache, the GC coalesce throttle, operators
+# through "tapstats.py show") use load(), which ignores the file once it is
+# older than MAX_AGE, i.e. when no collector is running.
+#
+
+import os
+import sys
+import time
+import errno
+import array
+import signal
+import simplejson
+
+import util
+import blktap2
+
+STATS_DIR = "/var/run/sm/tapstats"
+STATS_FILE = os.path.join(STATS_DIR, "stats")
+PID_FILE = os.path.join(STATS_DIR, "pid")
+SYS_BLOCK = "/sys/block"
+CACHE_NODE_EXT = ".vhdcache"
+
+INTERVAL = 5        # seconds between samples
+HISTORY = 120       # samples kept per VDI (10 minutes)
+CACHE_SAMPLES = 6   # run tap-ctl stats on caching tapdisks every 6 samples
+MAX_AGE = 3 * INTERVAL
+PERCENTILES = [50, 90, 99]
+SECTOR_SIZE = 512
+
+# the fields of one sample: cumulative counters, but for the time
+(F_TIME, F_RD_OPS, F_RD_SECS, F_RD_MS, F_WR_OPS, F_WR_SECS, F_WR_MS, F_HITS,
+        F_MISSES) = range(9)
+NUM_FIELDS = 9
+
+
+class RingBuffer:
+    """The last 'size' samples of a tapdisk, NUM_FIELDS numbers each, in one
+    flat array"""
+
+    def __init__(self, size):
+        self.size = size
+        self.data = array.array('d', [0]) * (size * NUM_FIELDS)
+        self.count = 0
+        self.head = 0 # index of the next sample to write
+
+    def append(self, sample):
+        start = self.head * NUM_FIELDS
+        self.data[start:start + NUM_FIELDS] = array.array('d', sample)
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def last(self):
+        if not self.count:
+            return None
+        return self.get(self.count - 1)
+
+    def get(self, i):
+        """Sample i, 0 being the oldest one kept"""
+        idx = (self.head - self.count + i) % self.size
+        return self.data[idx * NUM_FIELDS:(idx + 1) * NUM_FIELDS]
+
+    def samples(self):
+        return map(self.get, range(self.count))
+
+
+class Series:
+    """The samples of one tapdisk, with what identifies it"""
+
+    def __init__(self, tapdisk, srUuid, vdiUuid):
+        self.pid = tapdisk.pid
+        self.minor = tapdisk.minor
+        self.path = tapdisk.path
+        self.srUuid = srUuid
+        self.vdiUuid = vdiUuid
+        self.ring = RingBuffer(HISTORY)
+        self.tapctlStats = None
+
+    def key(self):
+        if self.vdiUuid:
+            return "%s/%s" % (self.srUuid, self.vdiUuid)
+        return self.path
+
+    def isCaching(self):
+        return self.path.endswith(CACHE_NODE_EXT)
+
+    def summarize(self):
+        """Rates and latencies over the samples kept, or None with fewer
+        than two samples"""
+        samples = self.ring.samples()
+        if len(samples) < 2:
+            return None
+        first = samples[0]
+        last = samples[-1]
+        window = last[F_TIME] - first[F_TIME]
+        if window <= 0:
+            return None
+
+        def rate(field, scale = 1):
+            return (last[field] - first[field]) * scale / window
+
+        rdLatencies = []
+        wrLatencies = []
+        for prev, cur in zip(samples[:-1], samples[1:]):
+            for ops, ms, latencies in [(F_RD_OPS, F_RD_MS, rdLatencies),
+                    (F_WR_OPS, F_WR_MS, wrLatencies)]:
+                if cur[ops] > prev[ops]:
+                    latencies.append((cur[ms] - prev[ms]) / \
+                            (cur[ops] - prev[ops]))
+
+        prev = samples[-2]
+        ops = (last[F_RD_OPS] - prev[F_RD_OPS]) + \
+                (last[F_WR_OPS] - prev[F_WR_OPS])
+        latency = 0
+        if ops > 0:
+            latency = ((last[F_RD_MS] - prev[F_RD_MS]) + \
+                    (last[F_WR_MS] - prev[F_WR_MS])) / ops
+
+        summary = {
+                "path": self.path,
+                "sr_uuid": self.srUuid,
+                "vdi_uuid": self.vdiUuid,
+                "pid": self.pid,
+                "minor": self.minor,
+                "window": window,
+                "rd_iops": rate(F_RD_OPS),
+                "wr_iops": rate(F_WR_OPS),
+                "rd_bps": rate(F_RD_SECS, SECTOR_SIZE),
+                "wr_bps": rate(F_WR_SECS, SECTOR_SIZE),
+                "rd_latency": _latencyStats(rdLatencies),
+                "wr_latency": _latencyStats(wrLatencies),
+                "latency": latency }
+        if self.isCaching():
+            hits = last[F_HITS] - first[F_HITS]
+            misses = last[F_MISSES] - first[F_MISSES]
+            summary["hit_bps"] = hits * SECTOR_SIZE / window
+            summary["miss_bps"] = misses * SECTOR_SIZE / window
+            summary["hit_ratio"] = None
+            if hits + misses > 0:
+                summary["hit_ratio"] = hits / (hits + misses)
+            summary["tapctl"] = self.tapctlStats
+        return summary
+
+
+def _latencyStats(latencies):
+    """Average and percentiles of the per-interval latencies (ms)"""
+    if not latencies:
+        return None
+    stats = {"avg": sum(latencies) / len(latencies)}
+    latencies = sorted(latencies)
+    for p in PERCENTILES:
+        # nearest rank
+        rank = max(int((p * len(latencies) + 99) / 100), 1)
+        stats["p%d" % p] = latencies[rank - 1]
+    return stats
+
+def _readBlockStat(minor):
+    """The (reads, read sectors, read ms, writes, write sectors, write ms)
+    block-layer counters of tapdev 'minor', or None if it's gone"""
+    try:
+        f = open(os.path.join(SYS_BLOCK, "tapdev%d" % minor, "stat"))
+        try:
+            fields = map(long, f.readline().split())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    if len(fields) < 8:
+        return None
+    return (fields[0], fields[2], fields[3], fields[4], fields[6], fields[7])
+
+def _cacheCounters(stats):
+    """Sectors read from the cache and from the shared parent, as lcache
+    counts them"""
+    images = stats["images"]
+    if images[-1]["driver"]["name"] == "vhd":
+        # parent cache: hits on the cache file, the rest went to the parent
+        hits = images[0]["hits"][0]
+        return (hits, stats["secs"][0] - hits)
+    # leaf: reads from the local leaf, and from the parent cache tapdev
+    return (images[0]["hits"][0], images[1]["hits"][0])
+
+def _getVDIPaths():
+    """Map the physical paths of the attached VDIs to (SR uuid, VDI uuid),
+    from the links blktap2 keeps for them"""
+    paths = {}
+    base = blktap2.VDI.PhyLink.BASEDIR
+    try:
+        srUuids = os.listdir(base)
+    except OSError:
+        return paths
+    for srUuid in srUuids:
+        try:
+            vdiUuids = os.listdir(os.path.join(base, srUuid))
+        except OSError:
+            continue
+        for vdiUuid in vdiUuids:
+            try:
+                target = os.readlink(os.path.join(base, srUuid, vdiUuid))
+            except OSError:
+                continue
+            paths[target] = (srUuid, vdiUuid)
+    return paths
+
+
+class Collector:
+    """Samples the tapdisks of this host"""
+
+    def __init__(self):
+        self.series = {} # minor -> Series
+        self.round = 0
+
+    def sample(self):
+        now = time.time()
+        blktap2.Tapdisk.registry.invalidate()
+        tapdisks = list(blktap2.Tapdisk.list())
+        vdiPaths = None
+        sampleCache = (self.round % CACHE_SAMPLES == 0)
+        self.round += 1
+
+        current = {}
+        for tapdisk in tapdisks:
+            series = self.series.get(tapdisk.minor)
+            if not series or series.pid != tapdisk.pid or \
+                    series.path != tapdisk.path:
+                if vdiPaths is None:
+                    vdiPaths = _getVDIPaths()
+                (srUuid, vdiUuid) = vdiPaths.get(tapdisk.path, (None, None))
+                series = Series(tapdisk, srUuid, vdiUuid)
+            counters = _readBlockStat(tapdisk.minor)
+            if counters is None:
+                continue # shut down meanwhile
+
+            hits = misses = 0
+            last = series.ring.last()
+            if last:
+                hits = last[F_HITS]
+                misses = last[F_MISSES]
+            if series.isCaching() and (sampleCache or not last):
+                try:
+                    series.tapctlStats = tapdisk.stats()
+                    (hits, misses) = _cacheCounters(series.tapctlStats)
+                except blktap2.TapCtl.CommandFailure, e:
+                    if e.status != errno.ENOENT:
+                        util.SMlog("tapstats: %s: %s" % (tapdisk, e))
+                    continue
+                except (KeyError, IndexError, TypeError, ValueError), e:
+                    util.SMlog("tapstats: unexpected stats for %s: %s" % \
+                            (tapdisk, e))
+
+            series.ring.append((now,) + counters + (hits, misses))
+            current[tapdisk.minor] = series
+        self.series = current
+
+    def summarize(self):
+        vdis = {}
+        for series in self.series.itervalues():
+            summary = series.summarize()
+            if summary:
+                vdis[series.key()] = summary
+        return {"time": time.time(), "interval": INTERVAL, "vdis": vdis}
+
+    def publish(self):
+        if not os.path.isdir(STATS_DIR):
+            os.makedirs(STATS_DIR)
+        tmpFile = "%s.%d" % (STATS_FILE, os.getpid())
+        f = open(tmpFile, 'w')
+        try:
+            simplejson.dump(self.summarize(), f)
+        finally:
+            f.close()
+        os.rename(tmpFile, STATS_FILE)
+
+    def run(self):
+        while True:
+            start = time.time()
+            try:
+                self.sample()
+                self.publish()
+            except Exception, e:
+                util.SMlog("tapstats: sampling failed: %s" % e)
+            time.sleep(max(INTERVAL - (time.time() - start), 0))
+
+
+def load(maxAge = MAX_AGE):
+    """The last summary written by the collector, or None if there is none
+    or it is older than 'maxAge' seconds (no collector running)"""
+    try:
+        f = open(STATS_FILE, 'r')
+        try:
+            summary = simplejson.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    if not (0 <= time.time() - summary.get("time", 0) <= maxAge):
+        return None
+    return summary
+
+def getTapctlStats(summary, tapdisk):
+    """The "tap-ctl stats" of caching tapdisk 'tapdisk' in 'summary', or None
+    if the collector has none for it"""
+    for vdi in summary["vdis"].itervalues():
+        if vdi["minor"] == tapdisk.minor and vdi["pid"] == tapdisk.pid and \
+                vdi["path"] == tapdisk.path:
+            return vdi.get("tapctl")
+    return None
+
+def getVDIStats(summary, srUuid, vdiUuid):
+    "The summary entry of VDI vdiUuid of SR srUuid, or None"
+    return summary["vdis"].get("%s/%s" % (srUuid, vdiUuid))
+
+def _fmtLatency(stats):
+    if not stats:
+        return "-"
+    return "%.1f/%.1f/%.1f" % (stats["p50"], stats["p90"], stats["p99"])
+
+def _show(summary, keys):
+    print "%-74s %8s %8s %10s %10s %15s %15s %6s" % ("VDI", "rd IOPS",
+            "wr IOPS", "rd B/s", "wr B/s", "rd ms p50/90/99",
+            "wr ms p50/90/99", "hit %")
+    vdis = summary["vdis"].items()
+    vdis.sort(lambda x, y: cmp(y[1]["rd_iops"] + y[1]["wr_iops"],
+        x[1]["rd_iops"] + x[1]["wr_iops"]))
+    for key, vdi in vdis:
+        if keys and not filter(lambda x: key.find(x) != -1, keys):
+            continue
+        hitRatio = "-"
+        if vdi.get("hit_ratio") is not None:
+            hitRatio = "%d" % (vdi["hit_ratio"] * 100)
+        print "%-74s %8.1f %8.1f %10d %10d %15s %15s %6s" % (key,
+                vdi["rd_iops"], vdi["wr_iops"], vdi["rd_bps"], vdi["wr_bps"],
+                _fmtLatency(vdi["rd_latency"]), _fmtLatency(vdi["wr_latency"]),
+                hitRatio)
+
+def _usage():
+    print >>sys.stderr, "usage: %s collect [-d] | show [<uuid|path>...]" % \
+            os.path.basename(sys.argv[0])
+    sys.exit(1)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        _usage()
+    cmd = sys.argv[1]
+    if cmd == "collect":
+        if sys.argv[2:] == ["-d"]:
+            util.daemon()
+        elif sys.argv[2:]:
+            _usage()
+        if not os.path.isdir(STATS_DIR):
+            os.makedirs(STATS_DIR)
+        f = open(PID_FILE, 'w')
+        f.write("%d\n" % os.getpid())
+        f.close()
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        util.SMlog("tapstats: collecting every %ds" % INTERVAL)
+        Collector().run()
+    elif cmd == "show":
+        summary = load()
+        if not summary:
+            print >>sys.stderr, "No current statistics: is the collector " \
+                    "running?"
+            sys.exit(1)
+        _show(summary, sys.argv[2:])
+    else:
+        _usage()
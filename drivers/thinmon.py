@@ -0,0 +1,275 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Online growth of thin-provisioned LVHD VDIs.
+#
+# A thin VDI is only inflated by a predicted increment on attach
+# (lvhdutil.attachThin), so while it is in use it may run out of LV space.
+# Every such VDI attached on this host is registered here, and a single
+# monitor process per host polls the registered VDIs and asks the SR master
+# (lvhd-thin plugin, "grow") to grow a VDI whenever its VHD data gets too 
+# close to the end of the LV. How close is too close, and how often a VDI is
+# polled, scale with the rate at which its VHD has been growing: the margin 
+# must cover the writes during a poll interval and a grow (LOW_WATERMARK at
+# the least). The polling is done by a child of the monitor process, which 
+# restarts it should it die. The monitor exits once no VDIs are registered, 
+# and is started again on demand by register().
+#
+
+import os
+import sys
+import time
+import getopt
+import subprocess
+
+import util
+import vhdutil
+import lvhdutil
+from lock import Lock
+
+BASE_DIR = "/var/run/sm/thinmon"
+THINMON_PATH = "/opt/xensource/sm/thinmon.py"
+LOCK_TYPE_MONITOR = "thinmon"
+THIN_PLUGIN = "lvhd-thin"
+
+POLL_INTERVAL = 10     # seconds, for VDIs not growing fast
+MIN_POLL_INTERVAL = 1
+LOW_WATERMARK = lvhdutil.THIN_MIN_INCREMENT / 2
+GROW_TIME_DEFAULT = 10 # seconds, until a grow has been timed
+RESTART_DELAY = 10
+
+
+def register(srUuid, vdiUuid):
+    """Start watching thin VDI vdiUuid attached on this host, starting the
+    monitor if it isn't running"""
+    srDir = os.path.join(BASE_DIR, srUuid)
+    if not util.pathexists(srDir):
+        try:
+            os.makedirs(srDir)
+        except OSError:
+            if not util.pathexists(srDir):
+                raise
+    open(os.path.join(srDir, vdiUuid), 'w').close()
+    util.SMlog("thinmon: watching %s/%s" % (srUuid, vdiUuid))
+    _start()
+
+def unregister(srUuid, vdiUuid):
+    """Stop watching VDI vdiUuid (no-op if it isn't watched)"""
+    srDir = os.path.join(BASE_DIR, srUuid)
+    path = os.path.join(srDir, vdiUuid)
+    if not util.pathexists(path):
+        return
+    try:
+        os.unlink(path)
+        os.rmdir(srDir)
+    except OSError:
+        pass # already removed, or the SR has other VDIs registered
+    util.SMlog("thinmon: stopped watching %s/%s" % (srUuid, vdiUuid))
+
+def getRegistered():
+    "List of (SR UUID, VDI UUID) of all watched VDIs"
+    vdis = []
+    if not util.pathexists(BASE_DIR):
+        return vdis
+    for srUuid in os.listdir(BASE_DIR):
+        try:
+            for vdiUuid in os.listdir(os.path.join(BASE_DIR, srUuid)):
+                vdis.append((srUuid, vdiUuid))
+        except OSError:
+            pass # just unregistered
+    return vdis
+
+def _start():
+    lock = Lock(LOCK_TYPE_MONITOR)
+    if not lock.acquireNoblock():
+        return # the monitor is running
+    lock.release()
+    devnull = open("/dev/null", 'r+')
+    try:
+        subprocess.Popen([THINMON_PATH, "-m"], stdin = devnull,
+                stdout = devnull, stderr = devnull, close_fds = True,
+                preexec_fn = os.setsid)
+    finally:
+        devnull.close()
+
+def _getDevSize(path):
+    f = open(path, 'r')
+    try:
+        f.seek(0, 2)
+        return f.tell()
+    finally:
+        f.close()
+
+
+class ThinMonitor:
+    """Polls the registered VDIs and has them grown on the master when
+    needed"""
+
+    def __init__(self):
+        self.session = None
+        self.masterRef = None
+        # (SR UUID, VDI UUID) -> (time, VHD size, growth rate, next check)
+        self.stats = dict()
+        self.growTime = GROW_TIME_DEFAULT
+
+    def run(self):
+        """Watch VDIs until none are registered. Return False if another
+        monitor is already running"""
+        lock = Lock(LOCK_TYPE_MONITOR)
+        started = False
+        while True:
+            if not lock.acquireNoblock():
+                return started
+            started = True
+            util.SMlog("thinmon: started")
+            try:
+                while not self._supervise():
+                    util.SMlog("thinmon: poller died, restarting")
+                    time.sleep(RESTART_DELAY)
+            finally:
+                lock.release()
+            # a VDI registered while we were exiting would not start a new
+            # monitor (the lock was still held), so check once more
+            if not getRegistered():
+                break
+        util.SMlog("thinmon: exiting")
+        return True
+
+    def _supervise(self):
+        """Run the poller in a child process. Return True once it is done
+        (no VDIs registered), False if it died"""
+        pid = os.fork()
+        if not pid:
+            try:
+                try:
+                    self._poll()
+                    os._exit(0)
+                except:
+                    util.logException("thinmon")
+            finally:
+                os._exit(1)
+        (pid, status) = os.waitpid(pid, 0)
+        return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+    def _poll(self):
+        vdis = getRegistered()
+        while vdis:
+            now = time.time()
+            wakeup = now + POLL_INTERVAL
+            for key in vdis:
+                (srUuid, vdiUuid) = key
+                stats = self.stats.get(key)
+                if not stats or stats[3] <= now:
+                    try:
+                        self._check(srUuid, vdiUuid)
+                    except:
+                        util.logException("thinmon")
+                    stats = self.stats.get(key)
+                if stats:
+                    wakeup = min(wakeup, stats[3])
+            for key in self.stats.keys():
+                if key not in vdis:
+                    del self.stats[key]
+            time.sleep(max(wakeup - time.time(), MIN_POLL_INTERVAL))
+            vdis = getRegistered()
+
+    def _check(self, srUuid, vdiUuid):
+        lvName = lvhdutil.LV_PREFIX[vhdutil.VDI_TYPE_VHD] + vdiUuid
+        path = os.path.join(lvhdutil.VG_LOCATION, lvhdutil.VG_PREFIX + srUuid,
+                lvName)
+        if not util.pathexists(path):
+            util.SMlog("thinmon: %s not active" % lvName)
+            unregister(srUuid, vdiUuid)
+            return
+        sizeLV = _getDevSize(path)
+        if sizeLV >= lvhdutil.calcSizeVHDLV(vhdutil.getSizeVirt(path)):
+            util.SMlog("thinmon: %s fully inflated" % lvName)
+            unregister(srUuid, vdiUuid)
+            return
+        sizePhys = vhdutil.getSizePhys(path)
+        rate = self._updateStats((srUuid, vdiUuid), sizePhys, sizeLV)
+        if sizeLV - sizePhys >= self._getWatermark(rate):
+            return
+        util.SMlog("thinmon: %s: VHD size %d, LV size %d, growing %d B/s, "
+                "growing the LV" % (lvName, sizePhys, sizeLV, rate))
+        start = time.time()
+        # grow by at least twice the margin needed at this rate
+        args = {"srUuid": srUuid, "vdiUuid": vdiUuid,
+                "minIncrement": str(2 * self._getWatermark(rate))}
+        text = self._getSession().xenapi.host.call_plugin(self.masterRef,
+                THIN_PLUGIN, "grow", args)
+        util.SMlog("thinmon: call-plugin returned: '%s'" % text)
+        if text == str(False):
+            raise util.SMException("Failed to grow %s" % lvName)
+        # the master refreshed the LV on this host before unpausing the VDI
+        self.growTime = (self.growTime + time.time() - start) / 2
+
+    def _getWatermark(self, rate):
+        "The LV space to keep ahead of the VHD data growing at 'rate' B/s"
+        return max(LOW_WATERMARK,
+                long(2 * rate * (self.growTime + MIN_POLL_INTERVAL)))
+
+    def _updateStats(self, key, sizePhys, sizeLV):
+        """Update the (running average) growth rate of VDI 'key' with the 
+        current VHD size, and schedule the next check early enough for the 
+        VHD not to get within the watermark unnoticed. Return the rate"""
+        now = time.time()
+        rate = 0.0
+        stats = self.stats.get(key)
+        if stats and now > stats[0]:
+            rate = max(sizePhys - stats[1], 0) / (now - stats[0])
+            rate = (stats[2] + rate) / 2
+        interval = POLL_INTERVAL
+        if rate > 0:
+            margin = sizeLV - sizePhys - self._getWatermark(rate)
+            interval = min(max(margin / rate / 2, MIN_POLL_INTERVAL),
+                    POLL_INTERVAL)
+        self.stats[key] = (now, sizePhys, rate, now + interval)
+        return rate
+
+    def _getSession(self):
+        if not self.session:
+            self.session = util.get_localAPI_session()
+            pools = self.session.xenapi.pool.get_all()
+            self.masterRef = self.session.xenapi.pool.get_master(pools[0])
+        return self.session
+
+
+def usage():
+    output = """Usage: thinmon.py -m | -l
+
+Online growth of thin-provisioned LVHD VDIs attached on this host.
+
+Options:
+    -m, --monitor  run the monitor (normally started by VDI attach)
+    -l, --list     list the watched VDIs
+"""
+    print output
+    sys.exit(1)
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ml", ["monitor", "list"])
+    except getopt.GetoptError:
+        usage()
+    if len(opts) != 1:
+        usage()
+    o = opts[0][0]
+    if o in ("-m", "--monitor"):
+        ThinMonitor().run()
+    elif o in ("-l", "--list"):
+        for srUuid, vdiUuid in getRegistered():
+            print "%s %s" % (srUuid, vdiUuid)
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,7 @@
 #
 
 import os, re, sys, popen2, subprocess
-import time, datetime
+import time, datetime, threading
 import errno, socket
 import xml.dom.minidom
 import SR, scsiutil
@@ -47,6 +47,9 @@ CMD_DD = "/bin/dd"
 
 FIST_PAUSE_PERIOD = 30 # seconds
 
+PLUGIN_CALL_THREADS = 16
+PLUGIN_CALL_TIMEOUT = 5 * 60 # seconds
+
 class SMException(Exception):
     """Base class for all SM exceptions for easier catching & wrapping in 
     XenError"""
@@ -504,6 +507,17 @@ def zeroOut(path, fromByte, bytes):
 
     return True
 
+BLKFLSBUF = 0x1261 # <linux/fs.h>
+
+def flush_blockdev_buffers(fd):
+    """Drop the cached pages of block device 'fd', so that the next reads
+    get what is on the device now (as an O_DIRECT read would: os.read can't
+    give O_DIRECT the aligned buffer it needs). No-op for other files"""
+    if not stat.S_ISBLK(os.fstat(fd).st_mode):
+        return
+    import fcntl
+    fcntl.ioctl(fd, BLKFLSBUF, 0)
+
 def match_rootdev(s):
     regex = re.compile("^PRIMARY_DISK")
     return regex.search(s, 0)
@@ -621,6 +635,116 @@ def get_all_slaves(session):
     master_ref = get_this_host_ref(session)
     return filter(lambda x: x != master_ref, host_refs)
 
+class PluginCallReport:
+    """The outcome of call_plugin_on_hosts(): the text returned by each host
+    that answered ('results') and the exception info of each host that
+    failed or timed out ('failures')"""
+
+    def __init__(self, hostRefs):
+        self.hostRefs = hostRefs
+        self.results = {}
+        self.failures = {}
+
+    def ok(self):
+        return len(self.failures) == 0
+
+    def check(self):
+        """Raise the error of the first host (in the order given) that
+        failed"""
+        for hostRef in self.hostRefs:
+            if self.failures.has_key(hostRef):
+                excType, excValue, tb = self.failures[hostRef]
+                raise excType, excValue, tb
+
+def call_plugin_on_hosts(session, hostRefs, plugin, fn, args,
+        timeout = PLUGIN_CALL_TIMEOUT, maxThreads = PLUGIN_CALL_THREADS,
+        argsByHost = None):
+    """Call plugin function 'fn' with 'args' (or with argsByHost[hostRef],
+    if given) on all hosts in hostRefs at once, from up to maxThreads
+    threads (each with its own connection to xapi, using the same session).
+    A host that hasn't answered within 'timeout' seconds is reported as
+    failed, and another thread takes over its share of the remaining hosts.
+    The call can't be cancelled however, so we still wait for it to return
+    before reporting the host, lest the caller undo the action on that host
+    only for the call to carry it out afterwards. Return a PluginCallReport
+    once every host has answered"""
+    report = PluginCallReport(hostRefs)
+    pending = list(hostRefs)
+    started = {} # host ref -> time its call was made
+    overdue = {} # host ref -> the timeout error, for calls that timed out
+    cond = threading.Condition()
+
+    def work():
+        workerSession = XenAPI.xapi_local()
+        workerSession._session = session._session
+        while True:
+            cond.acquire()
+            try:
+                if not pending:
+                    return
+                hostRef = pending.pop(0)
+                started[hostRef] = time.time()
+            finally:
+                cond.release()
+            try:
+                hostArgs = args
+                if argsByHost:
+                    hostArgs = argsByHost[hostRef]
+                text = workerSession.xenapi.host.call_plugin(hostRef, plugin,
+                        fn, hostArgs)
+                SMlog("call-plugin %s/%s on %s returned: '%s'" % \
+                        (plugin, fn, hostRef, text))
+                result = (text, None)
+            except:
+                logException("call-plugin %s/%s on %s" % (plugin, fn, hostRef))
+                result = (None, sys.exc_info())
+            cond.acquire()
+            try:
+                if overdue.has_key(hostRef):
+                    # we have been replaced: the call is a failure whatever
+                    # its outcome
+                    report.failures[hostRef] = overdue[hostRef]
+                    del overdue[hostRef]
+                    cond.notify()
+                    return
+                del started[hostRef]
+                if result[1]:
+                    report.failures[hostRef] = result[1]
+                else:
+                    report.results[hostRef] = result[0]
+                cond.notify()
+            finally:
+                cond.release()
+
+    def startWorker():
+        thread = threading.Thread(target = work)
+        thread.setDaemon(True)
+        thread.start()
+
+    for i in range(min(maxThreads, len(hostRefs))):
+        startWorker()
+    cond.acquire()
+    try:
+        while len(report.results) + len(report.failures) < len(hostRefs):
+            now = time.time()
+            wait = timeout
+            for hostRef, t in started.items():
+                if now - t < timeout:
+                    wait = min(wait, timeout - (now - t))
+                    continue
+                SMlog("call-plugin %s/%s on %s timed out, waiting for it to "
+                        "return" % (plugin, fn, hostRef))
+                del started[hostRef]
+                overdue[hostRef] = (SMException, SMException( \
+                        "call-plugin %s/%s on %s timed out after %ds" % \
+                        (plugin, fn, hostRef, timeout)), None)
+                if pending:
+                    startWorker()
+            cond.wait(wait)
+    finally:
+        cond.release()
+    return report
+
 def is_attached_rw(sm_config):
     for key, val in sm_config.iteritems():
         if key.startswith("host_") and val == "RW":
@@ -0,0 +1,230 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Free space accounting for a VG, shared by all SM processes on this host
+# (the SM driver and GC).
+#
+# The ledger of a VG is a file BASE_DIR/<VG> holding the last "vgs" result
+# (stamped with the VG seqno and the time it was read) and the outstanding
+# space reservations. The stats are reused until lvutil invalidates them
+# (on every LV create/remove/resize) or they get older than STATS_TTL (in
+# case someone changed the VG behind our back). A reservation belongs to a
+# process and is dropped when that process is gone, so a crash cannot leak
+# space. Updates are serialized with a flock on BASE_DIR/.<VG>.lock and
+# written atomically (temporary file + rename).
+#
+
+import os
+import time
+import fcntl
+
+import util
+import lvutil
+
+class VGLedgerException(util.SMException):
+    pass
+
+class VGLedgerNoSpace(VGLedgerException):
+    pass
+
+class VGLedger:
+    """Per-VG free space ledger: cached VG stats and space reservations"""
+
+    BASE_DIR = "/var/run/sm/vgledger"
+    STATS_TTL = 60
+
+    def __init__(self, vgName):
+        self.vgName = vgName
+        self.path = os.path.join(self.BASE_DIR, vgName)
+        self.reservations = [] # IDs of the reservations made through us
+
+    def getStats(self):
+        """The VG stats (as returned by lvutil._getVGstats), without forking
+        "vgs" unless the cached ones are out of date"""
+        f = self._lock()
+        try:
+            (stats, reservations) = self._loadStats()
+            return stats
+        finally:
+            self._unlock(f)
+
+    def getFreeSpace(self):
+        """Free space in the VG minus the space reserved by other processes"""
+        f = self._lock()
+        try:
+            (stats, reservations) = self._loadStats()
+            return stats["freespace"] - self._getReserved(reservations, True)
+        finally:
+            self._unlock(f)
+
+    def reserve(self, amount, tag):
+        """Reserve 'amount' bytes of free space for an operation described by
+        'tag'. Returns the reservation ID (to be passed to release()), or
+        raises VGLedgerNoSpace if there isn't enough space left over by the
+        reservations of other processes"""
+        f = self._lock()
+        try:
+            (stats, reservations) = self._loadStats()
+            available = stats["freespace"] - \
+                    self._getReserved(reservations, True)
+            if amount > available:
+                raise VGLedgerNoSpace("Not enough space in %s for %s: "
+                        "need %d, free %d (%d reserved by others)" % \
+                        (self.vgName, tag, amount, available,
+                            stats["freespace"] - available))
+            resId = "%d.%d.%d" % (os.getpid(), time.time(),
+                    len(self.reservations))
+            reservations[resId] = (os.getpid(), amount, tag)
+            self._save(stats, reservations)
+        finally:
+            self._unlock(f)
+        self.reservations.append(resId)
+        util.SMlog("VGLedger: reserved %d in %s for %s" % \
+                (amount, self.vgName, tag))
+        return resId
+
+    def release(self, resId):
+        "Release a reservation (no-op if it's gone already)"
+        if resId in self.reservations:
+            self.reservations.remove(resId)
+        f = self._lock()
+        try:
+            (stats, reservations) = self._load()
+            if not reservations.has_key(resId):
+                return
+            (pid, amount, tag) = reservations[resId]
+            del reservations[resId]
+            self._save(stats, reservations)
+        finally:
+            self._unlock(f)
+        util.SMlog("VGLedger: released %d in %s for %s" % \
+                (amount, self.vgName, tag))
+
+    def releaseAll(self):
+        "Release all reservations made through this object"
+        for resId in self.reservations[:]:
+            self.release(resId)
+
+    def invalidate(vgName):
+        """Forget the cached stats of VG vgName (because the VG free space has
+        just changed), but not the reservations"""
+        ledger = VGLedger(vgName)
+        if not util.pathexists(ledger.path):
+            return
+        f = ledger._lock()
+        try:
+            (stats, reservations) = ledger._load()
+            if stats:
+                ledger._save(None, reservations)
+        finally:
+            ledger._unlock(f)
+    invalidate = staticmethod(invalidate)
+
+    def _getReserved(self, reservations, othersOnly):
+        total = 0
+        for resId, (pid, amount, tag) in reservations.iteritems():
+            if othersOnly and resId in self.reservations:
+                continue
+            total += amount
+        return total
+
+    def _loadStats(self):
+        """Load the ledger, reading the VG stats if the cached ones are out of
+        date and dropping the reservations of dead processes"""
+        (stats, reservations) = self._load()
+        dirty = False
+        for resId, (pid, amount, tag) in reservations.items():
+            if not util.pathexists("/proc/%d" % pid):
+                util.SMlog("VGLedger: dropping reservation of %d in %s for %s "
+                        "(PID %d gone)" % (amount, self.vgName, tag, pid))
+                del reservations[resId]
+                dirty = True
+        if not stats or time.time() - stats["time"] > self.STATS_TTL:
+            (seqno, stats) = lvutil.getVGInfo(self.vgName)
+            stats["seqno"] = seqno
+            stats["time"] = time.time()
+            dirty = True
+        if dirty:
+            self._save(stats, reservations)
+        return (stats, reservations)
+
+    def _load(self):
+        """Read the ledger. Corrupt lines are dropped (with the cached stats,
+        so that they get read again from the VG) rather than failing every
+        operation on the VG: the file is rewritten on the next update"""
+        stats = None
+        reservations = dict()
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return (stats, reservations)
+        corrupt = False
+        try:
+            for line in f:
+                fields = line.split()
+                try:
+                    if fields[0] == "S":
+                        stats = {"seqno": int(fields[1]),
+                                "physical_size": long(fields[2]),
+                                "freespace": long(fields[3]),
+                                "time": float(fields[4])}
+                        stats["physical_utilisation"] = \
+                                stats["physical_size"] - stats["freespace"]
+                    elif fields[0] == "R":
+                        reservations[fields[1]] = (int(fields[2]),
+                                long(fields[3]), fields[4])
+                    else:
+                        corrupt = True
+                except (IndexError, ValueError):
+                    corrupt = True
+        finally:
+            f.close()
+        if corrupt:
+            util.SMlog("VGLedger: corrupt ledger %s, rebuilding it (%d "
+                    "reservations kept)" % (self.path, len(reservations)))
+            stats = None
+        return (stats, reservations)
+
+    def _save(self, stats, reservations):
+        lines = []
+        if stats:
+            lines.append("S %d %d %d %f" % (stats["seqno"],
+                stats["physical_size"], stats["freespace"], stats["time"]))
+        for resId, (pid, amount, tag) in reservations.iteritems():
+            lines.append("R %s %d %d %s" % (resId, pid, amount,
+                tag.replace(" ", "_")))
+        tmpPath = os.path.join(self.BASE_DIR, ".%s.tmp" % self.vgName)
+        try:
+            f = open(tmpPath, 'w')
+            try:
+                f.write("".join(map(lambda x: x + "\n", lines)))
+            finally:
+                f.close()
+            os.rename(tmpPath, self.path)
+        except (IOError, OSError), e:
+            raise VGLedgerException("Failed to write %s: %s" % (self.path, e))
+
+    def _lock(self):
+        if not util.pathexists(self.BASE_DIR):
+            try:
+                os.makedirs(self.BASE_DIR)
+            except OSError:
+                if not util.pathexists(self.BASE_DIR):
+                    raise
+        f = open(os.path.join(self.BASE_DIR, ".%s.lock" % self.vgName), 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return f
+
+    def _unlock(self, f):
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
@@ -0,0 +1,206 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Arithmetic on VHD block allocation bitmaps (as produced by
+# "vhd-util read -B" or vhdreader: one bit per block, MSB first).
+#
+# A bitmap is loaded once into a single Python long so that OR/AND/popcount
+# over a whole 2TB VHD (~1M blocks) are a handful of C-level big-integer
+# operations rather than a per-byte/per-bit Python loop.
+#
+
+import zlib
+import binascii
+
+# popcount of every byte value, for counting single bytes/small values
+BYTE_BITS = [0] * 256
+for i in range(1, 256):
+    BYTE_BITS[i] = (i & 1) + BYTE_BITS[i >> 1]
+del i
+
+# popcount of every non-zero hex digit, for counting longs by their hex text
+HEX_BITS = map(lambda i: ("%x" % i, BYTE_BITS[i]), range(1, 16))
+
+
+def _toLong(data):
+    """Convert a bitmap string to a long. Byte i of the bitmap becomes the
+    i-th least significant byte, so bitmaps of different lengths line up
+    without padding"""
+    if not data:
+        return 0L
+    return long(binascii.hexlify(data[::-1]), 16)
+
+def popcount(val):
+    "Number of set bits in a non-negative int/long"
+    if val < 256:
+        return BYTE_BITS[val]
+    # NB. one C-level count per hex digit value, whatever the size of val
+    text = "%x" % val
+    count = 0
+    for digit, bits in HEX_BITS:
+        count += text.count(digit) * bits
+    return count
+
+
+class Bitmap:
+    "Immutable block allocation bitmap"
+
+    def __init__(self, val = 0L, numBytes = 0):
+        self.val = val
+        self.numBytes = numBytes
+
+    def fromString(data):
+        return Bitmap(_toLong(data), len(data))
+    fromString = staticmethod(fromString)
+
+    def fromCompressed(data):
+        "Load a zlib-compressed bitmap (the vhdutil.getBlockBitmap format)"
+        return Bitmap.fromString(zlib.decompress(data))
+    fromCompressed = staticmethod(fromCompressed)
+
+    def count(self):
+        "Number of allocated blocks"
+        return popcount(self.val)
+
+    def test(self, block):
+        "Is block number 'block' allocated?"
+        return bool(self.val >> ((block & ~7) | (7 - (block & 7))) & 1)
+
+    def countOr(self, other):
+        "Number of blocks allocated in either bitmap"
+        return popcount(self.val | other.val)
+
+    def countAnd(self, other):
+        "Number of blocks allocated in both bitmaps"
+        return popcount(self.val & other.val)
+
+    def countNew(self, other):
+        "Number of blocks allocated in self but not in other"
+        return popcount(self.val & ~other.val)
+
+    def __or__(self, other):
+        return Bitmap(self.val | other.val, max(self.numBytes, other.numBytes))
+
+    def __and__(self, other):
+        return Bitmap(self.val & other.val, min(self.numBytes, other.numBytes))
+
+    def __len__(self):
+        return self.numBytes * 8
+
+    def toString(self):
+        if not self.numBytes:
+            return ""
+        text = "%x" % self.val
+        text = "0" * (self.numBytes * 2 - len(text)) + text
+        return binascii.unhexlify(text)[::-1]
+
+
+def countBits(bitmap1, bitmap2):
+    "Bit count in the bitmap produced by ORing the two bitmap strings"
+    return popcount(_toLong(bitmap1) | _toLong(bitmap2))
+
+def getCoalescedCounts(parents, bitmaps):
+    """Batch query over a whole VHD forest: for every node that has a parent,
+    the number of blocks the parent would have if the node were coalesced 
+    onto it. 
+    parents: dict uuid -> parent uuid (or None/"" for roots)
+    bitmaps: dict uuid -> bitmap string or Bitmap
+    Nodes for which either bitmap is missing are skipped. Each bitmap is 
+    decoded only once however many children share the parent"""
+    loaded = {}
+    def get(uuid):
+        if not loaded.has_key(uuid):
+            bitmap = bitmaps.get(uuid)
+            if bitmap is not None and not isinstance(bitmap, Bitmap):
+                bitmap = Bitmap.fromString(bitmap)
+            loaded[uuid] = bitmap
+        return loaded[uuid]
+    counts = {}
+    for uuid, parentUuid in parents.iteritems():
+        if not parentUuid:
+            continue
+        child = get(uuid)
+        parent = get(parentUuid)
+        if child is None or parent is None:
+            continue
+        counts[uuid] = child.countOr(parent)
+    return counts
+
+
+###########################################################################
+#
+#  Unit tests
+#
+def _runTests():
+    """Unit testing, against a bit-by-bit count"""
+    import random
+    print "Running unit tests..."
+
+    def bits(data):
+        blocks = []
+        for i in range(len(data) * 8):
+            if ord(data[i >> 3]) & (0x80 >> (i & 7)):
+                blocks.append(i)
+        return blocks
+
+    for val in [0, 1, 255, 256, 2L ** 100 - 1, 2L ** 100 + 5]:
+        count = 0
+        rest = val
+        while rest:
+            count += rest & 1
+            rest >>= 1
+        if popcount(val) != count:
+            print "popcount(%d) failed" % val
+            return 1
+
+    random.seed(0)
+    for (len1, len2) in [(0, 0), (1, 3), (64, 64), (1000, 200)]:
+        data1 = "".join(map(lambda x: chr(random.randint(0, 255)),
+            range(len1)))
+        data2 = "".join(map(lambda x: chr(random.randint(0, 255)),
+            range(len2)))
+        blocks1 = bits(data1)
+        blocks2 = bits(data2)
+        union = dict.fromkeys(blocks1 + blocks2).keys()
+        both = filter(lambda x: x in blocks2, blocks1)
+        bitmap1 = Bitmap.fromString(data1)
+        bitmap2 = Bitmap.fromCompressed(zlib.compress(data2))
+        if bitmap1.toString() != data1 or len(bitmap1) != len1 * 8:
+            print "round trip failed for %d bytes" % len1
+            return 1
+        if bitmap1.count() != len(blocks1) or \
+                filter(bitmap1.test, range(len1 * 8)) != blocks1:
+            print "count/test failed for %d bytes" % len1
+            return 1
+        if bitmap1.countOr(bitmap2) != len(union) or \
+                countBits(data1, data2) != len(union) or \
+                (bitmap1 | bitmap2).count() != len(union):
+            print "OR failed for %d/%d bytes" % (len1, len2)
+            return 1
+        if bitmap1.countAnd(bitmap2) != len(both) or \
+                (bitmap1 & bitmap2).count() != len(both) or \
+                bitmap1.countNew(bitmap2) != len(blocks1) - len(both):
+            print "AND failed for %d/%d bytes" % (len1, len2)
+            return 1
+
+    counts = getCoalescedCounts({"a": None, "b": "a", "c": "a", "d": "x"},
+            {"a": "\xf0", "b": "\x0f\x01", "c": Bitmap.fromString("\x30")})
+    if counts != {"b": 9, "c": 4}:
+        print "getCoalescedCounts failed: %s" % counts
+        return 1
+    print "All tests passed"
+    return 0
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(_runTests())
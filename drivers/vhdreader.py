@@ -0,0 +1,527 @@
+#!/usr/bin/python
+# Copyright (C) 2006-2007 XenSource Ltd.
+# Copyright (C) 2008-2009 Citrix Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published
+# by the Free Software Foundation; version 2.1 only.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# Read-only, in-process parser for VHD metadata (footer, dynamic header,
+# parent locators and BAT). It mirrors what libvhd does for the read-only
+# "vhd-util query/read" operations so that vhdutil can answer those queries
+# without forking. Anything unexpected raises VHDFormatError and the caller
+# is expected to fall back to vhd-util.
+#
+
+import os
+import sys
+import struct
+import array
+import util
+
+SECTOR_SIZE = 512
+FOOTER_SIZE = 512
+HEADER_SIZE = 1024
+
+FOOTER_COOKIE = "conectix"
+HEADER_COOKIE = "cxsparse"
+BATMAP_COOKIE = "tdbatmap"
+
+DD_BLK_UNUSED = 0xFFFFFFFFL
+
+HD_TYPE_FIXED = 2
+HD_TYPE_DYNAMIC = 3
+HD_TYPE_DIFF = 4
+
+CREATOR_TAPDISK = "tap\0"
+
+PLAT_CODE_NONE = 0x0
+PLAT_CODE_MACX = 0x4D616358 # "MacX": file:// URL, UTF-8
+PLAT_CODE_W2KU = 0x57326B75 # "W2ku": absolute path, UTF-16LE
+PLAT_CODE_W2RU = 0x57327275 # "W2ru": relative path, UTF-16LE
+
+NUM_PARENT_LOCATORS = 8
+
+# cookie, features, version, data offset, timestamp, creator app, creator
+# version, creator OS, original size, current size, geometry, disk type,
+# checksum, uuid, saved state, hidden
+FOOTER_FMT = ">8sIIQI4sIIQQIII16sBB"
+FOOTER_CHECKSUM_OFFSET = 64
+
+# cookie, data offset, table offset, header version, max BAT entries, block
+# size, checksum, parent uuid, parent timestamp, reserved, parent name
+HEADER_FMT = ">8sQQIIII16sI4s512s"
+HEADER_CHECKSUM_OFFSET = 36
+LOCATOR_FMT = ">IIIIQ"
+LOCATOR_OFFSET = struct.calcsize(HEADER_FMT)
+LOCATOR_SIZE = struct.calcsize(LOCATOR_FMT)
+
+# cookie, batmap offset, batmap size (sectors)
+BATMAP_HDR_FMT = ">8sQI"
+
+NULL_UUID = "\0" * 16
+
+
+class VHDFormatError(util.SMException):
+    pass
+
+
+def _checksum(buf, offset):
+    "one's complement of the byte sum, skipping the checksum field itself"
+    total = sum(array.array('B', buf[:offset] + buf[offset + 4:]))
+    return ~total & 0xFFFFFFFFL
+
+def _secsRoundUp(size):
+    return (size + SECTOR_SIZE - 1) / SECTOR_SIZE
+
+def _secsRoundUpNoZero(size):
+    return _secsRoundUp(size) or 1
+
+def _version(major, minor):
+    return (major << 16) | minor
+
+
+class Footer:
+    def __init__(self, buf):
+        (self.cookie, self.features, self.version, self.dataOffset,
+                self.timestamp, self.creatorApp, self.creatorVersion,
+                self.creatorOS, self.origSize, self.currSize, self.geometry,
+                self.diskType, self.checksum, self.uuid, self.savedState,
+                self.hidden) = struct.unpack(FOOTER_FMT,
+                        buf[:struct.calcsize(FOOTER_FMT)])
+        self.buf = buf
+
+    def valid(self):
+        return self.cookie == FOOTER_COOKIE and \
+                self.checksum == _checksum(self.buf, FOOTER_CHECKSUM_OFFSET)
+
+
+class ParentLocator:
+    def __init__(self, buf):
+        (self.code, self.dataSpace, self.dataLen, self.reserved,
+                self.dataOffset) = struct.unpack(LOCATOR_FMT, buf)
+
+    def getSize(self):
+        # data_space should be in sectors, but some writers use bytes
+        if self.dataSpace < SECTOR_SIZE:
+            return self.dataSpace * SECTOR_SIZE
+        if self.dataSpace % SECTOR_SIZE == 0:
+            return self.dataSpace
+        return 0
+
+
+class Header:
+    def __init__(self, buf):
+        (self.cookie, self.dataOffset, self.tableOffset, self.version,
+                self.maxBatSize, self.blockSize, self.checksum,
+                self.parentUuid, self.parentTimestamp, self.reserved,
+                self.parentName) = struct.unpack(HEADER_FMT,
+                        buf[:LOCATOR_OFFSET])
+        self.locators = []
+        for i in range(NUM_PARENT_LOCATORS):
+            offset = LOCATOR_OFFSET + i * LOCATOR_SIZE
+            self.locators.append(ParentLocator(buf[offset:offset + \
+                    LOCATOR_SIZE]))
+        self.buf = buf
+
+    def valid(self):
+        return self.cookie == HEADER_COOKIE and \
+                self.checksum == _checksum(self.buf, HEADER_CHECKSUM_OFFSET)
+
+
+class VHDFile:
+    """A VHD file (or LV) opened read-only. All metadata is read with
+    positioned reads on a single file descriptor and parsed lazily, so one
+    instance can answer any number of queries for the same VHD"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        try:
+            self.fileSize = os.lseek(self.fd, 0, 2) # SEEK_END
+            self.footer = self._readFooter()
+            self.header = None
+            if self.isDynamic():
+                self.header = self._readHeader()
+        except:
+            self.close()
+            raise
+        self._bat = None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _pread(self, offset, size):
+        os.lseek(self.fd, offset, 0)
+        buf = ""
+        while len(buf) < size:
+            data = os.read(self.fd, size - len(buf))
+            if not data:
+                raise VHDFormatError("%s: short read at %d (%d/%d)" % \
+                        (self.path, offset, len(buf), size))
+            buf += data
+        return buf
+
+    def _readFooter(self):
+        "Same order as libvhd: end of file, short footer, then the copy at 0"
+        if self.fileSize < FOOTER_SIZE:
+            raise VHDFormatError("%s: too small for a VHD" % self.path)
+        footer = Footer(self._pread(self.fileSize - FOOTER_SIZE, FOOTER_SIZE))
+        if footer.valid():
+            return footer
+        footer = Footer(self._pread(self.fileSize - FOOTER_SIZE + 1,
+                FOOTER_SIZE - 1) + "\0")
+        if footer.valid():
+            return footer
+        footer = Footer(self._pread(0, FOOTER_SIZE))
+        if footer.valid():
+            return footer
+        raise VHDFormatError("%s: no valid footer found" % self.path)
+
+    def _readHeader(self):
+        header = Header(self._pread(self.footer.dataOffset, HEADER_SIZE))
+        if not header.valid():
+            raise VHDFormatError("%s: invalid dynamic header" % self.path)
+        if header.blockSize == 0 or header.blockSize % SECTOR_SIZE:
+            raise VHDFormatError("%s: bad block size %d" % \
+                    (self.path, header.blockSize))
+        return header
+
+    def isDynamic(self):
+        return self.footer.diskType in (HD_TYPE_DYNAMIC, HD_TYPE_DIFF)
+
+    def isDiff(self):
+        return self.footer.diskType == HD_TYPE_DIFF
+
+    def isCreatorTapdisk(self):
+        return self.footer.creatorApp == CREATOR_TAPDISK
+
+    def getSizeVirt(self):
+        "Virtual size as reported by vhd-util (in whole MB, returned in bytes)"
+        return (self.footer.currSize >> 20) << 20
+
+    def getHidden(self):
+        if self.isDynamic() and self.isCreatorTapdisk() and \
+                self.footer.creatorVersion in (_version(0, 1), _version(1, 1)):
+            # old tapdisk versions kept the flag elsewhere: let vhd-util
+            # handle these
+            raise VHDFormatError("%s: legacy creator version %x" % \
+                    (self.path, self.footer.creatorVersion))
+        return self.footer.hidden
+
+    def getBAT(self):
+        if not self.isDynamic():
+            raise VHDFormatError("%s: not a dynamic VHD" % self.path)
+        if self._bat is None:
+            bat = array.array('I')
+            if bat.itemsize != 4:
+                raise VHDFormatError("unsupported platform word size")
+            bat.fromstring(self._pread(self.header.tableOffset,
+                    self.header.maxBatSize * 4))
+            if sys.byteorder == "little":
+                bat.byteswap()
+            self._bat = bat
+        return self._bat
+
+    def getBlockCount(self):
+        "Number of blocks covering the virtual size"
+        return self.footer.currSize / self.header.blockSize
+
+    def getBitmapSectors(self):
+        "Sectors taken by the sector bitmap preceding each data block"
+        sectorsPerBlock = self.header.blockSize / SECTOR_SIZE
+        return _secsRoundUp(sectorsPerBlock / 8)
+
+    def getAllocatedBlocks(self):
+        "Indices of all allocated blocks"
+        bat = self.getBAT()
+        return [i for i in xrange(len(bat)) if bat[i] != DD_BLK_UNUSED]
+
+    def getBlockBitmap(self):
+        """Bitmap of allocated blocks, one bit per block, most significant bit
+        first, in the same format as 'vhd-util read -B'"""
+        bat = self.getBAT()
+        numBlocks = self.getBlockCount()
+        if numBlocks > len(bat):
+            raise VHDFormatError("%s: BAT too small (%d < %d)" % \
+                    (self.path, len(bat), numBlocks))
+        bitmap = array.array('B', "\0" * ((numBlocks + 7) / 8))
+        for i in xrange(numBlocks):
+            if bat[i] != DD_BLK_UNUSED:
+                bitmap[i >> 3] |= 0x80 >> (i & 7)
+        return bitmap.tostring()
+
+    def _hasBatmap(self):
+        if not self.isCreatorTapdisk():
+            return False
+        if self.footer.creatorVersion <= _version(0, 1):
+            return False
+        return self._readBatmapHeader() is not None
+
+    def _batmapHeaderOffset(self):
+        return self.header.tableOffset + \
+                _secsRoundUp(self.header.maxBatSize * 4) * SECTOR_SIZE
+
+    def _readBatmapHeader(self):
+        size = struct.calcsize(BATMAP_HDR_FMT)
+        (cookie, offset, sectors) = struct.unpack(BATMAP_HDR_FMT,
+                self._pread(self._batmapHeaderOffset(), size))
+        if cookie != BATMAP_COOKIE:
+            return None
+        return (offset, sectors)
+
+    def _getEndOfHeaders(self):
+        end = self.footer.dataOffset + HEADER_SIZE
+        batEnd = self.header.tableOffset + \
+                _secsRoundUpNoZero(self.header.maxBatSize * 4) * SECTOR_SIZE
+        end = max(end, batEnd)
+        if self._hasBatmap():
+            (mapOffset, mapSectors) = self._readBatmapHeader()
+            hdrEnd = self._batmapHeaderOffset() + SECTOR_SIZE * \
+                    _secsRoundUpNoZero(struct.calcsize(BATMAP_HDR_FMT))
+            end = max(end, hdrEnd, mapOffset + mapSectors * SECTOR_SIZE)
+        for loc in self.header.locators:
+            if loc.code == PLAT_CODE_NONE:
+                continue
+            end = max(end, loc.dataOffset + loc.getSize())
+        return end
+
+    def getSizePhys(self):
+        "Physical utilization as reported by 'vhd-util query -s'"
+        if not self.isDynamic():
+            return self.fileSize
+        bat = self.getBAT()
+        end = self._getEndOfHeaders() / SECTOR_SIZE
+        blockSectors = self.header.blockSize / SECTOR_SIZE + \
+                self.getBitmapSectors()
+        used = [entry for entry in bat if entry != DD_BLK_UNUSED]
+        if used:
+            end = max(end, max(used) + blockSectors)
+        return end * SECTOR_SIZE + FOOTER_SIZE
+
+    def isParentRaw(self):
+        return self.header.parentUuid == NULL_UUID
+
+    def _readLocator(self, loc):
+        if loc.dataLen == 0 or loc.dataLen > loc.getSize():
+            raise VHDFormatError("%s: bad parent locator" % self.path)
+        raw = self._pread(loc.dataOffset, loc.dataLen)
+        if loc.code == PLAT_CODE_MACX:
+            name = raw.rstrip("\0").decode("utf-8")
+            if name.startswith("file://"):
+                name = name[len("file://"):]
+        elif loc.code in (PLAT_CODE_W2KU, PLAT_CODE_W2RU):
+            name = raw.decode("utf-16-le").rstrip(u"\0").replace(u"\\", u"/")
+        else:
+            return None
+        return name.encode("utf-8")
+
+    def getParentName(self):
+        """Parent name as recorded in the dynamic header. Unlike
+        getParentPath, this does not require the parent to be accessible"""
+        if not self.isDiff():
+            return None
+        codec = "utf-16-be"
+        if self.isCreatorTapdisk() and \
+                self.footer.creatorVersion == _version(0, 1):
+            codec = "utf-8"
+        try:
+            name = self.header.parentName.decode(codec).split(u"\0")[0]
+        except UnicodeError:
+            raise VHDFormatError("%s: bad parent name" % self.path)
+        if not name:
+            raise VHDFormatError("%s: empty parent name" % self.path)
+        return name.encode("utf-8")
+
+    def _findParent(self, name):
+        """Resolve a parent locator the way libvhd does: absolute paths are
+        used as is, anything else is looked up relative to the directory of
+        the (real path of the) child"""
+        if name.startswith("/") and os.access(name, os.R_OK):
+            return name
+        childDir = os.path.dirname(os.path.realpath(self.path))
+        location = "%s/%s" % (childDir, name)
+        if os.access(location, os.R_OK):
+            return os.path.realpath(location)
+        return None
+
+    def getParentPath(self):
+        """Path of the parent, or None if this VHD has no parent. The parent
+        must be accessible, as with vhd-util"""
+        if not self.isDiff():
+            return None
+        for loc in self.header.locators:
+            if loc.code == PLAT_CODE_NONE:
+                continue
+            try:
+                name = self._readLocator(loc)
+            except (VHDFormatError, UnicodeError):
+                continue
+            if not name:
+                continue
+            location = self._findParent(name)
+            if location:
+                return location
+        raise VHDFormatError("%s: parent not found" % self.path)
+
+    def getDepth(self):
+        "Chain depth as reported by 'vhd-util query -d'"
+        depth = 1
+        vhd = self
+        visited = [os.path.realpath(self.path)]
+        try:
+            while vhd.isDiff():
+                if vhd.isParentRaw():
+                    depth += 1
+                    break
+                parentPath = vhd.getParentPath()
+                if os.path.realpath(parentPath) in visited:
+                    raise VHDFormatError("%s: loop in VHD chain" % self.path)
+                visited.append(os.path.realpath(parentPath))
+                if vhd != self:
+                    vhd.close()
+                vhd = VHDFile(parentPath)
+                depth += 1
+        finally:
+            if vhd != self:
+                vhd.close()
+        return depth
+
+
+###########################################################################
+#
+#  Unit tests
+#
+def _makeTestVHD(path, size, blocks, parentName = None, hidden = 0):
+    """Write a minimal dynamic (or, with parentName, differencing) VHD with
+    2MB blocks, 'blocks' allocated, the way tapdisk lays it out"""
+    blockSize = 2 * 1024 * 1024
+    numBlocks = size / blockSize
+    tableOffset = FOOTER_SIZE + HEADER_SIZE
+    locOffset = tableOffset + _secsRoundUp(numBlocks * 4) * SECTOR_SIZE
+    dataOffset = locOffset + SECTOR_SIZE
+
+    diskType = HD_TYPE_DYNAMIC
+    parentUuid = NULL_UUID
+    locators = ""
+    if parentName:
+        diskType = HD_TYPE_DIFF
+        parentUuid = "p" * 16
+        locators = struct.pack(LOCATOR_FMT, PLAT_CODE_MACX, 1,
+                len("file://./" + parentName), 0, locOffset)
+    locators += "\0" * (NUM_PARENT_LOCATORS * LOCATOR_SIZE - len(locators))
+
+    footer = struct.pack(FOOTER_FMT, FOOTER_COOKIE, 2, _version(1, 0),
+            FOOTER_SIZE, 0, CREATOR_TAPDISK, _version(1, 3), 0, size, size, 0,
+            diskType, 0, "u" * 16, 0, hidden)
+    footer += "\0" * (FOOTER_SIZE - len(footer))
+    footer = footer[:FOOTER_CHECKSUM_OFFSET] + struct.pack(">I",
+            _checksum(footer, FOOTER_CHECKSUM_OFFSET)) + \
+            footer[FOOTER_CHECKSUM_OFFSET + 4:]
+    header = struct.pack(HEADER_FMT, HEADER_COOKIE, DD_BLK_UNUSED << 32 | \
+            DD_BLK_UNUSED, tableOffset, _version(1, 0), numBlocks, blockSize,
+            0, parentUuid, 0, "\0" * 4, "\0" * 512) + locators
+    header += "\0" * (HEADER_SIZE - len(header))
+    header = header[:HEADER_CHECKSUM_OFFSET] + struct.pack(">I",
+            _checksum(header, HEADER_CHECKSUM_OFFSET)) + \
+            header[HEADER_CHECKSUM_OFFSET + 4:]
+
+    bat = [DD_BLK_UNUSED] * numBlocks
+    sector = dataOffset / SECTOR_SIZE
+    for block in blocks:
+        bat[block] = sector
+        sector += 1 + blockSize / SECTOR_SIZE
+    f = open(path, 'w')
+    try:
+        f.write(footer + header)
+        f.write(struct.pack(">%dI" % numBlocks, *bat))
+        if parentName:
+            f.seek(locOffset)
+            f.write("file://./" + parentName)
+        f.seek(sector * SECTOR_SIZE)
+        f.write(footer)
+    finally:
+        f.close()
+    return (sector * SECTOR_SIZE + FOOTER_SIZE, footer)
+
+def _runTests():
+    """Unit testing"""
+    import tempfile
+    import shutil
+    print "Running unit tests..."
+    dir = tempfile.mkdtemp()
+    try:
+        size = 100 * 1024 * 1024
+        parentPath = os.path.join(dir, "parent.vhd")
+        childPath = os.path.join(dir, "child.vhd")
+        (parentSize, footer) = _makeTestVHD(parentPath, size, [0, 3, 49],
+                hidden = 1)
+        _makeTestVHD(childPath, size, [1, 3], "parent.vhd")
+
+        vhd = VHDFile(parentPath)
+        if not vhd.isDynamic() or vhd.isDiff() or vhd.getParentPath():
+            print "parent type failed"
+            return 1
+        if vhd.getSizeVirt() != size or vhd.getHidden() != 1:
+            print "footer failed: %d %d" % (vhd.getSizeVirt(),
+                    vhd.getHidden())
+            return 1
+        if vhd.getAllocatedBlocks() != [0, 3, 49]:
+            print "BAT failed: %s" % vhd.getAllocatedBlocks()
+            return 1
+        bitmap = vhd.getBlockBitmap()
+        if len(bitmap) != 7 or bitmap[0] != "\x90" or bitmap[6] != "\x40":
+            print "block bitmap failed: %r" % bitmap
+            return 1
+        if vhd.getSizePhys() != parentSize:
+            print "physical size failed: %d != %d" % (vhd.getSizePhys(),
+                    parentSize)
+            return 1
+        vhd.close()
+
+        vhd = VHDFile(childPath)
+        if not vhd.isDiff() or vhd.isParentRaw() or vhd.getHidden() != 0:
+            print "child type failed"
+            return 1
+        if vhd.getParentPath() != os.path.realpath(parentPath):
+            print "parent locator failed: %s" % vhd.getParentPath()
+            return 1
+        if vhd.getAllocatedBlocks() != [1, 3] or vhd.getDepth() != 2:
+            print "child BAT or depth failed"
+            return 1
+        vhd.close()
+
+        # a torn footer at the end: the copy at the start is used
+        f = open(parentPath, 'r+')
+        f.seek(parentSize - FOOTER_SIZE)
+        f.write("X" * FOOTER_SIZE)
+        f.close()
+        vhd = VHDFile(parentPath)
+        if vhd.getSizeVirt() != size:
+            print "footer copy failed"
+            return 1
+        vhd.close()
+
+        f = open(parentPath, 'r+')
+        f.write("X" * FOOTER_SIZE)
+        f.close()
+        try:
+            VHDFile(parentPath)
+            print "bad footers not detected"
+            return 1
+        except VHDFormatError:
+            pass
+    finally:
+        shutil.rmtree(dir)
+    print "All tests passed"
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(_runTests())
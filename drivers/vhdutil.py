@@ -19,6 +19,7 @@ import os
 import util
 import errno
 import zlib
+import vhdreader
 
 
 MAX_VHD_JOURNAL_SIZE = 6 * 1024 * 1024 # 2MB VHD block size, max 2TB VHD size
@@ -27,6 +28,9 @@ VHD_UTIL = "/usr/sbin/vhd-util"
 OPT_LOG_ERR = "--debug"
 VHD_BLOCK_SIZE = 2 * 1024 * 1024
 VHD_FOOTER_SIZE = 512
+# answer read-only queries by parsing the VHD metadata in-process where
+# possible, only forking vhd-util when that fails
+USE_VHD_READER = True
  
 # lock to lock the entire SR for short ops
 LOCK_TYPE_SR = "sr"
@@ -93,10 +97,30 @@ def ioretry(cmd):
     return util.ioretry(lambda: util.pread2(cmd),
             errlist = [errno.EIO, errno.EAGAIN])
 
+def _readVHD(path, query):
+    """Run query(vhd) against the VHD metadata read in-process. Return a
+    (success, result) pair: on failure the caller falls back to vhd-util"""
+    if not USE_VHD_READER:
+        return (False, None)
+    try:
+        vhd = vhdreader.VHDFile(path)
+        try:
+            return (True, query(vhd))
+        finally:
+            vhd.close()
+    except Exception, e:
+        # NB. whatever goes wrong in the reader, vhd-util still has the answer
+        util.SMlog("VHD reader failed on %s (%s), using vhd-util" % (path, e))
+        return (False, None)
+
 def getVHDInfo(path, extractUuidFunction, includeParent = True):
     """Get the VHD info. The parent info may optionally be omitted: vhd-util
     tries to verify the parent by opening it, which results in error if the VHD
     resides on an inactive LV"""
+    (ok, vhdInfo) = _readVHD(path, lambda vhd: \
+            _getVHDInfo(vhd, extractUuidFunction, includeParent))
+    if ok:
+        return vhdInfo
     opts = "-vsf"
     if includeParent:
         opts += "p"
@@ -117,6 +141,31 @@ def getVHDInfo(path, extractUuidFunction, includeParent = True):
     vhdInfo.path = path
     return vhdInfo
 
+def getVHDInfoNoParentCheck(path, extractUuidFunction):
+    """Get the VHD info (except the physical size) without opening the parent:
+    the parent is the one recorded in the VHD header, as with "vhd-util scan".
+    This is only done in-process: return None if the VHD could not be read"""
+    (ok, vhdInfo) = _readVHD(path, lambda vhd: \
+            _getVHDInfo(vhd, extractUuidFunction, True, False))
+    return vhdInfo
+
+def _getVHDInfo(vhd, extractUuidFunction, includeParent, checkParent = True):
+    vhdInfo = VHDInfo(extractUuidFunction(vhd.path))
+    vhdInfo.sizeVirt = vhd.getSizeVirt()
+    if checkParent:
+        vhdInfo.sizePhys = vhd.getSizePhys()
+    if includeParent:
+        if checkParent:
+            parentPath = vhd.getParentPath()
+        else:
+            parentPath = vhd.getParentName()
+        if parentPath:
+            vhdInfo.parentPath = parentPath
+            vhdInfo.parentUuid = extractUuidFunction(parentPath)
+    vhdInfo.hidden = vhd.getHidden()
+    vhdInfo.path = vhd.path
+    return vhdInfo
+
 def getVHDInfoLVM(lvName, extractUuidFunction, vgName):
     """Get the VHD info. This function does not require the container LV to be
     active, but uses lvs & vgs"""
@@ -152,6 +201,11 @@ def getParentChain(lvName, extractUuidFunction, vgName):
     return chain
 
 def getParent(path, extractUuidFunction):
+    (ok, parentPath) = _readVHD(path, lambda vhd: vhd.getParentPath())
+    if ok:
+        if not parentPath:
+            return None
+        return extractUuidFunction(parentPath)
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-p", "-n", path]
     ret = ioretry(cmd)
     if ret.find("query failed") != -1 or ret.find("Failed opening") != -1:
@@ -168,6 +222,9 @@ def setParent(path, parentPath, parentRaw):
     ioretry(cmd)
 
 def getHidden(path):
+    (ok, hidden) = _readVHD(path, lambda vhd: vhd.getHidden())
+    if ok:
+        return hidden
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-f", "-n", path]
     ret = ioretry(cmd)
     hidden = int(ret.split(':')[-1].strip())
@@ -181,6 +238,9 @@ def setHidden(path, hidden = True):
     ret = ioretry(cmd)
 
 def getSizeVirt(path):
+    (ok, size) = _readVHD(path, lambda vhd: vhd.getSizeVirt())
+    if ok:
+        return size
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-v", "-n", path]
     ret = ioretry(cmd)
     size = long(ret) * 1024 * 1024
@@ -206,6 +266,9 @@ def getMaxResizeSize(path):
     return int(ret)
 
 def getSizePhys(path):
+    (ok, size) = _readVHD(path, lambda vhd: vhd.getSizePhys())
+    if ok:
+        return size
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-s", "-n", path]
     ret = ioretry(cmd)
     return int(ret)
@@ -222,6 +285,9 @@ def killData(path):
 
 def getDepth(path):
     "get the VHD parent chain depth"
+    (ok, depth) = _readVHD(path, lambda vhd: vhd.getDepth())
+    if ok:
+        return depth
     cmd = [VHD_UTIL, "query", OPT_LOG_ERR, "-d", "-n", path]
     text = ioretry(cmd)
     depth = -1
@@ -230,6 +296,9 @@ def getDepth(path):
     return depth
 
 def getBlockBitmap(path):
+    (ok, bitmap) = _readVHD(path, lambda vhd: vhd.getBlockBitmap())
+    if ok:
+        return zlib.compress(bitmap)
     cmd = [VHD_UTIL, "read", OPT_LOG_ERR, "-B", "-n", path]
     text = ioretry(cmd)
     return zlib.compress(text)